@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# ---------------------------------------------------------------------------
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+"""Benchmark and check the PAR2 builder.
+
+Builds a PAR2 set for some random files, then checks every packet, the file
+hashes and slice checksums, and a sample of words from each recovery slice
+worked out the slow way. If par2cmdline is around it also builds the same
+set with that, compares the recovery slices and has it verify ours.
+"""
+
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+from newsmangler import par2
+
+# Words of each recovery slice to check by hand
+SAMPLE_WORDS = 64
+
+def makeFiles(tmpdir, count, size):
+	files = []
+	for i in range(count):
+		path = os.path.join(tmpdir, 'file%d.bin' % (i))
+		with open(path, 'wb') as f:
+			# Make the files different sizes so the last slices get padded
+			f.write(os.urandom(size - i * 1001))
+		files.append((path, os.path.basename(path), os.path.getsize(path)))
+	return files
+
+def buildSet(files, basepath, blockSize, redundancy, workers):
+	executor = ProcessPoolExecutor(max_workers=workers)
+	for i in range(workers):
+		executor.submit(par2.gf_tables).result()
+	
+	done = threading.Event()
+	result = []
+	
+	start = time.perf_counter()
+	builder = par2.Par2Builder(basepath, files, blockSize, redundancy, executor, workers)
+	builder.on_done = lambda builder, ok: (result.append(ok), done.set())
+	for path, name, size in files:
+		feed = builder.feeder(path)
+		with open(path, 'rb') as f:
+			for begin in range(0, size, blockSize):
+				feed(begin, f.read(blockSize))
+	done.wait()
+	elapsed = time.perf_counter() - start
+	
+	executor.shutdown()
+	if not result[0]:
+		raise SystemExit('Building the PAR2 set failed')
+	return builder, elapsed
+
+# -----------------------------------------------------------------------
+# Read the packets from a .par2 file as (type, body), checking their hashes
+def readPackets(path):
+	with open(path, 'rb') as f:
+		data = f.read()
+	
+	packets = []
+	offset = 0
+	while offset < len(data):
+		assert data[offset:offset + 8] == par2.MAGIC, 'bad magic in %s' % (path)
+		length = struct.unpack('<Q', data[offset + 8:offset + 16])[0]
+		assert hashlib.md5(data[offset + 32:offset + length]).digest() == data[offset + 16:offset + 32], \
+			'bad packet hash in %s' % (path)
+		packets.append((data[offset + 48:offset + 64], data[offset + 64:offset + length]))
+		offset += length
+	return packets
+
+def recoverySlices(paths):
+	slices = {}
+	for path in paths:
+		for ptype, body in readPackets(path):
+			if ptype == par2.TYPE_RECVSLIC:
+				slices[struct.unpack('<I', body[:4])[0]] = body[4:]
+	return slices
+
+# Plain Python GF(2^16), nothing shared with the builder
+def gfTables():
+	exp = [0] * (par2.GF_ORDER * 2)
+	log = [0] * (par2.GF_ORDER + 1)
+	x = 1
+	for i in range(par2.GF_ORDER):
+		exp[i] = exp[i + par2.GF_ORDER] = x
+		log[x] = i
+		x <<= 1
+		if x & 0x10000:
+			x ^= par2.GF_POLY
+	return exp, log
+
+def checkSet(builder, files, blockSize):
+	exp, log = gfTables()
+	byName = dict((name, path) for path, name, size in files)
+	
+	# Critical packets, with the files in slice order
+	order = []
+	for ptype, body in readPackets(builder.volumes[0][0]):
+		if ptype == par2.TYPE_MAIN:
+			assert struct.unpack('<Q', body[:8])[0] == blockSize
+			order = [body[12 + i * 16:28 + i * 16] for i in range(struct.unpack('<I', body[8:12])[0])]
+		elif ptype == par2.TYPE_FILEDESC:
+			name = body[56:].rstrip(b'\0').decode('utf-8')
+			with open(byName[name], 'rb') as f:
+				data = f.read()
+			assert hashlib.md5(data).digest() == body[16:32], 'bad hash for %s' % (name)
+			assert hashlib.md5(data[:16384]).digest() == body[32:48], 'bad 16k hash for %s' % (name)
+	
+	slices = []
+	for fileid in order:
+		f = [f for f in builder.files if f.file_id == fileid][0]
+		with open(f.filepath, 'rb') as fh:
+			data = fh.read()
+		for begin in range(0, len(data), blockSize):
+			block = data[begin:begin + blockSize]
+			block += bytes(blockSize - len(block))
+			assert f.checksums[begin // blockSize] == (hashlib.md5(block).digest(), zlib.crc32(block)), \
+				'bad slice checksum for %s' % (f.filename)
+			slices.append(block)
+	
+	recovery = recoverySlices(path for path, start, count in builder.volumes)
+	assert sorted(recovery) == list(range(builder.recovery_blocks))
+	
+	logs = par2.input_logs(len(slices))
+	words = blockSize // 2
+	for exponent, data in recovery.items():
+		for w in range(0, words, max(1, words // SAMPLE_WORDS)):
+			want = 0
+			for i, block in enumerate(slices):
+				value = block[w * 2] | (block[w * 2 + 1] << 8)
+				if value:
+					want ^= exp[(log[value] + logs[i] * exponent) % par2.GF_ORDER]
+			got = data[w * 2] | (data[w * 2 + 1] << 8)
+			assert got == want, 'recovery slice %d is wrong at word %d' % (exponent, w)
+
+def compareWithPar2cmdline(par2cmd, builder, files, blockSize, tmpdir):
+	refdir = os.path.join(tmpdir, 'ref')
+	os.mkdir(refdir)
+	for path, name, size in files:
+		os.link(path, os.path.join(refdir, name))
+	
+	start = time.perf_counter()
+	subprocess.check_call([par2cmd, 'create', '-q', '-s%d' % (blockSize), '-c%d' % (builder.recovery_blocks),
+		'ref.par2'] + [name for path, name, size in files], cwd=refdir, stdout=subprocess.DEVNULL)
+	elapsed = time.perf_counter() - start
+	
+	theirs = recoverySlices(os.path.join(refdir, name) for name in os.listdir(refdir) if name.endswith('.par2'))
+	ours = recoverySlices(path for path, start, count in builder.volumes)
+	same = (theirs == ours)
+	
+	verified = subprocess.call([par2cmd, 'verify', '-q', builder.volumes[0][0]], cwd=tmpdir,
+		stdout=subprocess.DEVNULL) == 0
+	return elapsed, same, verified
+
+def main():
+	parser = OptionParser(usage='usage: %prog [options]')
+	parser.add_option('-s', '--size',
+		dest='size',
+		type='int',
+		default=32,
+		help='Size of each file in MB (default: %default)',
+	)
+	parser.add_option('-f', '--files',
+		dest='files',
+		type='int',
+		default=3,
+		help='Number of files (default: %default)',
+	)
+	parser.add_option('-b', '--block-size',
+		dest='block_size',
+		type='int',
+		default=768000,
+		help='PAR2 block size in bytes (default: %default)',
+	)
+	parser.add_option('-r', '--redundancy',
+		dest='redundancy',
+		type='int',
+		default=10,
+		help='Redundancy in percent (default: %default)',
+	)
+	parser.add_option('-w', '--workers',
+		dest='workers',
+		type='int',
+		default=os.cpu_count() or 1,
+		help='Number of worker processes (default: %default)',
+	)
+	parser.add_option('--par2',
+		dest='par2',
+		default=shutil.which('par2'),
+		help='par2cmdline to compare with (default: %default)',
+	)
+	(options, args) = parser.parse_args()
+	
+	if not par2.HAVE_NUMPY:
+		raise SystemExit('NumPy is needed to build PAR2 files')
+	
+	tmpdir = tempfile.mkdtemp(prefix='bench_par2-')
+	try:
+		files = makeFiles(tmpdir, options.files, options.size * 1024 * 1024)
+		total = sum(size for path, name, size in files)
+		
+		builder, elapsed = buildSet(files, os.path.join(tmpdir, 'bench'), options.block_size,
+			options.redundancy, options.workers)
+		print('%-14s %10s %10s %10s' % ('builder', 'MB/s', 'slices', 'recovery'))
+		print('%-14s %10.1f %10d %10d' % ('newsmangler', total / elapsed / 1024 / 1024,
+			builder.total_blocks, builder.recovery_blocks))
+		
+		checkSet(builder, files, options.block_size)
+		print('Packets, hashes and sampled recovery words check out')
+		
+		if options.par2:
+			elapsed, same, verified = compareWithPar2cmdline(options.par2, builder, files,
+				options.block_size, tmpdir)
+			print('%-14s %10.1f' % ('par2cmdline', total / elapsed / 1024 / 1024))
+			print('Recovery slices %s par2cmdline\'s' % ('match' if same else 'DO NOT match'))
+			print('par2cmdline %s our set' % ('verified' if verified else 'FAILED to verify'))
+		else:
+			print('par2cmdline not found, not comparing')
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+	main()
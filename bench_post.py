@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# ---------------------------------------------------------------------------
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""End to end posting benchmark against a local fake NNTP server.
+
+Posts generated datasets (lots of small files, a few huge ones) with each
+engine to newsmangler.fakenntp running in this process, and reports MB/s,
+CPU seconds, peak RSS and time to first byte. Each post runs in a process of
+its own so the CPU time and memory are just the poster's. The server can be
+told to misbehave (--latency, --bandwidth, --drop-rate, --fail-rate,
+--max-connections, --slow-ack) to see how we cope.
+
+-o writes the results as JSON, and --compare shows how they went against an
+earlier file, for checking a change against the commit before it.
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# name: (number of files, size of each file in bytes)
+DATASETS = {
+	'small': (400, 64 * 1024),
+	'huge': (2, 256 * 1024 * 1024),
+}
+
+MB = 1024.0 ** 2
+
+# ---------------------------------------------------------------------------
+
+def makeDataset(basedir, name, scale):
+	count, size = DATASETS[name]
+	size = max(1, int(size * scale))
+	if name == 'small':
+		count = max(1, int(count * scale))
+	
+	path = os.path.join(basedir, name)
+	if os.path.isdir(path) and len(os.listdir(path)) == count and \
+			all(os.path.getsize(os.path.join(path, f)) == size for f in os.listdir(path)):
+		return path, count * size
+	
+	shutil.rmtree(path, ignore_errors=True)
+	os.makedirs(path)
+	for i in range(count):
+		with open(os.path.join(path, '%s%04d.bin' % (name, i)), 'wb') as f:
+			left = size
+			while left:
+				chunk = min(left, 16 * 1024 * 1024)
+				f.write(os.urandom(chunk))
+				left -= chunk
+	return path, count * size
+
+def makeConf(options, engine, port):
+	return {
+		'posting': {
+			'from': 'bench <bench@localhost>',
+			'default_group': 'alt.binaries.test',
+			'article_size': options.article_size,
+			'subject_prefix': '',
+			'generate_nzbs': 0,
+			'engine': engine,
+			'encoder_workers': options.encoder_workers,
+			'encoder_pool': options.encoder_pool,
+			# Nothing gets left lying around between runs
+			'journal': '',
+			'server_state': '',
+			# Don't wait around too long when we're injecting failures
+			'retry_delay': 0.2,
+			'retry_max_delay': 2,
+		},
+		'server': {
+			'hostname': '127.0.0.1',
+			'port': port,
+			'use_ssl': 0,
+			'username': 'bench',
+			'password': 'bench',
+			'connections': options.connections,
+			'reconnect_delay': 1,
+			'streaming': options.streaming,
+			'quarantine_time': 2,
+		},
+	}
+
+def gitCommit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# ---------------------------------------------------------------------------
+# Run one post in a child process, which reports back through a file
+def runPost(conf, path, tmpdir):
+	resultPath = os.path.join(tmpdir, 'result.json')
+	job = {'conf': conf, 'path': path, 'result': resultPath}
+	proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'],
+		input=json.dumps(job).encode('utf-8'), stdout=subprocess.DEVNULL)
+	if proc.returncode != 0:
+		raise RuntimeError('posting process exited with %d' % (proc.returncode))
+	
+	with open(resultPath) as f:
+		return json.load(f)
+
+def runChild():
+	import resource
+	from newsmangler.postmangler import PostMangler
+	
+	logging.basicConfig(level=logging.WARNING)
+	job = json.load(sys.stdin)
+	
+	start = time.time()
+	poster = PostMangler(job['conf'], False)
+	poster.post(job['conf']['posting']['default_group'], [job['path']])
+	elapsed = time.time() - start
+	
+	# Encoder and PAR2 worker processes have been reaped by now
+	cpu = 0.0
+	for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+		usage = resource.getrusage(who)
+		cpu += usage.ru_utime + usage.ru_stime
+	
+	# ru_maxrss is KB on Linux and bytes on macOS
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		rss //= 1024
+	
+	with open(job['result'], 'w') as f:
+		json.dump({
+			'start': start,
+			'seconds': elapsed,
+			'bytes': poster._bytes,
+			'posted': poster._posted,
+			'failed': len(poster._failed),
+			'cpu_seconds': cpu,
+			'peak_rss_kb': rss,
+		}, f)
+
+# ---------------------------------------------------------------------------
+
+def compareResults(results, path):
+	with open(path) as f:
+		old = dict(((r['dataset'], r['engine']), r) for r in json.load(f)['results'])
+	
+	print('')
+	print('Compared with %s:' % (path))
+	print('%-8s %-9s %10s %10s %8s' % ('dataset', 'engine', 'old MB/s', 'new MB/s', 'change'))
+	for r in results:
+		o = old.get((r['dataset'], r['engine']))
+		if o is None or not o['mb_s']:
+			continue
+		print('%-8s %-9s %10.1f %10.1f %+7.1f%%' % (r['dataset'], r['engine'], o['mb_s'], r['mb_s'],
+			(r['mb_s'] / o['mb_s'] - 1) * 100))
+
+def main():
+	parser = OptionParser(usage='usage: %prog [options]')
+	parser.add_option('--child', action='store_true', default=False, help='(used internally)')
+	parser.add_option('-d', '--dataset', dest='datasets', action='append',
+		choices=sorted(DATASETS), type='choice',
+		help='Dataset to post, can be given more than once (default: all of them)',
+	)
+	parser.add_option('-e', '--engine', dest='engines', action='append',
+		choices=['asyncore', 'asyncio'], type='choice',
+		help='Posting engine, can be given more than once (default: all available)',
+	)
+	parser.add_option('--scale', dest='scale', type='float', default=1.0,
+		help='Scale the dataset sizes by this much (default: %default)',
+	)
+	parser.add_option('--data-dir', dest='data_dir',
+		help='Keep generated datasets in DIR and reuse them next time',
+		metavar='DIR',
+	)
+	parser.add_option('-n', '--repeat', dest='repeat', type='int', default=1,
+		help='Post each dataset this many times and keep the best (default: %default)',
+	)
+	parser.add_option('-c', '--connections', dest='connections', type='int', default=4,
+		help='Connections to the server (default: %default)',
+	)
+	parser.add_option('-s', '--article-size', dest='article_size', type='int', default=768000,
+		help='Article size in bytes (default: %default)',
+	)
+	parser.add_option('--streaming', dest='streaming', default='auto',
+		help='server/streaming setting: auto, 0 or 1 (default: %default)',
+	)
+	parser.add_option('-w', '--encoder-workers', dest='encoder_workers', type='int', default=2,
+		help='Encoder workers (default: %default)',
+	)
+	parser.add_option('--encoder-pool', dest='encoder_pool', default='thread',
+		help='Encoder pool, thread or process (default: %default)',
+	)
+	parser.add_option('--latency', dest='latency', type='float', default=0.0,
+		help='Seconds the server waits before each response',
+	)
+	parser.add_option('--bandwidth', dest='bandwidth', type='float', default=0,
+		help='Most MB/s each connection can send the server',
+	)
+	parser.add_option('--drop-rate', dest='drop_rate', type='float', default=0.0,
+		help='Chance of the server dropping the connection during an article',
+	)
+	parser.add_option('--fail-rate', dest='fail_rate', type='float', default=0.0,
+		help='Chance of the server failing an article (441)',
+	)
+	parser.add_option('--max-connections', dest='max_connections', type='int', default=0,
+		help='The server sends 502 to connections past this many',
+	)
+	parser.add_option('--slow-ack', dest='slow_ack', type='float', default=0.0,
+		help='Extra seconds the server takes to accept each article',
+	)
+	parser.add_option('-o', '--output', dest='output',
+		help='Write the results to FILE as JSON',
+		metavar='FILE',
+	)
+	parser.add_option('--compare', dest='compare',
+		help='Compare the results with an earlier JSON FILE',
+		metavar='FILE',
+	)
+	(options, args) = parser.parse_args()
+	
+	if options.child:
+		runChild()
+		return
+	
+	if options.streaming.isdigit():
+		options.streaming = int(options.streaming)
+	
+	from newsmangler.fakenntp import FakeNNTPServer
+	
+	datasets = options.datasets or sorted(DATASETS)
+	engines = options.engines
+	if not engines:
+		engines = ['asyncio']
+		if importlib.util.find_spec('asyncore') is not None:
+			engines.insert(0, 'asyncore')
+	
+	server = FakeNNTPServer(username='bench', password='bench', latency=options.latency,
+		bandwidth=int(options.bandwidth * MB), drop_rate=options.drop_rate, fail_rate=options.fail_rate,
+		max_connections=options.max_connections, slow_ack=options.slow_ack, keep_msgids=False).start()
+	
+	tmpdir = tempfile.mkdtemp(prefix='bench_post-')
+	datadir = options.data_dir or tmpdir
+	results = []
+	try:
+		print('%-8s %-9s %8s %8s %8s %10s %8s %8s %8s' % ('dataset', 'engine', 'MB', 'MB/s', 'CPU s',
+			'MB/CPU s', 'RSS MB', 'TTFB ms', 'failed'))
+		for dataset in datasets:
+			path, size = makeDataset(datadir, dataset, options.scale)
+			for engine in engines:
+				best = None
+				for i in range(options.repeat):
+					server.stats.reset()
+					r = runPost(makeConf(options, engine, server.port), path, tmpdir)
+					stats = server.stats.as_dict()
+					
+					r['mb_s'] = r['bytes'] / MB / max(r['seconds'], 0.001)
+					r['ttfb'] = (stats['first_byte_at'] - r['start']) if stats['first_byte_at'] else None
+					r['server'] = stats
+					if best is None or r['mb_s'] > best['mb_s']:
+						best = r
+				
+				best.update(dataset=dataset, engine=engine, data_bytes=size)
+				results.append(best)
+				print('%-8s %-9s %8.1f %8.1f %8.2f %10.1f %8.1f %8s %8d' % (dataset, engine, best['bytes'] / MB,
+					best['mb_s'], best['cpu_seconds'], best['bytes'] / MB / max(best['cpu_seconds'], 0.001),
+					best['peak_rss_kb'] / 1024.0, best['ttfb'] is not None and '%.1f' % (best['ttfb'] * 1000) or '-',
+					best['failed']))
+				
+				if stats['bad']:
+					print('  the server got %d bad article(s)!' % (stats['bad']))
+	finally:
+		server.stop()
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	
+	if options.output:
+		with open(options.output, 'w') as f:
+			json.dump({
+				'commit': gitCommit(),
+				'python': sys.version.split()[0],
+				'time': time.time(),
+				'options': dict((k, v) for k, v in vars(options).items() if k not in ('child', 'output', 'compare')),
+				'results': results,
+			}, f, indent=1, sort_keys=True)
+	
+	if options.compare:
+		compareResults(results, options.compare)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# ---------------------------------------------------------------------------
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark the yEnc encoders and decoders we have available.
+
+For each one this reports throughput and the peak memory allocated while
+encoding or decoding a single part, as measured by tracemalloc. Decoder
+speeds are for the decoded data.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from optparse import OptionParser
+
+from newsmangler import yenc
+
+def getEncoders(partSize):
+	encoders = [
+		('python3-reference', lambda data: yenc.yEncode_Python3(BytesIO(), data)),
+		('python', lambda data: yenc.yEncode_Python(BytesIO(), data)),
+	]
+	
+	# Preallocated buffer, like a caller that reuses its buffers would
+	buf = bytearray(yenc.yEncodeBufferSize(partSize))
+	encoders.append(('python-into', lambda data: yenc.yEncodeInto_Python(buf, data)))
+	if yenc.HAVE_NUMPY:
+		encoders.append(('numpy-into', lambda data: yenc.yEncodeInto_NumPy(buf, data)))
+	
+	# Everything in the encoder registry, pure Python included
+	for name, (encode, description) in yenc.ENCODERS.items():
+		if name != 'python':
+			encoders.append((name, lambda data, encode=encode: encode(BytesIO(), data)))
+	
+	return encoders
+
+# Decoders get the encoded part, the article decoder a whole article body
+# that gets its =y lines parsed and CRC checked.
+def getDecoders(encoded, size, crc):
+	decoders = [(name, decode, encoded) for name, decode in yenc.DECODERS.items()]
+	
+	body = b'=ybegin part=1 total=1 line=128 size=%d name=bench\r\n=ypart begin=1 end=%d\r\n' % (size, size)
+	body += encoded + b'=yend size=%d part=1 pcrc32=%s\r\n' % (size, crc.encode('ascii'))
+	decoders.append(('article', yenc.yDecodeArticle, body))
+	
+	return decoders
+
+def benchEncoder(encode, data, iterations):
+	# Warm up, this also makes sure any scratch buffers exist already
+	encode(data)
+	
+	start = time.perf_counter()
+	for i in range(iterations):
+		encode(data)
+	elapsed = time.perf_counter() - start
+	
+	tracemalloc.start()
+	encode(data)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	
+	return elapsed, peak
+
+def main():
+	parser = OptionParser(usage='usage: %prog [options]')
+	parser.add_option('-s', '--size',
+		dest='size',
+		type='int',
+		default=768000,
+		help='Part size in bytes (default: %default)',
+	)
+	parser.add_option('-n', '--iterations',
+		dest='iterations',
+		type='int',
+		default=50,
+		help='Number of parts to encode per encoder (default: %default)',
+	)
+	(options, args) = parser.parse_args()
+	
+	data = os.urandom(options.size)
+	
+	print('%-18s %10s %10s %12s' % ('encoder', 'MB/s', 'ms/part', 'peak KB'))
+	for name, encode in getEncoders(options.size):
+		elapsed, peak = benchEncoder(encode, data, options.iterations)
+		mbps = options.size * options.iterations / elapsed / 1024 / 1024
+		print('%-18s %10.1f %10.2f %12.1f' % (name, mbps, elapsed / options.iterations * 1000, peak / 1024.0))
+	
+	postfile = BytesIO()
+	crc = yenc.yEncode(postfile, data)
+	encoded = postfile.getvalue()
+	
+	print()
+	print('%-18s %10s %10s %12s' % ('decoder', 'MB/s', 'ms/part', 'peak KB'))
+	for name, decode, encoded in getDecoders(encoded, options.size, crc):
+		elapsed, peak = benchEncoder(decode, encoded, options.iterations)
+		mbps = options.size * options.iterations / elapsed / 1024 / 1024
+		print('%-18s %10.1f %10.2f %12.1f' % (name, mbps, elapsed / options.iterations * 1000, peak / 1024.0))
+
+if __name__ == '__main__':
+	main()
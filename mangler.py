@@ -28,17 +28,18 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import signal
 import sys
 import logging
 from optparse import OptionParser
 
-from newsmangler.common import parseManglerConfig, setupLogger, NM_VERSION
+from newsmangler.common import parseManglerConfig, parseRate, setupLogger, NM_VERSION
 from newsmangler.postmangler import PostMangler
 
 #class InputDataValidator
 def parseCmdLineOption():
 	# Parse our command line options
-	parser = OptionParser(usage='usage: %prog [options] dir1 dir2 ... dirN')
+	parser = OptionParser(usage='usage: %prog [options] dir1 dir2 ... dirN\n       %prog [options] --verify [--repair DIR] nzb1 nzb2 ... nzbN')
 	parser.add_option('-c', '--config',
 		dest='config',
 		help='Specify a different config file location',
@@ -52,6 +53,58 @@ def parseCmdLineOption():
 		dest='group',
 		help='Post to a different group than the default',
 	)
+	parser.add_option('-e', '--engine',
+		dest='engine',
+		type='choice',
+		choices=['asyncore', 'asyncio'],
+		help='Posting engine to use, asyncore or asyncio (default: from config, asyncore)',
+	)
+	parser.add_option('-j', '--journal',
+		dest='journal',
+		help='Keep a journal of posted parts in FILE, so an interrupted post can be resumed (default: from config, none)',
+		metavar='FILE',
+	)
+	parser.add_option('-l', '--limit',
+		dest='rate_limit',
+		help='Limit posting to RATE, e.g. 800K, 50MB/s or 400Mbit (default: from config, no limit). Send SIGHUP to re-read the limit from the config file',
+		metavar='RATE',
+	)
+	parser.add_option('-w', '--workers',
+		dest='workers',
+		type='int',
+		help='Post from N worker processes, each with a share of the connections (default: from config, 1)',
+		metavar='N',
+	)
+	parser.add_option('--pin-cpus',
+		dest='pin_cpus',
+		action='store_true',
+		default=False,
+		help='Give each worker process its own share of the CPUs',
+	)
+	parser.add_option('-r', '--resume',
+		dest='resume',
+		action='store_true',
+		default=False,
+		help='Resume an interrupted post, skipping parts the journal (-j) says were posted',
+	)
+	parser.add_option('--verify',
+		dest='verify',
+		action='store_true',
+		default=False,
+		help='Check that every segment in the NZB files given as arguments is on the server',
+	)
+	parser.add_option('--repair',
+		dest='repair',
+		action='append',
+		help='Check the NZB files given as arguments and post any missing segments again from the files in DIR. Can be given more than once',
+		metavar='DIR',
+	)
+	parser.add_option('--bench-encoders',
+		dest='bench_encoders',
+		action='store_true',
+		default=False,
+		help='Check and time the yEnc encoders we have, and show which one would be used',
+	)
 	parser.add_option('-d', '--debug',
 		dest='debug',
 		action='store_true',
@@ -68,7 +121,7 @@ def parseCmdLineOption():
 	(options, args) = parser.parse_args()
 	
 	# No args? We have nothing to do!
-	if not args:
+	if not args and not options.bench_encoders:
 		parser.print_help()
 		sys.exit(1)
 		
@@ -126,24 +179,108 @@ def getValidNewsgroupName(options, manglerConfDict):
 	
 	return newsgroup
 
+# Re-read the rate limit from the config file when we get a SIGHUP
+def watchRateLimit(poster, cfgfile):
+	logger = logging.getLogger('mangler')
+	
+	def reload(signum, frame):
+		try:
+			rate = parseRate(parseManglerConfig(cfgfile)['posting'].get('rate_limit', 0))
+		except (IOError, ValueError) as msg:
+			logger.error('Unable to change the rate limit: %s' % (msg))
+		else:
+			poster.set_rate_limit(rate)
+	
+	if hasattr(signal, 'SIGHUP'):
+		signal.signal(signal.SIGHUP, reload)
+
+# Show how each yEnc encoder did
+def benchEncoders():
+	from newsmangler import yenc
+	
+	results = yenc.benchEncoders()
+	good = [(result['mbps'], name) for name, result in results.items() if result['error'] is None]
+	best = max(good)[1] if good else None
+	
+	print('%-10s %-24s %10s  %s' % ('encoder', 'description', 'MB/s', 'status'))
+	for name, result in results.items():
+		if result['error'] is not None:
+			status = 'broken: %s' % (result['error'])
+		elif name == best:
+			status = 'ok, fastest'
+		else:
+			status = 'ok'
+		print('%-10s %-24s %10.1f  %s' % (name, result['description'], result['mbps'], status))
+
+# Check the NZBs given on the command line, and repair them if we've been
+# asked to. Returns the exit status, 1 if anything is still missing.
+def verifyNZBs(options, args, manglerConf):
+	logger = logging.getLogger('mangler')
+	
+	nzbs = [arg for arg in args if os.path.isfile(arg)]
+	for arg in args:
+		if arg not in nzbs:
+			logger.error('"%s" does not exist or is not a file!' % (arg))
+	
+	for dirname in options.repair or []:
+		if not os.path.isdir(dirname):
+			logger.error('"%s" does not exist or is not a directory!' % (dirname))
+			return 1
+	
+	if not nzbs:
+		logger.error('No valid arguments provided on command line!')
+		return 1
+	
+	if options.engine:
+		manglerConf['posting']['engine'] = options.engine
+	if options.rate_limit:
+		manglerConf['posting']['rate_limit'] = options.rate_limit
+	
+	poster = PostMangler(manglerConf, debug=options.debug)
+	if options.repair:
+		return 1 if poster.repair(nzbs, options.repair) else 0
+	return 1 if poster.verify(nzbs) else 0
+
 def main():
 	(options, args) = parseCmdLineOption()
 	setupLogger(options.debug)
 	
+	if options.bench_encoders:
+		benchEncoders()
+		return
+	
 	logger = logging.getLogger('mangler')
 	logger.info("Welcome to newsMangler v%s" % NM_VERSION)
 	
+	DEFAULT_CFG_FILE = '~/.newsmangler.conf'
+	cfgfile = options.config if options.config else DEFAULT_CFG_FILE
+	
+	if options.verify or options.repair:
+		sys.exit(verifyNZBs(options, args, parseManglerConfig(cfgfile)))
+	
 	resourceToPost = getPostSources(options, args)
 	post_title = getPostTitle(options, args)
 	
 	# Parse our configuration file
-	DEFAULT_CFG_FILE = '~/.newsmangler.conf'
-	manglerConf = parseManglerConfig(options.config if options.config else DEFAULT_CFG_FILE)
+	manglerConf = parseManglerConfig(cfgfile)
 	
 	newsgroup = getValidNewsgroupName(options, manglerConf)
 	
+	if options.engine:
+		manglerConf['posting']['engine'] = options.engine
+	if options.journal:
+		manglerConf['posting']['journal'] = options.journal
+	if options.rate_limit:
+		manglerConf['posting']['rate_limit'] = options.rate_limit
+	if options.workers:
+		manglerConf['posting']['workers'] = options.workers
+	if options.pin_cpus:
+		manglerConf['posting']['worker_pinning'] = 1
+	manglerConf['posting']['resume'] = options.resume
+	
 	# And off we go
 	poster = PostMangler(manglerConf, debug=options.debug)
+	watchRateLimit(poster, cfgfile)
 	
 	if options.profile:
 		import hotshot
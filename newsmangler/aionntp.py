@@ -0,0 +1,430 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"A basic NNTP client using asyncio"
+
+import asyncio
+import logging
+import re
+import time
+
+try:
+    import ssl
+except ImportError:
+    SSL_SUPPORT = False
+else:
+    SSL_SUPPORT = True
+
+# ---------------------------------------------------------------------------
+
+POST_READ_SIZE = 262144
+
+MSGID_RE = re.compile(r'(<\S+@\S+>)')
+
+# ---------------------------------------------------------------------------
+
+class NNTPError(Exception):
+    pass
+
+# ---------------------------------------------------------------------------
+
+class AioNNTP:
+    def __init__(self, parent, pool, connid, host, port, bindto, username, password, use_ssl):
+        self.logger = logging.getLogger('aioNNTP')
+        
+        self.parent = parent
+        # The ServerPool we belong to, and its config section
+        self.pool = pool
+        self.server = pool.conf
+        self.connid = connid
+        self.host = host
+        self.port = port
+        self.bindto = bindto
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        
+        self._reader = None
+        self._writer = None
+        self._sock = None
+        self._article = None
+        
+        # Streaming mode, and articles sent with TAKETHIS that haven't been
+        # answered yet.
+        self._streaming = False
+        self._inflight = {}
+        
+        # Posts that have failed on this connection in a row
+        self._failures = 0
+        
+        # We've been asked to go away once we're not posting anything
+        self.retiring = False
+        # Set while we're waiting to reconnect, retire() cuts that short
+        self._wakeup = None
+        
+        # Our bits of the job's metrics
+        metrics = parent.metrics
+        self._bytes_metric = metrics.conn_bytes.labels(server=pool.name, connection=connid)
+        self._post_wait = metrics.post_wait.labels(server=pool.name)
+        self._ack_wait = metrics.ack_wait.labels(server=pool.name)
+        self._reconnects = metrics.reconnects.labels(server=pool.name)
+        self._responses = metrics.responses
+    
+    # -----------------------------------------------------------------------
+    # Read a single response line and return (code, line)
+    async def _read_response(self):
+        line = await self._reader.readline()
+        if not line:
+            raise NNTPError('connection closed by server')
+        
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        self.logger.debug('%d: < %s', self.connid, line)
+        if line[:3].isdigit():
+            self._responses.labels(server=self.pool.name, code=line[:3]).inc()
+        return line.split(None, 1)[0], line
+    
+    # Read the rest of a multi-line response, up to the terminating dot
+    async def _read_multiline(self):
+        lines = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise NNTPError('connection closed by server')
+            
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if line == '.':
+                return lines
+            lines.append(line)
+    
+    async def _command(self, text, logtext=None):
+        self.logger.debug('%d: > %s', self.connid, logtext or text)
+        self._writer.write(('%s\r\n' % (text)).encode('utf-8'))
+        await self._writer.drain()
+        return await self._read_response()
+    
+    # -----------------------------------------------------------------------
+    # Connect and log in, trying again every reconnect_delay seconds until
+    # there's nothing left to post or we're retired
+    async def connect(self):
+        while self.parent.has_work() and not self.retiring:
+            try:
+                await self._connect()
+            except (OSError, NNTPError) as msg:
+                self.logger.warning('%d: %s!', self.connid, msg)
+                self.pool.conn_failed()
+                self._reconnects.inc()
+                await self.close()
+                await self.pause(self.server['reconnect_delay'])
+            else:
+                self.logger.debug('%d: ready.', self.connid)
+                return
+    
+    async def _connect(self):
+        ssl_context = None
+        if self.use_ssl and SSL_SUPPORT:
+            ssl_context = ssl.create_default_context()
+        
+        local_addr = (self.bindto, 0) if self.bindto else None
+        
+        self.logger.debug('%d: connecting to %s:%s', self.connid, self.host, self.port)
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port,
+            ssl=ssl_context, local_addr=local_addr, limit=POST_READ_SIZE)
+        self._sock = self._writer.get_extra_info('socket')
+        if self._sock is not None:
+            self.parent.limiter.add(self._sock)
+        
+        resp, line = await self._read_response()
+        if resp not in ('200', '201'):
+            raise NNTPError('unknown welcome response - "%s"' % (line))
+        
+        if self.username:
+            resp, line = await self._command('AUTHINFO USER %s' % (self.username), 'AUTHINFO USER ********')
+            if resp == '381':
+                if not self.password:
+                    raise NNTPError('need password')
+                resp, line = await self._command('AUTHINFO PASS %s' % (self.password), 'AUTHINFO PASS ********')
+            
+            if resp != '281':
+                raise NNTPError('authentication failure')
+        
+        await self._check_streaming()
+    
+    # Find out if we can stream articles, unless we already know about this
+    # server. Servers without CAPABILITIES might still understand MODE STREAM.
+    async def _check_streaming(self):
+        self._streaming = False
+        self._inflight = {}
+        
+        streaming = self.parent.streaming_for(self.server, self.host, self.port)
+        if streaming is None:
+            resp, line = await self._command('CAPABILITIES')
+            if resp == '101':
+                caps = [line.split(None, 1)[0].upper() for line in await self._read_multiline() if line]
+                streaming = ('STREAMING' in caps)
+            else:
+                streaming = True
+        
+        if streaming:
+            resp, line = await self._command('MODE STREAM')
+            self._streaming = (resp == '203')
+        
+        self.parent.remember_streaming(self.host, self.port, self._streaming)
+        self.logger.debug('%d: streaming %s', self.connid,
+            self._streaming and 'enabled' or 'not supported')
+    
+    async def close(self):
+        if self._sock is not None:
+            self.parent.limiter.remove(self._sock)
+            self._sock = None
+        
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (OSError, NNTPError):
+                pass
+        
+        self._reader = None
+        self._writer = None
+        self._inflight = {}
+    
+    # -----------------------------------------------------------------------
+    # Post articles until there are none left, or we're told to stop
+    async def run(self):
+        while self.parent.has_work() and not self.retiring:
+            if self._writer is None:
+                await self.connect()
+                continue
+            
+            try:
+                if self._streaming:
+                    await self.stream_articles()
+                    continue
+                
+                self._article = await self.parent.next_article_async(self)
+                if self._article is None:
+                    break
+                
+                await self.post_article(self._article)
+                self._article = None
+                self.check_failures()
+            except (OSError, NNTPError) as msg:
+                self.logger.warning('%d: %s!', self.connid, msg)
+                self._reconnects.inc()
+                self.requeue_lost()
+                await self.close()
+                await self.pause(self.reconnect_delay())
+            finally:
+                self._article = None
+        
+        if self._writer is not None:
+            try:
+                await self._command('QUIT')
+            except (OSError, NNTPError):
+                pass
+            await self.close()
+        
+        self.parent.connection_closed(self)
+    
+    # Connected and logged in
+    def is_connected(self):
+        return self._writer is not None
+    
+    # Go away once we've finished what we're posting
+    def retire(self):
+        self.retiring = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    # Number of articles we're in the middle of posting
+    def in_flight(self):
+        return len(self._inflight) + (self._article is not None)
+    
+    # Wait before reconnecting, unless everything gets finished or we're
+    # retired first
+    async def pause(self, delay):
+        self._wakeup = asyncio.Event()
+        waits = [asyncio.ensure_future(event.wait()) for event in (self.parent._all_done, self._wakeup)]
+        try:
+            await asyncio.wait(waits, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._wakeup = None
+            for wait in waits:
+                wait.cancel()
+    
+    # -----------------------------------------------------------------------
+    # Anything we were in the middle of posting when the connection went away
+    # has to go back in the queue.
+    def requeue_lost(self):
+        lost = list(self._inflight.values())
+        if self._article is not None:
+            lost.append(self._article)
+        
+        self._inflight = {}
+        self._article = None
+        
+        if lost:
+            self._failures += 1
+            for article in lost:
+                self.parent.post_failed(article, 'connection closed while posting')
+    
+    def post_ok(self, article):
+        self._failures = 0
+        self.parent.post_success(article)
+        article.release()
+    
+    def post_failed(self, article, reason):
+        self._failures += 1
+        self.parent.post_failed(article, reason)
+    
+    # Close the connection if posts keep failing on it
+    def check_failures(self):
+        if self._failures >= self.server.get('quarantine_after', 3):
+            raise NNTPError('too many failed posts')
+    
+    # How long to wait before reconnecting, a connection that keeps failing
+    # gets a rest.
+    def reconnect_delay(self):
+        if self._failures >= self.server.get('quarantine_after', 3):
+            quarantine = self.server.get('quarantine_time', 60)
+            self.logger.warning('%d: %d failures in a row, waiting %ds before reconnecting',
+                self.connid, self._failures, quarantine)
+            self._failures = 0
+            return quarantine
+        return self.server['reconnect_delay']
+    
+    # Send articles back to back with TAKETHIS, only stopping to read
+    # responses when stream_window of them are waiting for one.
+    async def stream_articles(self):
+        window = self.server.get('stream_window', 8)
+        
+        while True:
+            finished = self.retiring or not self.parent.has_work()
+            while self._inflight and (len(self._inflight) >= window or finished):
+                await self._stream_response()
+            
+            if finished:
+                return
+            
+            # Don't sit waiting for the encoder while the server has
+            # something to tell us.
+            article = self.parent.next_article(self)
+            if article is None:
+                if self._inflight:
+                    await self._stream_response()
+                    continue
+                article = await self.parent.next_article_async(self)
+                if article is None:
+                    return
+            
+            await self.take_this(article)
+    
+    async def take_this(self, article):
+        article.prepare()
+        
+        msgid = article.headers['Message-ID']
+        self._inflight[msgid] = article
+        self.logger.debug('%d: > TAKETHIS %s', self.connid, msgid)
+        self._writer.write(('TAKETHIS %s\r\n' % (msgid)).encode('utf-8'))
+        await self.send_article(article)
+        article.sent_at = time.time()
+    
+    # Responses to TAKETHIS come back in any order
+    async def _stream_response(self):
+        resp, line = await self._read_response()
+        m = MSGID_RE.search(line)
+        article = m and self._inflight.pop(m.group(1), None)
+        if not article:
+            raise NNTPError('unknown response while streaming - "%s"' % (line))
+        
+        self._ack_wait.observe(time.time() - article.sent_at)
+        if resp == '239':
+            self.post_ok(article)
+        # Rejected, trying again won't help
+        elif resp == '439':
+            self.logger.warning('%d: article rejected - %s', self.connid, line)
+            self.parent.post_failed(article, line, retry=False)
+        else:
+            self.logger.warning('%d: posting failed - %s', self.connid, line)
+            self.post_failed(article, line)
+            self.check_failures()
+    
+    async def post_article(self, article):
+        start = time.time()
+        resp, line = await self._command('POST')
+        self._post_wait.observe(time.time() - start)
+        
+        # Posting is not allowed
+        if resp == '440':
+            self.logger.warning('%d: posting not allowed!', self.connid)
+            self.post_failed(article, line)
+            return
+        elif resp != '340':
+            self.logger.warning('%d: unknown response to POST - "%s"', self.connid, line)
+            self.post_failed(article, line)
+            return
+        
+        # Prepare the article for posting
+        article.prepare()
+        await self.send_article(article)
+        
+        sent_at = time.time()
+        resp, line = await self._read_response()
+        self._ack_wait.observe(time.time() - sent_at)
+        if resp == '240':
+            self.post_ok(article)
+            return
+        elif resp.startswith('44'):
+            self.logger.warning('%d: posting failed - %s', self.connid, line)
+        else:
+            self.logger.warning('%d: unknown response after posting - "%s"', self.connid, line)
+        self.post_failed(article, line)
+    
+    # Send a prepared article, drain() makes sure we don't buffer the whole
+    # thing up. Slicing the views doesn't copy anything, the transport only
+    # copies whatever the socket didn't take straight away. We only send as
+    # much at a time as the rate limiter lets us.
+    async def send_article(self, article):
+        limiter = self.parent.limiter
+        for buf in article.buffers():
+            i = 0
+            while i < len(buf):
+                size = min(len(buf) - i, POST_READ_SIZE)
+                allowed = limiter.allow(size)
+                if not allowed:
+                    await asyncio.sleep(limiter.delay(size))
+                    continue
+                
+                data = buf[i:i + allowed]
+                self._writer.write(data)
+                limiter.used(allowed)
+                await self._writer.drain()
+                self.parent._bytes += allowed
+                self._bytes_metric.inc(allowed)
+                i += allowed
+
+# ---------------------------------------------------------------------------
@@ -25,6 +25,8 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import time
+
 from collections import OrderedDict
 try:
 	from cStringIO import StringIO as BytesIO
@@ -32,10 +34,10 @@ except ImportError:
 	#python 3.x
 	from io import BytesIO
 
-from newsmangler.yenc import yEncode
+from newsmangler import yenc
 
 class Article:
-	def __init__(self, filewrap, begin, end, fileinfo, subject, partnum):
+	def __init__(self, filewrap, begin, end, fileinfo, subject, partnum, bufpool=None):
 		self._filewrap = filewrap
 		self._begin = begin
 		self._end = end
@@ -44,41 +46,143 @@ class Article:
 		self._partnum = partnum
 		
 		self.headers = OrderedDict()
+		
+		# Headers and yEnc start lines, encoded data, yEnc end and terminator
+		self._head = b''
 		self.postfile = BytesIO()
+		self._tail = b''
 
 		self.__article_size = 0
+		
+		# Encoded data goes in a buffer from this pool if we have one, and
+		# if postfile is one of them right now.
+		self._bufpool = bufpool
+		self._pooled = False
+		
+		# The CRC32 of our part, and if the whole file CRC32 is still missing
+		# from our =yend line.
+		self._partcrc = None
+		self._need_crc = False
+		
+		# How long the last prepare() took
+		self.encode_time = 0.0
+		
+		# How many times we've tried to post this, the server it was last
+		# handed to and when, when it was sent, and the servers it failed on.
+		self.attempts = 0
+		self.server = None
+		self.dispatched_at = 0
+		self.sent_at = 0
+		self.failed_on = ()
+
+	def is_prepared(self):
+		return self.__article_size > 0
+
+	# Size of the prepared article, 0 if it isn't prepared
+	def prepared_size(self):
+		return self.__article_size
+
+	# Use article data that was prepared somewhere else (another process),
+	# takes the pieces buffers() returned over there, how long it took and the
+	# part CRC32.
+	def set_prepared(self, head, body, tail, encode_time=0.0, partcrc=None):
+		self._head = head
+		self.postfile = BytesIO(body)
+		self._tail = tail
+		self.encode_time = encode_time
+		self.__article_size = len(head) + len(body) + len(tail)
+		self._filewrap.replay_read(self._begin, self._end)
+		# The file checksum over there was a throwaway copy, tell the real one
+		# about our part and redo the =yend line with what it knows.
+		if partcrc is not None:
+			self._partcrc = partcrc
+			self._add_crc()
+			self._tail = self._yend()
+			self.__article_size = len(head) + len(body) + len(self._tail)
 
 	def prepare(self):
 		# Don't prepare again if we already did everything
 		if self.__article_size > 0:
-			self.postfile.seek(0, 0)
 			return self.__article_size
+		
+		start = time.time()
 
 		# Headers
+		lines = []
 		for k, v in self.headers.items():
-			self.postfile.write( ('%s: %s\r\n' % (k, v)).encode('utf-8') )
+			lines.append('%s: %s\r\n' % (k, v))
 		
-		self.postfile.write(b'\r\n')
+		lines.append('\r\n')
 		
 		# yEnc start
-		line = '=ybegin part=%d total=%d line=128 size=%d name=%s\r\n' % (
+		lines.append('=ybegin part=%d total=%d line=128 size=%d name=%s\r\n' % (
 			self._partnum, self._fileinfo['parts'], self._fileinfo['filesize'], self._fileinfo['filename']
-		)
-		self.postfile.write(line.encode('utf-8'))
-		line = '=ypart begin=%d end=%d\r\n' % (self._begin + 1, self._end)
-		self.postfile.write(line.encode('utf-8'))
+		))
+		lines.append('=ypart begin=%d end=%d\r\n' % (self._begin + 1, self._end))
+		self._head = ''.join(lines).encode('utf-8')
 		
 		# yEnc data
+		self.take_buffer()
 		data = self._filewrap.read_part(self._begin, self._end)
-		partcrc = yEncode(self.postfile, data)
+		self._partcrc = yenc.yEncode(self.postfile, data)
+		self._add_crc()
 
-		# yEnc end
-		line = '=yend size=%d part=%d pcrc32=%s\r\n' % (self._end - self._begin, self._partnum, partcrc)
-		self.postfile.write(line.encode('utf-8'))
+		# yEnc end, and done writing for now
+		self._tail = self._yend()
 		
-		# And done writing for now
-		self.postfile.write('.\r\n'.encode('utf-8'))
-		self.__article_size = self.postfile.tell()
-		self.postfile.seek(0, 0)
+		self.__article_size = len(self._head) + self.postfile.tell() + len(self._tail)
+		self.encode_time = time.time() - start
 
 		return self.__article_size
+
+	# Get a buffer from the pool to encode into, the encoder pipeline does
+	# this before handing us to a worker.
+	def take_buffer(self):
+		if self._bufpool is not None and not self._pooled:
+			self.postfile = self._bufpool.get()
+			self._pooled = True
+
+	# Tell the file's checksum about our part CRC
+	def _add_crc(self):
+		checksum = self._fileinfo.get('checksum')
+		if checksum is not None:
+			checksum.add_crc(self._begin, self._end - self._begin, int(self._partcrc, 16))
+	
+	# The =yend line and terminator. The last part gets the CRC32 of the
+	# whole file too, if every part before it has been read by now.
+	def _yend(self):
+		line = '=yend size=%d part=%d pcrc32=%s' % (self._end - self._begin, self._partnum, self._partcrc)
+		
+		self._need_crc = False
+		if self._fileinfo['parts'] == 1:
+			line += ' crc32=%s' % (self._partcrc)
+		elif self._partnum == self._fileinfo['parts']:
+			crc = self._fileinfo.get('checksum') and self._fileinfo['checksum'].crc32()
+			if crc:
+				line += ' crc32=%s' % (crc)
+			else:
+				self._need_crc = 'checksum' in self._fileinfo
+		
+		return (line + '\r\n.\r\n').encode('utf-8')
+	
+	# The prepared article as a list of memoryviews, nothing gets copied.
+	def buffers(self):
+		# The other parts might have been read since we were prepared
+		if self._need_crc and self._fileinfo['checksum'].crc32():
+			size = self.__article_size - len(self._tail)
+			self._tail = self._yend()
+			self.__article_size = size + len(self._tail)
+		return [memoryview(self._head), self.postfile.getbuffer(), memoryview(self._tail)]
+
+	# We're done with the prepared data. Anyone still holding views from
+	# buffers() keeps the data alive until they let go, a pool buffer isn't
+	# used again until they do. prepare() will start from scratch if the
+	# article has to be posted again.
+	def release(self):
+		self._head = b''
+		if self._pooled:
+			self._pooled = False
+			self._bufpool.put(self.postfile)
+		self.postfile = BytesIO()
+		self._tail = b''
+		self.__article_size = 0
@@ -28,12 +28,18 @@
 "A basic NNTP client using asyncore"
 
 import asyncore
+import collections
+import errno
+import itertools
 import logging
+import os
 import re
-import select
 import socket
+import sys
 import time
 
+from newsmangler.eventloop import EVENT_READ, EVENT_WRITE
+
 try:
     import ssl
 except ImportError:
@@ -52,21 +58,40 @@ MODE_POST_INIT = 2
 MODE_POST_DATA = 3
 MODE_POST_DONE = 4
 MODE_DATA = 5
+MODE_CAPABILITIES = 6
+MODE_MODE_STREAM = 7
+MODE_STREAM = 8
 
 POST_BUFFER_MIN = 16384
-POST_READ_SIZE = 262144
+
+# Most buffers we'll hand to sendmsg() in one go
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Errors from send() that just mean the other end went away
+DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+    errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+
+# How long to wait before reconnecting after a non-socket error
+RECONNECT_MIN_DELAY = 0.5
 
 MSGID_RE = re.compile(r'(<\S+@\S+>)')
 
 # ---------------------------------------------------------------------------
 
 class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
-    def __init__(self, parent, connid, host, port, bindto, username, password, use_ssl):
+    def __init__(self, parent, pool, connid, host, port, bindto, username, password, use_ssl):
         asyncore.dispatcher.__init__(self)
         
         self.logger = logging.getLogger('asyncCores')
         
         self.parent = parent
+        # The ServerPool we belong to, and its config section
+        self.pool = pool
+        self.server = pool.conf
         self.connid = connid
         self.host = host
         self.port = port
@@ -75,21 +100,55 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
         self.password = password
         self.use_ssl = use_ssl
         
+        self.loop = parent.loop
+        self._events = 0
+        self._reconnect_timer = None
+        
+        # We've been asked to go away once we're not posting anything
+        self.retiring = False
+        
+        # Waiting for the rate limiter to let us send some more
+        self._throttle_timer = None
+        
+        # Posts that have failed on this connection in a row
+        self._failures = 0
+        
+        # Our bits of the job's metrics, and when we sent whatever we're
+        # waiting to hear back about.
+        metrics = parent.metrics
+        self._bytes_metric = metrics.conn_bytes.labels(server=pool.name, connection=connid)
+        self._post_wait = metrics.post_wait.labels(server=pool.name)
+        self._ack_wait = metrics.ack_wait.labels(server=pool.name)
+        self._reconnects = metrics.reconnects.labels(server=pool.name)
+        self._responses = metrics.responses
+        self._sent_at = 0
+        
         self.reset()
     
     def reset(self):
         self._readbuf = b''
-        self._writebuf = b''
+        self._writebufs = collections.deque()
         self._article = None
-        self._pointer = 0
+        
+        # Streaming mode: capabilities we've been sent so far, and the
+        # articles we've sent with TAKETHIS that haven't been answered yet.
+        self._caps = None
+        self._streaming = False
+        self._inflight = {}
         
         self.reconnect_at = 0
         self.mode = MODE_AUTH
         self.state = STATE_DISCONNECTED
+        
+        if self._throttle_timer is not None:
+            self._throttle_timer.cancel()
+            self._throttle_timer = None
 
     def do_connect(self):
         # Create the none ssl socket
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sendmsg = HAVE_SENDMSG
+        self.parent.limiter.add(self.socket)
         
         if self.use_ssl and SSL_SUPPORT:
             sock = self.socket
@@ -100,14 +159,14 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
         # Try to set our send buffer a bit larger
         for i in range(17, 13, -1):
             try:
-                self.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2**i)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2**i)
             except socket.error:
                 continue
             else:
                 break
         self.logger.debug('%d: SO_SNDBUF is %s', 
                           self.connid, 
-                          self.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+                          self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
         
         # Try to connect. This can blow up!
         try:
@@ -120,7 +179,14 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
     
     # -----------------------------------------------------------------------
     # Check to see if it's time to reconnect yet
-    def reconnect_check(self, now):
+    def reconnect_check(self, now=None):
+        self._reconnect_timer = None
+        if self.retiring:
+            self.shutdown()
+            return
+        
+        if now is None:
+            now = time.time()
         if self.state == STATE_DISCONNECTED and now >= self.reconnect_at:
             self.do_connect()
 
@@ -129,67 +195,142 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
         
         asyncore.dispatcher.add_channel(self, mapp)
 
-        # Add ourselves to the poll object
-        asyncore.poller.register(self._fileno)
+        # Add ourselves to the event loop, we want to know when the connect
+        # finishes so we need write events too.
+        self._events = EVENT_READ | EVENT_WRITE
+        self.loop.register(self._fileno, self._events, self)
     
     def del_channel(self, mapp=None):
-        self.logger.debug('%d: removing FD %d from poller', self.connid, self._fileno)
+        self.logger.debug('%d: removing FD %s from poller', self.connid, self._fileno)
+
+        # Remove ourselves from the event loop while we still know our FD
+        if self._fileno is not None:
+            self.loop.unregister(self._fileno)
+        self._events = 0
 
         # Remove ourselves from the async mapp
         asyncore.dispatcher.del_channel(self, mapp)
+    
+    # Only poke the selector if the events we care about actually changed
+    def update_events(self):
+        if self._fileno is None:
+            return
         
-        # Remove ourselves from the poll object
-        if self._fileno is not None:
-            try:
-                asyncore.poller.unregister(self._fileno)
-            except KeyError:
-                pass
+        events = EVENT_READ
+        if self.writable():
+            events |= EVENT_WRITE
+        
+        if events != self._events:
+            self._events = events
+            self.loop.modify(self._fileno, events, self)
 
     def close(self):
         self.del_channel()
         if self.socket is not None:
+            self.parent.limiter.remove(self.socket)
             self.socket.close()
     
     # -----------------------------------------------------------------------
     # We only want to be writable if we're connecting, or something is in our
-    # buffer.
+    # buffer and the rate limiter isn't making us wait.
     def writable(self):
-        return (not self.connected) or len(self._writebuf)
+        return (not self.connected) or (len(self._writebufs) and self._throttle_timer is None)
     
-    # Send some data from our buffer when we can write
+    # Send some data from our buffers when we can write
     def handle_write(self):
         #self.logger.debug('%d wants to write!', self._fileno)
         
         if not self.writable():
             # We don't have any buffer, silly thing
-            asyncore.poller.register(self._fileno, select.POLLIN)
+            self.update_events()
             return
         
-        sent = asyncore.dispatcher.send(self, self._writebuf[self._pointer:])
-        self._pointer += sent
+        # Only send as much as the rate limiter lets us, and stop asking to
+        # write until it lets us have more.
+        limiter = self.parent.limiter
+        pending = sum(len(buf) for buf in self._writebufs)
+        allowed = limiter.allow(pending)
+        if not allowed:
+            self._throttle_timer = self.loop.call_later(limiter.delay(pending), self.unthrottle)
+            self.update_events()
+            return
         
-        # We've run out of data
-        if self._pointer == len(self._writebuf):
-            self._writebuf = b''
-            self._pointer = 0
-            asyncore.poller.register(self._fileno, select.POLLIN)
+        sent = self.send_buffers(allowed)
+        limiter.used(sent)
         
-        # If we're posting, we might need to read some more data from our file
-        if self.mode == MODE_POST_DATA:
+        # Throw away whatever got sent. Partly sent buffers are sliced, which
+        # doesn't copy anything.
+        left = sent
+        while left:
+            buf = self._writebufs[0]
+            if left >= len(buf):
+                self._writebufs.popleft()
+                left -= len(buf)
+            else:
+                self._writebufs[0] = buf[left:]
+                left = 0
+        
+        # Streaming articles, just keep count
+        if self.mode == MODE_STREAM:
+            self.parent._bytes += sent
+            self._bytes_metric.inc(sent)
+        
+        # If we're posting, we might have just finished the article
+        elif self.mode == MODE_POST_DATA:
             self.parent._bytes += sent
-            if len(self._writebuf) == 0:
-                self.post_data()
+            self._bytes_metric.inc(sent)
+            if len(self._writebufs) == 0:
+                self.post_done()
+        
+        self.update_events()
     
+    def unthrottle(self):
+        self._throttle_timer = None
+        self.update_events()
     
+    # Send as much of our buffers as the socket will take, up to limit bytes,
+    # using sendmsg() to send several of them in one go if we can.
+    def send_buffers(self, limit):
+        try:
+            if self._sendmsg and len(self._writebufs) > 1:
+                bufs = []
+                for buf in itertools.islice(self._writebufs, IOV_MAX):
+                    bufs.append(buf[:limit])
+                    limit -= len(bufs[-1])
+                    if not limit:
+                        break
+                try:
+                    return self.socket.sendmsg(bufs)
+                except NotImplementedError:
+                    # SSL sockets don't do sendmsg()
+                    self._sendmsg = False
+            return self.socket.send(self._writebufs[0][:limit])
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except socket.error as why:
+            if why.errno in DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+    
+    # Queue some data to be sent. We keep a view of it instead of copying, so
+    # it had better not change until it's gone.
     def send(self, data):
-        self._writebuf += data
+        self._writebufs.append(memoryview(data))
         # We need to know about writable things now
-        asyncore.poller.register(self._fileno)
+        self.update_events()
         #self.logger.debug('%d has data!', self._fileno)
     
     
     def handle_error(self):
-        self.logger.exception('%d: unhandled exception!', self.connid)
+        # Socket errors (connection refused and friends) just mean we should
+        # try again later, anything else is a bug.
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error):
+            self.really_close(error)
+        else:
+            self.logger.exception('%d: unhandled exception!', self.connid)
+            self.really_close('unhandled exception')
     
     def handle_connect(self):
         self.status = STATE_CONNECTED
@@ -199,17 +340,51 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
         self.really_close()
     
     def really_close(self, error=None):
+        # Anything we were in the middle of posting has to go back in the
+        # queue.
+        lost = list(self._inflight.values())
+        if self.mode in (MODE_POST_INIT, MODE_POST_DATA, MODE_POST_DONE) and self._article is not None:
+            lost.append(self._article)
+        
+        # Never got as far as posting, the server might not want us
+        if self.state != STATE_CONNECTED:
+            self.pool.conn_failed()
+        self._reconnects.inc()
+        
         self.mode = MODE_COMMAND
         self.status = STATE_DISCONNECTED
         
+        # We can't post anything until we've reconnected
+        if self in self.parent._idle:
+            self.parent._idle.remove(self)
+        
         self.close()
         self.reset()
         
         if error and hasattr(error, 'args'):
-            self.logger.warning('%d: %s!', self.connid, error.args[1])
-            self.reconnect_at = time.time() + self.parent.conf['server']['reconnect_delay']
+            self.logger.warning('%d: %s!', self.connid, error.args[-1])
+            self.reconnect_at = time.time() + self.server['reconnect_delay']
         else:
             self.logger.warning('%d: Connection closed: %s', self.connid, error)
+            self.reconnect_at = time.time() + RECONNECT_MIN_DELAY
+        
+        if lost:
+            self._failures += 1
+            for article in lost:
+                self.parent.post_failed(article, 'connection closed while posting')
+        
+        # Give a connection that keeps failing a rest
+        if self._failures >= self.server.get('quarantine_after', 3):
+            quarantine = self.server.get('quarantine_time', 60)
+            self.logger.warning('%d: %d failures in a row, waiting %ds before reconnecting',
+                self.connid, self._failures, quarantine)
+            self._failures = 0
+            self.reconnect_at = time.time() + quarantine
+        
+        # Wake up when it's time to reconnect
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+        self._reconnect_timer = self.loop.call_at(self.reconnect_at, self.reconnect_check)
     
     # There is some data waiting to be read
     def handle_read(self):
@@ -228,6 +403,8 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
         # Do something useful here
         for line in lines:
             self.logger.debug('%d: < Mode:%d %s', self.connid, self.mode, line)
+            if self.mode != MODE_CAPABILITIES or self._caps is None:
+                self.count_response(line)
 
             # Initial login stuff
             if self.mode == MODE_AUTH:
@@ -241,9 +418,7 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
                         self.send(text.encode('utf-8'))
                         self.logger.debug('%d: > AUTHINFO USER ********', self.connid)
                     else:
-                        self.mode = MODE_COMMAND
-                        self.parent._idle.append(self)
-                        self.logger.debug('%d: ready.', self.connid)
+                        self.logged_in()
                 
                 # Need password too
                 elif resp in ('381'):
@@ -256,9 +431,7 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
                 
                 # Auth ok
                 elif resp in ('281'):
-                    self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
-                    self.logger.debug('%d: ready.', self.connid)
+                    self.logged_in()
                 
                 # Auth failure
                 elif resp in ('502'):
@@ -269,54 +442,120 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
                     self.logger.warning('%d: unknown response while MODE_AUTH - "%s"',
                         self.connid, line)
             
+            # Finding out if the server can do streaming
+            elif self.mode == MODE_CAPABILITIES:
+                parts = line.split(None, 1)
+                if not parts:
+                    continue
+                
+                if self._caps is None:
+                    # No CAPABILITIES, see if it understands MODE STREAM anyway
+                    if parts[0] != '101':
+                        self.mode_stream()
+                    else:
+                        self._caps = []
+                
+                # End of the list
+                elif line == '.':
+                    if 'STREAMING' in self._caps:
+                        self.mode_stream()
+                    else:
+                        self.parent.remember_streaming(self.host, self.port, False)
+                        self.ready()
+                
+                else:
+                    self._caps.append(parts[0].upper())
+            
+            elif self.mode == MODE_MODE_STREAM:
+                self._streaming = (line.split(None, 1)[0] == '203')
+                self.parent.remember_streaming(self.host, self.port, self._streaming)
+                self.logger.debug('%d: streaming %s', self.connid,
+                    self._streaming and 'enabled' or 'not supported')
+                self.ready()
+            
+            # Responses to TAKETHIS, these come back in any order
+            elif self.mode == MODE_STREAM:
+                resp = line.split(None, 1)[0]
+                m = MSGID_RE.search(line)
+                article = m and self._inflight.pop(m.group(1), None)
+                # Nothing we sent, a 400/480/502 or the like means something
+                # is wrong with the session. Start again, everything in
+                # flight goes back in the queue.
+                if not article:
+                    self.really_close('unknown response while MODE_STREAM - "%s"' % (line))
+                    return
+                
+                self._ack_wait.observe(time.time() - article.sent_at)
+                if resp == '239':
+                    self.post_ok(article)
+                # Rejected, trying again won't help
+                elif resp == '439':
+                    self.logger.warning('%d: article rejected - %s', self.connid, line)
+                    self.parent.post_failed(article, line, retry=False)
+                else:
+                    self.logger.warning('%d: posting failed - %s', self.connid, line)
+                    if not self.post_failed(article, line):
+                        return
+                
+                # Room for another one
+                if self not in self.parent._idle:
+                    self.parent._idle.append(self)
+            
             # Posting a file
             elif self.mode == MODE_POST_INIT:
                 self.logger.debug('%d: < %s', self.connid, "MODE_POST_INIT")
                 resp = line.split(None, 1)[0]
                 # Posting is allowed
+                self._post_wait.observe(time.time() - self._sent_at)
                 if resp == '340':
                     self.mode = MODE_POST_DATA
                     
-                    # TODO: use the suggested message-ID, will require some rethinking as to how
-                    #       messages are constructed
-                    m = MSGID_RE.search(line)
-                    if m:
-                        self.logger.debug('%d: changing Message-ID to %s', self.connid, m.group(1))
-                        self._article.headers['Message-ID'] = m.group(1)
-
                     # Prepare the article for posting
-                    article_size = self._article.prepare()
-                    self.parent.remember_msgid(article_size, self._article)
+                    self._article.prepare()
 
-                    self.post_data()
+                    for buf in self._article.buffers():
+                        self.send(buf)
                 
                 # Posting is not allowed
                 elif resp == '440':
                     self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
-                    del self._article
                     self.logger.warning('%d: posting not allowed!', self.connid)
+                    if not self.post_failed(self._article, line):
+                        return
+                    self.parent._idle.append(self)
                 
                 # WTF?
                 else:
+                    self.mode = MODE_COMMAND
                     self.logger.warning('%d: unknown response while MODE_POST_INIT - "%s"',
                         self.connid, line)
+                    if not self.post_failed(self._article, line):
+                        return
+                    
+                    # Something is wrong with the session (480 wants auth,
+                    # 502, 400 going away), start again with a new one
+                    if resp[:1] in ('4', '5'):
+                        self.really_close('posting failed - %s' % (line))
+                        return
+                    self.parent._idle.append(self)
             
             # Done posting
             elif self.mode == MODE_POST_DONE:
                 resp = line.split(None, 1)[0]
+                self._ack_wait.observe(time.time() - self._sent_at)
                 # Ok
                 if resp == '240':
-                    #self.parent.post_success(self._article)
-
                     self.mode = MODE_COMMAND
+                    self.post_ok(self._article)
                     self.parent._idle.append(self)
 
                 # Not ok
                 elif resp.startswith('44'):
                     self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
                     self.logger.warning('%d: posting failed - %s', self.connid, line)
+                    if not self.post_failed(self._article, line):
+                        return
+                    self.parent._idle.append(self)
                 
                 # WTF?
                 else:
@@ -329,20 +568,127 @@ class AsyncNNTP(asyncore.dispatcher): #TLSAsyncDispatcherMixIn
                     self.connid, line)
     
     # -----------------------------------------------------------------------
+    # We're logged in, find out if we can stream articles unless we already
+    # know about this server.
+    def logged_in(self):
+        streaming = self.parent.streaming_for(self.server, self.host, self.port)
+        if streaming is None:
+            self.mode = MODE_CAPABILITIES
+            self.send(b'CAPABILITIES\r\n')
+            self.logger.debug('%d: > CAPABILITIES', self.connid)
+        elif streaming:
+            self.mode_stream()
+        else:
+            self.ready()
+    
+    def mode_stream(self):
+        self.mode = MODE_MODE_STREAM
+        self.send(b'MODE STREAM\r\n')
+        self.logger.debug('%d: > MODE STREAM', self.connid)
+    
+    def ready(self):
+        self.state = STATE_CONNECTED
+        if self._streaming:
+            self.mode = MODE_STREAM
+        else:
+            self.mode = MODE_COMMAND
+        self.parent._idle.append(self)
+        self.logger.debug('%d: ready.', self.connid)
+    
+    # Connected and logged in
+    def is_connected(self):
+        return self.state == STATE_CONNECTED
+    
+    # Close the connection for good
+    def shutdown(self):
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
+        if self in self.parent._idle:
+            self.parent._idle.remove(self)
+        
+        if self.state == STATE_CONNECTED and not self._writebufs:
+            try:
+                self.socket.send(b'QUIT\r\n')
+            except socket.error:
+                pass
+        
+        self.close()
+        self.reset()
+        self.parent.connection_closed(self)
+    
+    # Go away once we've finished what we're posting
+    def retire(self):
+        self.retiring = True
+        if self.in_flight() == 0:
+            self.shutdown()
+    
+    # Number of articles we're in the middle of posting
+    def in_flight(self):
+        if self._streaming:
+            return len(self._inflight)
+        elif self.mode in (MODE_POST_INIT, MODE_POST_DATA, MODE_POST_DONE):
+            return 1
+        else:
+            return 0
+    
     # Guess what this does!
     def post_article(self, article):
+        if self._streaming:
+            self.take_this(article)
+            return
+        
         self.mode = MODE_POST_INIT
         self._article = article
+        self._sent_at = time.time()
         self.send('POST\r\n'.encode('utf-8'))
         self.logger.debug('%d: > POST', self.connid)
     
-    def post_data(self):
-        data = self._article.postfile.read(POST_READ_SIZE)
-        if len(data) == 0:
-            self.mode = MODE_POST_DONE
-            self._article.postfile.close()
-            self._article.postfile = None
-        
-        self.send(data)
+    # Send an article without waiting for the server to ask for it. We stay
+    # idle until there are stream_window articles waiting for a response.
+    def take_this(self, article):
+        article.prepare()
+        
+        msgid = article.headers['Message-ID']
+        self._inflight[msgid] = article
+        article.sent_at = time.time()
+        self.send(('TAKETHIS %s\r\n' % (msgid)).encode('utf-8'))
+        for buf in article.buffers():
+            self.send(buf)
+        self.logger.debug('%d: > TAKETHIS %s', self.connid, msgid)
+        
+        if len(self._inflight) < self.server.get('stream_window', 8):
+            self.parent._idle.append(self)
+    
+    # The whole article has been sent, wait for the server to say something
+    def post_done(self):
+        self.mode = MODE_POST_DONE
+        self._sent_at = time.time()
+    
+    def count_response(self, line):
+        code = line[:3]
+        if code.isdigit():
+            self._responses.labels(server=self.pool.name, code=code).inc()
+    
+    def post_ok(self, article):
+        self._failures = 0
+        self.parent.post_success(article)
+        article.release()
+        if article is self._article:
+            self._article = None
+    
+    # Posting an article failed, it goes back in the queue. If this keeps
+    # happening on this connection we close it for a while, returns False
+    # if we did.
+    def post_failed(self, article, reason):
+        if article is self._article:
+            self._article = None
+        self.parent.post_failed(article, reason)
+        
+        self._failures += 1
+        if self._failures >= self.server.get('quarantine_after', 3):
+            self.really_close('too many failed posts')
+            return False
+        return True
 
 # ---------------------------------------------------------------------------
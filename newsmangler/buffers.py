@@ -0,0 +1,148 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Reusable buffers for encoded articles."""
+
+import logging
+import threading
+
+# ---------------------------------------------------------------------------
+
+class ArticleBuffer:
+    """A preallocated bytearray used the way Article used a BytesIO.
+
+    write() copies to the end of what's been written, getbuffer() is a view
+    of it. Encoders that can write in place use reserve() and commit()
+    instead, so the data only gets copied once.
+    """
+    __slots__ = ('buf', 'used')
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.used = 0
+    
+    def write(self, data):
+        n = len(data)
+        end = self.used + n
+        if end > len(self.buf):
+            self.buf.extend(bytes(end - len(self.buf)))
+        self.buf[self.used:end] = data
+        self.used = end
+        return n
+    
+    def tell(self):
+        return self.used
+    
+    def getbuffer(self):
+        return memoryview(self.buf)[:self.used]
+    
+    def getvalue(self):
+        return bytes(self.buf[:self.used])
+    
+    # A writable view of at least `size` bytes after what's been written.
+    # commit() says how much of it was used.
+    def reserve(self, size):
+        if self.used + size > len(self.buf):
+            self.buf.extend(bytes(self.used + size - len(self.buf)))
+        return memoryview(self.buf)[self.used:]
+    
+    def commit(self, n):
+        self.used += n
+
+class BufferPool:
+    """Up to `count` buffers of `size` bytes, big enough for any encoded
+    article body, handed out by get() and given back by put() once the
+    article is posted. They're only allocated when they're first needed.
+
+    Asking for one when they're all out allocates a new one (a miss) that
+    is thrown away when it comes back if the pool is full. The encoder
+    pipeline doesn't start on an article unless there's a free buffer for
+    it, so the pool size also limits how far ahead of the connections we
+    get. A buffer that comes back with views of it still around (a
+    connection closed halfway through sending it) isn't reused, someone
+    might still read from it.
+    """
+    def __init__(self, count, size):
+        self.logger = logging.getLogger('buffers')
+        
+        self.count = max(1, count)
+        self.size = size
+        self._lock = threading.Lock()
+        self._free = []
+        self._made = 0
+        self._out = 0
+        
+        # on_free (if set) gets called when a buffer is put back
+        self.on_free = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        
+        self.logger.debug('Up to %d article buffer(s) of %d bytes', self.count, size)
+    
+    # Number of buffers that are free to be handed out
+    def available(self):
+        return max(0, self.count - self._out)
+    
+    def get(self):
+        with self._lock:
+            self._out += 1
+            if self._free:
+                self.hits += 1
+                return ArticleBuffer(self._free.pop())
+            if self._made < self.count:
+                self._made += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+        return ArticleBuffer(bytearray(self.size))
+    
+    def put(self, articlebuf):
+        buf = articlebuf.buf
+        articlebuf.buf = bytearray()
+        articlebuf.used = 0
+        
+        # Resizing fails while anything has a view of it
+        try:
+            buf.append(0)
+            buf.pop()
+            in_use = False
+        except BufferError:
+            in_use = True
+        
+        with self._lock:
+            self._out -= 1
+            if in_use:
+                self.discarded += 1
+            elif len(self._free) < self.count:
+                if len(buf) != self.size:
+                    del buf[self.size:]
+                self._free.append(buf)
+        
+        if self.on_free is not None:
+            self.on_free()
@@ -0,0 +1,194 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Whole-file CRC32s and hashes, built up from the parts as they're posted."""
+
+import functools
+import hashlib
+import os
+import threading
+
+# Checksum files we know how to write, and the hash each one needs. SFV
+# only needs the CRC32 we get from the encoder.
+CHECKSUM_FILES = {
+    'sfv': None,
+    'md5': 'md5',
+    'sha1': 'sha1',
+    'sha256': 'sha256',
+}
+
+# The (reflected) CRC-32 polynomial
+CRC32_POLY = 0xedb88320
+
+# ---------------------------------------------------------------------------
+# Multiply two polynomials modulo the CRC polynomial, reflected like the CRC
+def _multmodp(a, b):
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+    return p
+
+# x^(2^n) modulo the CRC polynomial, for n = 0..31
+def _x2n_table():
+    table = []
+    p = 1 << 30
+    for n in range(32):
+        table.append(p)
+        p = _multmodp(p, p)
+    return table
+
+_X2N = _x2n_table()
+
+# x^(8 * length) modulo the CRC polynomial, what appending `length` bytes
+# does to a CRC. Nearly every part is article_size long, so this is cached.
+@functools.lru_cache(maxsize=64)
+def _shift(length):
+    p = 1 << 31
+    k = 3
+    while length:
+        if length & 1:
+            p = _multmodp(_X2N[k & 31], p)
+        length >>= 1
+        k += 1
+    return p
+
+# CRC32 of A followed by B, from the CRC32s of A and B and the length of B.
+# The same thing zlib's crc32_combine() does, which Python doesn't give us.
+def crc32_combine(crc1, crc2, length2):
+    return _multmodp(_shift(length2), crc1) ^ crc2
+
+# ---------------------------------------------------------------------------
+
+class FileChecksum:
+    """The CRC32 and hashes of one file, without reading it again.
+
+    add_crc() is given the CRC32 the encoder worked out for each part,
+    feed() (if there are hashes to do) the data FileWrap read for it. Parts
+    can turn up in any order, from any thread, and more than once when
+    they're retried. Parts that turn up early wait for the ones before them,
+    the hashes keep a copy of their data until then.
+
+    Copies sent to encoder processes start out empty and are thrown away,
+    the real one gets told about those parts when they come back.
+    """
+    def __init__(self, filename, filesize, hashes=()):
+        self.filename = filename
+        self.filesize = filesize
+        self.hashes = tuple(hashes)
+        
+        self._lock = threading.Lock()
+        
+        # CRC32 of everything up to _crc_done, and the parts past that
+        self._crc = 0
+        self._crc_done = 0
+        self._crcs = {}
+        
+        # Same again for the hashes
+        self._hashers = [hashlib.new(name) for name in self.hashes]
+        self._hash_done = 0
+        self._early = {}
+    
+    def __reduce__(self):
+        return (FileChecksum, (self.filename, self.filesize))
+    
+    # -----------------------------------------------------------------------
+    # The part starting at `begin` is `length` bytes long with a CRC32 of `crc`
+    def add_crc(self, begin, length, crc):
+        with self._lock:
+            if begin < self._crc_done or begin in self._crcs:
+                return
+            self._crcs[begin] = (crc, length)
+            
+            while self._crc_done in self._crcs:
+                crc, length = self._crcs.pop(self._crc_done)
+                self._crc = crc32_combine(self._crc, crc, length)
+                self._crc_done += length
+    
+    # The part starting at `begin` was read, a FileWrap watcher
+    def feed(self, begin, data):
+        if not self._hashers:
+            return
+        
+        with self._lock:
+            if begin < self._hash_done or begin in self._early:
+                return
+            # Too early, it might be a view of something that's going away
+            if begin != self._hash_done:
+                self._early[begin] = bytes(data)
+                return
+            
+            while data is not None:
+                for hasher in self._hashers:
+                    hasher.update(data)
+                self._hash_done += len(data)
+                data = self._early.pop(self._hash_done, None)
+    
+    # -----------------------------------------------------------------------
+    # The CRC32 of the whole file as 8 hex digits, None until we have it
+    def crc32(self):
+        if self._crc_done < self.filesize:
+            return None
+        return '%08x' % (self._crc)
+    
+    # The hex digest of one of our hashes, None until we have it
+    def hexdigest(self, name):
+        if self._hash_done < self.filesize or name not in self.hashes:
+            return None
+        return self._hashers[self.hashes.index(name)].hexdigest()
+
+# ---------------------------------------------------------------------------
+# Write a checksum file for some FileChecksums, `kind` is one of
+# CHECKSUM_FILES. Files we don't have a checksum for are left out, returns
+# how many were written.
+def write_checksum_file(path, kind, checksums, comment=None):
+    lines = []
+    if comment and kind == 'sfv':
+        lines.append('; %s\n' % (comment))
+    
+    written = 0
+    for checksum in sorted(checksums, key=lambda c: c.filename):
+        if kind == 'sfv':
+            value = checksum.crc32()
+            line = '%s %s\n' % (checksum.filename, value and value.upper())
+        else:
+            value = checksum.hexdigest(CHECKSUM_FILES[kind])
+            line = '%s *%s\n' % (value, checksum.filename)
+        if value is not None:
+            lines.append(line)
+            written += 1
+    
+    if written:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(''.join(lines))
+        os.replace(path + '.tmp', path)
+    return written
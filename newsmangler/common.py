@@ -29,8 +29,11 @@
 
 NM_VERSION = '0.1.3git'
 
+import base64
+import itertools
 import os
 import logging
+import re
 
 try:
 	#Python version <3.x
@@ -87,6 +90,39 @@ def safeFilename(filename):
 		safe_filename = safe_filename.replace(char, '_')
 	return safe_filename
 
+# ---------------------------------------------------------------------------
+# Hands out Message-IDs that won't collide with each other, or with those from
+# any other run. Each run gets a random prefix and every ID a number after it.
+class MessageIDs:
+	def __init__(self, domain):
+		self.domain = domain
+		self.prefix = base64.b32encode(os.urandom(10)).decode('ascii').lower()
+		self._counter = itertools.count(1)
+	
+	# Number for the next Message-ID, format() turns it into the real thing
+	def allocate(self):
+		return next(self._counter)
+	
+	def format(self, number):
+		return '<%s.%d@%s>' % (self.prefix, number, self.domain)
+
+# ---------------------------------------------------------------------------
+# Turn a rate like 800K, 50MB/s or 400Mbit into bytes per second. Plain
+# numbers are KB/s, 0 means no limit. B and /s are optional, bit, bits and
+# bps mean bits.
+RATE_RE = re.compile(r'^([\d.]+)\s*([KMG]?)(BITS?|BPS|B)?(?:/S)?$')
+RATE_UNITS = {'': 1024, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+def parseRate(value):
+	m = RATE_RE.match(str(value).strip().upper())
+	if not m:
+		raise ValueError('invalid rate "%s"' % (value))
+	
+	number, unit, bits = m.groups()
+	if bits and bits != 'B':
+		# Network people count in powers of 10
+		return int(float(number) * 1000 ** ' KMG'.index(unit or ' ') / 8)
+	return int(float(number) * RATE_UNITS[unit])
+
 # ---------------------------------------------------------------------------
 # Return a nicely formatted size
 MB = 1024.0 ** 2
@@ -0,0 +1,182 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Encode articles ahead of the connections on a worker pool."""
+
+import collections
+import logging
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from newsmangler import yenc
+
+# ---------------------------------------------------------------------------
+# Runs in a worker process. The article gets pickled over, prepared, and we
+# send back the finished pieces, how long they took and the part CRC32.
+def _prepare_in_process(article):
+    article.prepare()
+    return [bytes(buf) for buf in article.buffers()] + [article.encode_time, article._partcrc]
+
+# ---------------------------------------------------------------------------
+
+class EncodePipeline:
+    """Keeps up to `depth` articles being prepared or ready to post.
+
+    Articles are taken from `source` (an ArticlePlanner) and handed to a
+    thread or process pool. Finished articles come out of get() in the same
+    order they went in. `call_soon_threadsafe` is used to get completion
+    notices back into the posting loop, `on_ready` (if set) is called there
+    whenever an article finishes. Articles that couldn't be prepared are
+    passed to `on_failed` (if set) with the reason, instead of coming out of
+    get().
+    
+    With a BufferPool in `buffers`, articles get their buffer before they
+    go to a worker and we don't start on any more while none are free.
+    """
+    def __init__(self, source, workers, depth, use_processes, call_soon_threadsafe, buffers=None):
+        self.logger = logging.getLogger('encoder')
+        
+        self._source = source
+        self._depth = max(1, depth)
+        self._use_processes = use_processes
+        self._call_soon_threadsafe = call_soon_threadsafe
+        self._buffers = buffers
+        self.on_ready = None
+        self.on_failed = None
+        
+        if use_processes:
+            # Workers that don't fork would start out with the default encoder
+            self._pool = ProcessPoolExecutor(max_workers=workers,
+                initializer=yenc.useEncoder, initargs=(yenc.yEncMode(),))
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+        self.logger.debug('Encoding with %d %s worker(s), queue depth %d',
+            workers, 'process' if use_processes else 'thread', self._depth)
+        
+        self._queue = collections.deque()
+        self._done = 0
+        
+        # Stall accounting: how long connections sat waiting for the encoder,
+        # and how long the encoder sat waiting for connections.
+        self.encoder_stall = 0.0
+        self.network_stall = 0.0
+        self._starved_since = None
+        self._full_since = None
+    
+    # Number of articles being encoded or waiting to be posted
+    def pending(self):
+        return len(self._queue)
+    
+    # Is there room to start encoding another article?
+    def _has_room(self):
+        return len(self._queue) < self._depth and (self._buffers is None or self._buffers.available() > 0)
+    
+    # Start encoding articles until we hit our queue depth or run out of
+    # buffers
+    def fill(self):
+        while self._has_room():
+            article = self._source.next_article()
+            if article is None:
+                break
+            if self._use_processes:
+                future = self._pool.submit(_prepare_in_process, article)
+            else:
+                article.take_buffer()
+                future = self._pool.submit(article.prepare)
+            future.add_done_callback(self._future_done)
+            self._queue.append((article, future))
+    
+    # Called from a worker thread, bounce over to the posting loop
+    def _future_done(self, future):
+        self._call_soon_threadsafe(self._completed)
+    
+    def _completed(self):
+        self._done += 1
+        
+        # Everything in the queue is done and we can't start any more, the
+        # encoder is waiting on the network now.
+        if self._full_since is None and not self._has_room() and \
+                all(future.done() for article, future in self._queue):
+            self._full_since = time.time()
+        
+        if self.on_ready is not None:
+            self.on_ready()
+    
+    # Number of articles that are encoded and waiting to be posted
+    def ready_count(self):
+        return sum(1 for article, future in self._queue if future.done())
+    
+    # Is the next article finished?
+    def ready(self):
+        return bool(self._queue) and self._queue[0][1].done()
+    
+    # Return the next finished article, or None if it's not ready yet
+    def get(self):
+        now = time.time()
+        
+        while self._queue and self._queue[0][1].done():
+            article, future = self._queue.popleft()
+            
+            if self._full_since is not None:
+                self.network_stall += now - self._full_since
+                self._full_since = None
+            
+            try:
+                result = future.result()
+            except Exception as exc:
+                self.logger.exception('Failed to prepare article: %s', article.headers['Subject'])
+                article.release()
+                if self.on_failed is not None:
+                    self.on_failed(article, 'unable to prepare article: %s' % (exc))
+                continue
+            
+            if self._use_processes:
+                article.set_prepared(*result)
+            
+            if self._starved_since is not None:
+                self.encoder_stall += now - self._starved_since
+                self._starved_since = None
+            
+            self.fill()
+            return article
+        
+        # Someone wanted an article and we didn't have one
+        if self._starved_since is None and (self._queue or self._source.has_more()):
+            self._starved_since = now
+        
+        self.fill()
+        return None
+    
+    # A buffer went back to the pool, we might be able to start another
+    def buffer_freed(self):
+        self.fill()
+    
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,201 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""A small selectors based event loop with a timer heap."""
+
+import collections
+import heapq
+import logging
+import selectors
+import socket
+import threading
+import time
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+# ---------------------------------------------------------------------------
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# ---------------------------------------------------------------------------
+# A socketpair that other threads can poke to wake up a blocked select()
+
+class Waker:
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+    def wake(self):
+        try:
+            self.wsock.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # Buffer is full, a wakeup is already pending
+            pass
+
+    def handle_read_event(self):
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def handle_write_event(self):
+        pass
+
+    def handle_error(self):
+        pass
+
+    def close(self):
+        self.rsock.close()
+        self.wsock.close()
+
+# ---------------------------------------------------------------------------
+
+class EventLoop:
+    def __init__(self):
+        self.logger = logging.getLogger('eventLoop')
+
+        # DefaultSelector picks the best thing this platform has: epoll,
+        # kqueue, devpoll, poll, and finally plain old select on Windows.
+        self.selector = selectors.DefaultSelector()
+        self.logger.debug('Using %s for sockets', self.selector.__class__.__name__)
+
+        self._timers = []
+        self._seq = 0
+
+        # Callbacks from other threads and the socket used to wake us up
+        self._pending = collections.deque()
+        self._pending_lock = threading.Lock()
+        self._waker = Waker()
+        self.register(self._waker.fileno(), EVENT_READ, self._waker)
+
+    # -----------------------------------------------------------------------
+    # Socket registration. obj is an asyncore style dispatcher, it gets
+    # handle_read_event()/handle_write_event()/handle_error() called on it.
+    def register(self, fd, events, obj):
+        self.selector.register(fd, events, obj)
+
+    def modify(self, fd, events, obj):
+        self.selector.modify(fd, events, obj)
+
+    def unregister(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    # -----------------------------------------------------------------------
+    # Timers
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        self._seq += 1
+        heapq.heappush(self._timers, (when, self._seq, timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    # Work out how long we can block for before the next timer is due
+    def _next_timeout(self, timeout):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+
+        if self._timers:
+            due = max(0, self._timers[0][0] - time.time())
+            if timeout is None or due < timeout:
+                timeout = due
+
+        return timeout
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    # Run callback(*args) in the loop thread as soon as possible. This is the
+    # only method that is safe to call from another thread.
+    def call_soon_threadsafe(self, callback, *args):
+        with self._pending_lock:
+            self._pending.append((callback, args))
+        self._waker.wake()
+
+    def _run_pending(self):
+        while self._pending:
+            with self._pending_lock:
+                callback, args = self._pending.popleft()
+            callback(*args)
+
+    # -----------------------------------------------------------------------
+    # Wait for something to happen, either a socket event or a timer being
+    # due, and deal with it.
+    def run_once(self, timeout=None):
+        timeout = self._next_timeout(timeout)
+        if self._pending:
+            timeout = 0
+
+        # Our waker is always registered, so there is always something to
+        # select() on.
+        fdmap = self.selector.get_map()
+        events = self.selector.select(timeout)
+
+        for key, mask in events:
+            obj = key.data
+            try:
+                if mask & EVENT_READ:
+                    obj.handle_read_event()
+                # The read handler might have closed the connection
+                if mask & EVENT_WRITE and fdmap.get(key.fd) is key:
+                    obj.handle_write_event()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                obj.handle_error()
+
+        self._run_pending()
+        self._run_timers()
+
+    def close(self):
+        self.unregister(self._waker.fileno())
+        self._waker.close()
+        self.selector.close()
@@ -0,0 +1,344 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""A stand-in NNTP server for tests and benchmarks.
+
+It speaks just enough NNTP for us to post to it: AUTHINFO, POST, CAPABILITIES,
+MODE STREAM, CHECK and TAKETHIS, and STAT for the articles it has kept. Every article gets its yEnc data decoded and
+checked against the sizes and CRC in the =y lines. Faults can be injected to
+see how we cope with bad servers: response latency, a bandwidth cap, dropped
+connections, 441s and 502s, and slow acknowledgements.
+"""
+
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+
+from newsmangler.yenc import YencError, yDecodeArticle
+
+# ---------------------------------------------------------------------------
+
+RECV_SIZE = 262144
+
+MSGID_RE = re.compile(rb'^Message-ID:\s*(<\S+>)', re.I | re.M)
+
+# Everything we can be told to do, and what we do if we aren't
+DEFAULTS = {
+    'username': '',
+    'password': '',
+    # Offer streaming in CAPABILITIES and accept MODE STREAM
+    'streaming': True,
+    # Seconds to wait before every response
+    'latency': 0.0,
+    # Extra seconds before accepting an article
+    'slow_ack': 0.0,
+    # Most bytes per second each connection can send us, 0 for no cap
+    'bandwidth': 0,
+    # Chance of dropping the connection in the middle of an article
+    'drop_rate': 0.0,
+    # Chance of failing an article: 441 for POST, 431 for TAKETHIS
+    'fail_rate': 0.0,
+    # Connections past this many get a 502, 0 for no limit
+    'max_connections': 0,
+    # Answer every Nth POST or TAKETHIS with a 480 (no Message-ID) as if the
+    # session had gone bad, 0 for never
+    'error_every': 0,
+    # Keep the Message-IDs of accepted articles
+    'keep_msgids': True,
+}
+
+# ---------------------------------------------------------------------------
+# Check an article is good yEnc, returns None if it is or what's wrong
+def check_article(article):
+    head, sep, body = article.partition(b'\r\n\r\n')
+    if not sep:
+        return 'no body'
+    
+    try:
+        headers, data = yDecodeArticle(body)
+    except YencError as msg:
+        return str(msg)
+    if 'pcrc32' not in headers['yend']:
+        return 'no =yend pcrc32'
+    return None
+
+# ---------------------------------------------------------------------------
+
+class Stats:
+    """What happened, across every connection. Everything is updated with
+    the lock held."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.connections = 0
+        self.refused = 0
+        self.dropped = 0
+        self.accepted = 0
+        self.failed = 0
+        self.session_errors = 0
+        self.bad = 0
+        self.bytes = 0
+        self.first_byte_at = None
+        self.last_accepted_at = None
+        self.msgids = set()
+        self.errors = []
+    
+    def as_dict(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'refused': self.refused,
+                'dropped': self.dropped,
+                'accepted': self.accepted,
+                'failed': self.failed,
+                'session_errors': self.session_errors,
+                'bad': self.bad,
+                'bytes': self.bytes,
+                'first_byte_at': self.first_byte_at,
+                'last_accepted_at': self.last_accepted_at,
+            }
+
+# ---------------------------------------------------------------------------
+
+class Dropped(Exception):
+    pass
+
+class FakeNNTPHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.conf = self.server.conf
+        self.stats = self.server.stats
+        self._buf = b''
+        self._user = None
+        self._streaming = False
+    
+    # -----------------------------------------------------------------------
+    def recv_more(self):
+        data = self.request.recv(RECV_SIZE)
+        if not data:
+            raise Dropped()
+        
+        # Pretend we're on the other end of a slow link
+        if self.conf['bandwidth']:
+            time.sleep(len(data) / float(self.conf['bandwidth']))
+        self._buf += data
+    
+    def readline(self):
+        while True:
+            i = self._buf.find(b'\r\n')
+            if i >= 0:
+                line, self._buf = self._buf[:i], self._buf[i + 2:]
+                return line.decode('utf-8', 'replace')
+            self.recv_more()
+    
+    # Read an article up to the terminating dot
+    def read_article(self):
+        with self.stats.lock:
+            if self.stats.first_byte_at is None:
+                self.stats.first_byte_at = time.time()
+        
+        # Now and then the connection goes away mid-article
+        drop = self.conf['drop_rate'] and random.random() < self.conf['drop_rate']
+        
+        start = 0
+        while True:
+            if self._buf.startswith(b'.\r\n'):
+                article, self._buf = b'', self._buf[3:]
+                break
+            i = self._buf.find(b'\r\n.\r\n', start)
+            if i >= 0:
+                article, self._buf = self._buf[:i + 2], self._buf[i + 5:]
+                break
+            start = max(0, len(self._buf) - 4)
+            
+            if drop:
+                with self.stats.lock:
+                    self.stats.dropped += 1
+                raise Dropped()
+            self.recv_more()
+        
+        with self.stats.lock:
+            self.stats.bytes += len(article) + 3
+        return article
+    
+    def respond(self, text):
+        if self.conf['latency']:
+            time.sleep(self.conf['latency'])
+        self.request.sendall(('%s\r\n' % (text)).encode('utf-8'))
+    
+    # -----------------------------------------------------------------------
+    def handle(self):
+        with self.stats.lock:
+            self.stats.connections += 1
+            self.server.active += 1
+            refuse = self.conf['max_connections'] and self.server.active > self.conf['max_connections']
+            if refuse:
+                self.stats.refused += 1
+        
+        try:
+            if refuse:
+                self.respond('502 too many connections')
+                return
+            self.respond('200 fake NNTP server ready, posting ok')
+            
+            while True:
+                line = self.readline()
+                if not self.command(line):
+                    return
+        except (Dropped, OSError):
+            pass
+        finally:
+            with self.stats.lock:
+                self.server.active -= 1
+    
+    # Deal with a command, returns False once we should hang up
+    def command(self, line):
+        words = line.split()
+        cmd = words[0].upper() if words else ''
+        
+        if cmd == 'AUTHINFO' and len(words) == 3 and words[1].upper() == 'USER':
+            self._user = words[2]
+            self.respond('381 password please')
+        elif cmd == 'AUTHINFO' and len(words) == 3 and words[1].upper() == 'PASS':
+            if self._user == self.conf['username'] and words[2] == self.conf['password']:
+                self.respond('281 ok')
+            else:
+                self.respond('481 authentication failed')
+        elif cmd == 'CAPABILITIES':
+            caps = ['VERSION 2', 'POST']
+            if self.conf['streaming']:
+                caps.append('STREAMING')
+            self.respond('101 capability list follows\r\n%s\r\n.' % ('\r\n'.join(caps)))
+        elif cmd == 'MODE' and len(words) == 2 and words[1].upper() == 'STREAM' and self.conf['streaming']:
+            self._streaming = True
+            self.respond('203 streaming permitted')
+        elif cmd == 'POST':
+            if self.session_error():
+                return True
+            self.respond('340 send article')
+            code, text = self.take(self.read_article(), '240', '441')
+            self.respond('%s %s' % (code, text))
+        elif cmd == 'TAKETHIS' and len(words) == 2 and self._streaming:
+            article = self.read_article()
+            if self.session_error():
+                return True
+            code, text = self.take(article, '239', '439', '431')
+            self.respond('%s %s %s' % (code, words[1], text))
+        elif cmd == 'CHECK' and len(words) == 2 and self._streaming:
+            self.respond('238 %s send it' % (words[1]))
+        elif cmd == 'STAT' and len(words) == 2:
+            with self.stats.lock:
+                found = words[1] in self.stats.msgids
+            if found:
+                self.respond('223 0 %s' % (words[1]))
+            else:
+                self.respond('430 no such article')
+        elif cmd == 'QUIT':
+            self.respond('205 bye')
+            return False
+        else:
+            self.respond('500 what?')
+        return True
+    
+    # Every error_every articles, say something's wrong with the session
+    # instead. Returns True if we did.
+    def session_error(self):
+        if not self.conf['error_every']:
+            return False
+        with self.stats.lock:
+            self.server.articles += 1
+            if self.server.articles % self.conf['error_every']:
+                return False
+            self.stats.session_errors += 1
+        self.respond('480 authentication required')
+        return True
+    
+    # Check an article and decide what to tell the poster. Returns
+    # (code, text).
+    def take(self, article, ok, bad, failed=None):
+        if self.conf['fail_rate'] and random.random() < self.conf['fail_rate']:
+            with self.stats.lock:
+                self.stats.failed += 1
+            return (failed or bad), 'posting failed'
+        
+        error = check_article(article)
+        if error is not None:
+            with self.stats.lock:
+                self.stats.bad += 1
+                self.stats.errors.append(error)
+            return bad, error
+        
+        if self.conf['slow_ack']:
+            time.sleep(self.conf['slow_ack'])
+        
+        m = MSGID_RE.search(article.partition(b'\r\n\r\n')[0])
+        with self.stats.lock:
+            self.stats.accepted += 1
+            self.stats.last_accepted_at = time.time()
+            if m and self.conf['keep_msgids']:
+                self.stats.msgids.add(m.group(1).decode('utf-8', 'replace'))
+        return ok, 'article received'
+
+# ---------------------------------------------------------------------------
+
+class FakeNNTPServer(socketserver.ThreadingTCPServer):
+    """Listens on the loopback interface, a thread per connection. port 0
+    picks a free one, self.port is the one we got. Faults can be changed
+    in self.conf at any time."""
+    allow_reuse_address = True
+    daemon_threads = True
+    
+    def __init__(self, port=0, **conf):
+        self.conf = dict(DEFAULTS)
+        for key, value in conf.items():
+            if key not in DEFAULTS:
+                raise TypeError('unknown option "%s"' % (key))
+            self.conf[key] = value
+        
+        self.stats = Stats()
+        self.active = 0
+        self.articles = 0
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), FakeNNTPHandler)
+        self.port = self.server_address[1]
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fakenntp')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# ---------------------------------------------------------------------------
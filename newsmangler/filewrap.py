@@ -27,41 +27,337 @@
 
 """Simple file wrapper to handle opening and closing on demand."""
 
+import collections
 import logging
+import mmap
+import os
+import queue
+import threading
+
+# Ways of reading parts from files:
+#   read      - pread() into a new bytes object
+#   mmap      - map the file and hand out slices of it, nothing is copied
+#   preadv    - preadv() into a buffer that gets reused for every part
+#   readahead - like read, but a thread pulls the next parts into the page
+#               cache while the current one is being encoded
+BACKENDS = ('read', 'mmap', 'preadv', 'readahead')
+
+# How many parts ahead of the current one the readahead thread reads, and in
+# what size chunks.
+READAHEAD_PARTS = 2
+READAHEAD_CHUNK = 1024 * 1024
+
+HAVE_PREAD = hasattr(os, 'pread')
+HAVE_PREADV = hasattr(os, 'preadv')
+HAVE_FADVISE = hasattr(os, 'posix_fadvise')
+HAVE_MADVISE = hasattr(mmap.mmap, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL')
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+# ---------------------------------------------------------------------------
+
+class OpenFile:
+	__slots__ = ('fd', 'map', 'users', 'done', 'lock')
+	
+	def __init__(self, fd):
+		self.fd = fd
+		self.map = None
+		self.users = 0
+		self.done = False
+		# Only used for seek + read when we don't have pread()
+		self.lock = threading.Lock()
+	
+	def close(self):
+		if self.map is not None:
+			try:
+				self.map.close()
+			except BufferError:
+				# Someone is still encoding a slice of it, the map goes away
+				# when they're done with it.
+				pass
+			self.map = None
+		os.close(self.fd)
+
+# Pools sent over to worker processes, so each process only ends up with one
+# for each setting.
+_process_pools = {}
+
+def _process_pool(max_open, backend):
+	pool = _process_pools.get((max_open, backend))
+	if pool is None:
+		pool = _process_pools[(max_open, backend)] = FilePool(max_open, backend)
+	return pool
+
+class FilePool:
+	"""Open files shared between FileWraps, at most max_open at a time.
+
+	The least recently used file is closed when we need room for another one,
+	but never while it's being read from.
+	"""
+	def __init__(self, max_open=64, backend='read'):
+		self.logger = logging.getLogger('fileWrapper')
+		
+		if backend not in BACKENDS:
+			self.logger.warning('Unknown read backend "%s", using "read"', backend)
+			backend = 'read'
+		elif backend == 'preadv' and not HAVE_PREADV:
+			self.logger.warning('preadv() is not available here, using "read"')
+			backend = 'read'
+		
+		self.max_open = max(1, max_open)
+		self.backend = backend
+		
+		self._lock = threading.Lock()
+		self._open = collections.OrderedDict()
+		self._scratch = threading.local()
+		
+		self._readahead = None
+		if backend == 'readahead':
+			self._readahead = ReadAhead(self)
+	
+	# Locks, threads and file descriptors can't be pickled, worker processes
+	# get a pool of their own.
+	def __reduce__(self):
+		return (_process_pool, (self.max_open, self.backend))
+	
+	# -----------------------------------------------------------------------
+	def acquire(self, path):
+		with self._lock:
+			f = self._open.get(path)
+			if f is None:
+				f = self._open[path] = self._open_file(path)
+				self._trim()
+			else:
+				self._open.move_to_end(path)
+			f.users += 1
+		return f
+	
+	def release(self, path, f):
+		with self._lock:
+			f.users -= 1
+			if f.users == 0 and f.done and self._open.get(path) is f:
+				del self._open[path]
+				f.close()
+			else:
+				self._trim()
+	
+	# We've read everything we want from this file, close it once nobody is
+	# using it.
+	def forget(self, path):
+		with self._lock:
+			f = self._open.get(path)
+			if f is None:
+				return
+			if f.users == 0:
+				del self._open[path]
+				f.close()
+			else:
+				f.done = True
+	
+	def close(self):
+		with self._lock:
+			for f in self._open.values():
+				f.close()
+			self._open.clear()
+	
+	def _open_file(self, path):
+		self.logger.debug('%s open file', path)
+		fd = os.open(path, os.O_RDONLY | O_BINARY)
+		f = OpenFile(fd)
+		
+		try:
+			if self.backend == 'mmap':
+				# Empty files can't be mapped, but they have no parts either
+				if os.fstat(fd).st_size > 0:
+					f.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+					if HAVE_MADVISE:
+						f.map.madvise(mmap.MADV_SEQUENTIAL)
+			elif HAVE_FADVISE:
+				os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		except:
+			os.close(fd)
+			raise
+		
+		return f
+	
+	# Close files we don't need until we're back under the limit. Files that
+	# are being read from stay open, so we can go over it for a bit.
+	def _trim(self):
+		if len(self._open) <= self.max_open:
+			return
+		for path, f in list(self._open.items()):
+			if f.users == 0:
+				self.logger.debug('%s close file', path)
+				del self._open[path]
+				f.close()
+				if len(self._open) <= self.max_open:
+					break
+	
+	# -----------------------------------------------------------------------
+	# Read end - begin bytes. What you get back depends on the backend: bytes,
+	# or a memoryview for mmap/preadv. preadv views are only good until the
+	# next read from the same thread.
+	def read(self, path, begin, end, more=False):
+		f = self.acquire(path)
+		try:
+			if f.map is not None:
+				return memoryview(f.map)[begin:end]
+			
+			elif self.backend == 'preadv':
+				buf = getattr(self._scratch, 'buf', None)
+				if buf is None or len(buf) < end - begin:
+					buf = self._scratch.buf = bytearray(end - begin)
+				n = os.preadv(f.fd, [memoryview(buf)[:end - begin]], begin)
+				return memoryview(buf)[:n]
+			
+			else:
+				data = self.pread(f, end - begin, begin)
+				if more and self._readahead is not None:
+					self._readahead.hint(path, end, end + (end - begin) * READAHEAD_PARTS)
+				return data
+		finally:
+			self.release(path, f)
+	
+	def pread(self, f, size, offset):
+		if HAVE_PREAD:
+			return os.pread(f.fd, size, offset)
+		
+		with f.lock:
+			os.lseek(f.fd, offset, os.SEEK_SET)
+			return os.read(f.fd, size)
+
+# ---------------------------------------------------------------------------
+
+class ReadAhead(threading.Thread):
+	"""Pulls the next bit of a file into the page cache while the current
+	part is being encoded. posix_fadvise() alone doesn't do much on NFS, so we
+	actually read the data too."""
+	def __init__(self, pool):
+		threading.Thread.__init__(self, name='readahead', daemon=True)
+		
+		self._pool = pool
+		self._queue = queue.Queue(maxsize=16)
+		# How far ahead of things we've read in each file
+		self._ahead = {}
+		
+		self.start()
+	
+	def hint(self, path, begin, end):
+		try:
+			self._queue.put_nowait((path, begin, end))
+		except queue.Full:
+			pass
+	
+	def run(self):
+		while True:
+			path, begin, end = self._queue.get()
+			begin = max(begin, self._ahead.get(path, 0))
+			if begin >= end:
+				continue
+			
+			try:
+				f = self._pool.acquire(path)
+			except OSError:
+				continue
+			
+			try:
+				if HAVE_FADVISE:
+					os.posix_fadvise(f.fd, begin, end - begin, os.POSIX_FADV_WILLNEED)
+				
+				offset = begin
+				while offset < end:
+					data = self._pool.pread(f, min(READAHEAD_CHUNK, end - offset), offset)
+					if not data:
+						break
+					offset += len(data)
+				self._ahead[path] = offset
+			
+			except OSError:
+				pass
+			
+			finally:
+				self._pool.release(path, f)
+
+# ---------------------------------------------------------------------------
+
+# Used by FileWraps that weren't given a pool of their own
+_default_pool = None
+
+def default_pool():
+	global _default_pool
+	if _default_pool is None:
+		_default_pool = FilePool()
+	return _default_pool
+
+# A watcher that passes everything on to two others, either can be None
+def chain_watchers(first, second):
+	if first is None:
+		return second
+	if second is None:
+		return first
+	def watcher(begin, data):
+		first(begin, data)
+		second(begin, data)
+	return watcher
 
 class FileWrap:
-	def __init__(self, filepath, parts):
+	def __init__(self, filepath, parts, pool=None, watcher=None):
 		self._filepath = filepath
 		self._parts = parts
+		# watcher(begin, data) gets to see everything we read
+		self.watcher = watcher
 		
-		self._file = None
+		self._pool = pool or default_pool()
+		# Copies sent to encoder processes leave closing the file to us
+		self._owner = True
+		self._lock = threading.Lock()
 
 		self.logger = logging.getLogger('fileWrapper')
 		
 	def __del__(self):
 		self._closeFile()
 
+	# Locks can't be pickled, leave them behind when being sent to an encoder
+	# process. The watcher stays here too, see replay_read().
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_lock']
+		state['watcher'] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._owner = False
+		self._lock = threading.Lock()
+
 	def _closeFile(self):
-		if self._file:
-			self.logger.debug('%s read_part close file', self._filepath)
-			self._file.close()
+		if self._owner and self._parts > 0:
+			self._pool.forget(self._filepath)
 		
 	def read_part(self, begin, end):
 		self.logger.debug('%s read_part %d %d', self._filepath, begin, end)
 
-		# Open the file if it's not already open
-		if self._file is None:
-			self.logger.debug('%s read_part open file', self._filepath)
-			self._file = open(self._filepath, 'rb')
+		with self._lock:
+			self._parts -= 1
+			last = (self._parts == 0)
+
+		data = self._pool.read(self._filepath, begin, end, more=not last)
 
-		# Seek to the right position and read the data
-		self._file.seek(begin, 0)
-		data = self._file.read(end - begin)
+		if self.watcher is not None:
+			self.watcher(begin, data)
 
 		# If this was the last part we should close the file
-		self._parts -= 1
-		if self._parts == 0:
-			self._closeFile()
+		if last and self._owner:
+			self._pool.forget(self._filepath)
 
 		# Return the data
 		return data
+
+	# A part was read by an encoder process, which can't tell the watcher
+	# about it. Read it again here, it should still be in the page cache.
+	def replay_read(self, begin, end):
+		if self.watcher is None:
+			return
+		self.watcher(begin, self._pool.read(self._filepath, begin, end))
+		if self._parts <= 0:
+			self._pool.forget(self._filepath)
@@ -0,0 +1,176 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""An append-only journal of posted parts, so an interrupted post can be
+resumed."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# How much of each end of a file goes into its fast hash
+HASH_BYTES = 65536
+
+# ---------------------------------------------------------------------------
+# Work out an identity for a file: path, size, mtime and a hash of the first
+# and last bits of it. Something changing any of those is a different file.
+def file_identity(path, size=None):
+    st = os.stat(path)
+    if size is None:
+        size = st.st_size
+    
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        md5.update(f.read(HASH_BYTES))
+        if size > HASH_BYTES:
+            f.seek(max(HASH_BYTES, size - HASH_BYTES))
+            md5.update(f.read(HASH_BYTES))
+    
+    info = {
+        'path': os.path.abspath(path),
+        'size': size,
+        'mtime': st.st_mtime_ns,
+        'hash': md5.hexdigest(),
+    }
+    key = hashlib.sha1(('%(path)s\0%(size)d\0%(mtime)d\0%(hash)s' % info).encode('utf-8', 'surrogateescape'))
+    return key.hexdigest()[:16], info
+
+# ---------------------------------------------------------------------------
+
+class Journal:
+    """One JSON record per line. 'file' records describe a file we're posting,
+    'part' records say that one of its parts was accepted by the server.
+
+    Records are written and fsync()ed by a background thread every
+    sync_interval seconds, or as soon as sync_records of them are waiting,
+    so the posting loop never waits on the disk. A crash loses at most the
+    last batch, and those parts just get posted again.
+
+    The file is only ever appended to. Without resume the old records are
+    ignored rather than thrown away, so forgetting --resume doesn't lose
+    track of an interrupted post.
+    """
+    def __init__(self, path, resume=False, sync_interval=1.0, sync_records=256):
+        self.logger = logging.getLogger('journal')
+        
+        self.path = path
+        self._files = {}
+        self._parts = {}
+        
+        if resume and os.path.exists(path):
+            self._load()
+            self.logger.info('Resuming from %s: %d part(s) of %d file(s) already posted', path,
+                sum(len(parts) for parts in self._parts.values()), len(self._parts))
+        elif os.path.exists(path):
+            self.logger.info('Ignoring what %s says was posted already (use --resume to carry on from there)', path)
+        
+        self._file = open(path, 'a')
+
+        # Finish off a line that was cut short, or the next record would end
+        # up on the end of it.
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+        
+        self._sync_interval = sync_interval
+        self._sync_records = sync_records
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._writer, name='journal', daemon=True)
+        self._thread.start()
+    
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Probably the end of a line that was being written when
+                    # we died.
+                    continue
+                
+                if 'file' in record:
+                    self._files[record['file']] = record
+                elif 'part' in record:
+                    self._parts.setdefault(record['part'], {})[record['num']] = record
+    
+    # -----------------------------------------------------------------------
+    # Remember a file we're going to post
+    def add_file(self, key, info):
+        if key not in self._files:
+            record = dict(info, file=key)
+            self._files[key] = record
+            self._write(record)
+    
+    # Parts of a file that were posted already, {partnum: record}
+    def done_parts(self, key):
+        return self._parts.get(key, {})
+    
+    def part_done(self, key, partnum, nbytes, msgid):
+        record = {'part': key, 'num': partnum, 'bytes': nbytes, 'msgid': msgid, 'time': int(time.time())}
+        self._parts.setdefault(key, {})[partnum] = record
+        self._write(record)
+    
+    def _write(self, record):
+        with self._cond:
+            self._pending.append(json.dumps(record) + '\n')
+            if len(self._pending) >= self._sync_records:
+                self._cond.notify()
+    
+    # -----------------------------------------------------------------------
+    def _writer(self):
+        while True:
+            with self._cond:
+                if not self._closing and len(self._pending) < self._sync_records:
+                    self._cond.wait(self._sync_interval)
+                lines, self._pending = self._pending, []
+                closing = self._closing
+            
+            if lines:
+                try:
+                    self._file.writelines(lines)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                except (IOError, OSError) as msg:
+                    self.logger.error('Unable to write to %s: %s', self.path, msg)
+            
+            if closing:
+                return
+    
+    # Write out anything left and close the file
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self._file.close()
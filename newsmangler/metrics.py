@@ -0,0 +1,305 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Metrics for a posting job, exported as Prometheus text or JSON."""
+
+import bisect
+import itertools
+import json
+import logging
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    HTTP_SUPPORT = False
+else:
+    HTTP_SUPPORT = True
+
+# ---------------------------------------------------------------------------
+
+# Upper bounds for latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# ---------------------------------------------------------------------------
+
+class Value:
+    def __init__(self):
+        self.value = 0.0
+    
+    def inc(self, amount=1):
+        self.value += amount
+    
+    def set(self, value):
+        self.value = value
+
+class Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# ---------------------------------------------------------------------------
+
+class Metric:
+    """A named metric with a value for each set of labels. labels() returns
+    the thing to update for one set, metrics without labels can be updated
+    directly. A metric with `func` has no values of its own, func() is asked
+    for them when we're exported: a number, or with labels a list of
+    (labels, number).
+    """
+    kind = 'untyped'
+    
+    def __init__(self, name, help, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        
+        self._children = {}
+        self._lock = threading.Lock()
+    
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self.new_child())
+        return child
+    
+    def new_child(self):
+        return Value()
+    
+    # [(labels, child)] for everything we've got
+    def children(self):
+        if self.func is None:
+            with self._lock:
+                items = list(self._children.items())
+            return [(dict(zip(self.labelnames, key)), child) for key, child in items]
+        
+        value = self.func()
+        if not self.labelnames:
+            value = [({}, value)]
+        result = []
+        for labels, number in value:
+            child = Value()
+            child.set(number)
+            result.append((labels, child))
+        return result
+
+class Counter(Metric):
+    """Whatever func() counts starts again from zero for every probe or job
+    run. When that happens the total so far is carried over, so the counter
+    only ever goes up."""
+    kind = 'counter'
+    
+    def __init__(self, name, help, labelnames=(), func=None):
+        Metric.__init__(self, name, help, labelnames, func)
+        # {label values: (last value from func, total before it started again)}
+        self._totals = {}
+    
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+    
+    def children(self):
+        result = Metric.children(self)
+        if self.func is None:
+            return result
+        
+        with self._lock:
+            for labels, child in result:
+                key = tuple(sorted(labels.items()))
+                last, before = self._totals.get(key, (0, 0))
+                if child.value < last:
+                    before += last
+                self._totals[key] = (child.value, before)
+                child.value += before
+        return result
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def new_child(self):
+        return Buckets(self.buckets)
+    
+    def observe(self, value):
+        self.labels().observe(value)
+
+# ---------------------------------------------------------------------------
+
+def _label_str(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+def _number(value):
+    if value == int(value) and abs(value) < 2 ** 53:
+        return '%d' % (value)
+    return repr(float(value))
+
+class Registry:
+    """All of the metrics for a job. snapshot() renders them, which has to
+    happen in the posting loop, and the last snapshot is what gets written
+    out or served over HTTP.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('metrics')
+        
+        self._metrics = []
+        self.text = ''
+        self.json = '{}'
+    
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help, labelnames=(), func=None):
+        return self.add(Counter(name, help, labelnames, func))
+    
+    def gauge(self, name, help, labelnames=(), func=None):
+        return self.add(Gauge(name, help, labelnames, func))
+    
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+    
+    # -----------------------------------------------------------------------
+    # Prometheus text exposition format
+    def render_text(self, values):
+        lines = []
+        for metric, children in values:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for labels, child in children:
+                if metric.kind != 'histogram':
+                    lines.append('%s%s %s' % (metric.name, _label_str(labels), _number(child.value)))
+                    continue
+                
+                total = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), child.counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('%s_bucket%s %d' % (metric.name, _label_str(dict(labels, le=le)), total))
+                lines.append('%s_sum%s %s' % (metric.name, _label_str(labels), _number(child.sum)))
+                lines.append('%s_count%s %d' % (metric.name, _label_str(labels), child.count))
+        return '\n'.join(lines) + '\n'
+    
+    def render_json(self, values):
+        result = {}
+        for metric, children in values:
+            samples = []
+            for labels, child in children:
+                if metric.kind == 'histogram':
+                    # Cumulative, like the Prometheus ones
+                    counts = list(itertools.accumulate(child.counts))
+                    samples.append({
+                        'labels': labels,
+                        'buckets': dict(zip([repr(float(b)) for b in metric.buckets] + ['+Inf'], counts)),
+                        'sum': child.sum,
+                        'count': child.count,
+                    })
+                else:
+                    samples.append({'labels': labels, 'value': child.value})
+            result[metric.name] = {'type': metric.kind, 'help': metric.help, 'samples': samples}
+        return json.dumps(result, indent=1, sort_keys=True)
+    
+    def snapshot(self):
+        values = [(metric, metric.children()) for metric in self._metrics]
+        self.text = self.render_text(values)
+        self.json = self.render_json(values)
+    
+    # Write the last snapshot out, JSON if the filename ends with .json. A
+    # half written file never replaces a whole one.
+    def write(self, path):
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.json if path.endswith('.json') else self.text)
+            os.replace(tmp, path)
+        except OSError as msg:
+            self.logger.warning('Unable to write metrics to %s: %s', path, msg)
+
+# ---------------------------------------------------------------------------
+
+if HTTP_SUPPORT:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            registry = self.server.registry
+            if self.path == '/metrics':
+                body, ctype = registry.text, 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/metrics.json':
+                body, ctype = registry.json, 'application/json'
+            else:
+                self.send_error(404)
+                return
+            
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+
+class MetricsServer:
+    """Serves the last snapshot of a registry at /metrics (Prometheus text)
+    and /metrics.json from a thread of its own."""
+    def __init__(self, registry, host, port):
+        self._httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.registry = registry
+        self.address = self._httpd.server_address
+        
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# ---------------------------------------------------------------------------
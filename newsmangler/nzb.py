@@ -0,0 +1,163 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Writes NZB files a file at a time, as their segments come in."""
+
+import gzip
+import logging
+import os
+import shutil
+import time
+
+from array import array
+from xml.sax.saxutils import escape, quoteattr
+
+from newsmangler.common import NM_VERSION
+
+# ---------------------------------------------------------------------------
+
+class NZBFile:
+    __slots__ = ('parts', 'done', 'date', 'numbers', 'sizes', 'msgids')
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.done = 0
+        self.date = None
+        self.numbers = array('l')
+        self.sizes = array('q')
+        self.msgids = []
+
+# ---------------------------------------------------------------------------
+
+class NZBWriter:
+    """One NZB for one collection.
+
+    Segments are kept as (number, bytes, Message-ID) columns until every part
+    of their file has been posted or given up on. The file is then written
+    out and forgotten, so we only ever hold the files that are in progress.
+    The files go to a temporary file, close() puts the <head> (which we
+    don't know until the end) in front of them and renames it into place.
+    """
+    def __init__(self, filename, poster, groups, compress=False):
+        self.logger = logging.getLogger('nzb')
+        
+        self.filename = filename
+        self._poster = poster
+        self._groups = groups
+        self._compress = compress
+        
+        self._files = {}
+        self._out = None
+        self._written = 0
+    
+    # -----------------------------------------------------------------------
+    # A segment was posted
+    def add_segment(self, subject, parts, number, msgid, nbytes, posttime):
+        nzbfile = self._file(subject, parts)
+        if nzbfile.date is None or posttime < nzbfile.date:
+            nzbfile.date = posttime
+        nzbfile.numbers.append(number)
+        nzbfile.sizes.append(nbytes)
+        nzbfile.msgids.append(msgid)
+        self._part_done(subject, nzbfile)
+    
+    # A segment was given up on, it won't be in the NZB
+    def skip_segment(self, subject, parts):
+        self._part_done(subject, self._file(subject, parts))
+    
+    def _file(self, subject, parts):
+        nzbfile = self._files.get(subject)
+        if nzbfile is None:
+            nzbfile = self._files[subject] = NZBFile(parts)
+        return nzbfile
+    
+    def _part_done(self, subject, nzbfile):
+        nzbfile.done += 1
+        if nzbfile.done >= nzbfile.parts:
+            del self._files[subject]
+            self._write_file(subject, nzbfile)
+    
+    # -----------------------------------------------------------------------
+    def _open(self):
+        self._out = open(self.filename + '.files', 'w+', encoding='utf-8')
+    
+    def _write_file(self, subject, nzbfile):
+        if not nzbfile.msgids:
+            return
+        if self._out is None:
+            self._open()
+        
+        lines = ['<file poster=%s date="%d" subject=%s><groups>' % (
+            quoteattr(self._poster), nzbfile.date, quoteattr(subject))]
+        for group in self._groups:
+            lines.append('<group>%s</group>' % (escape(group)))
+        lines.append('</groups><segments>')
+        
+        # Segments come in whatever order they were posted in
+        order = sorted(range(len(nzbfile.numbers)), key=nzbfile.numbers.__getitem__)
+        for i in order:
+            lines.append('<segment bytes="%d" number="%d">%s</segment>' % (
+                nzbfile.sizes[i], nzbfile.numbers[i], escape(nzbfile.msgids[i][1:-1])))
+        lines.append('</segments></file>\n')
+        
+        self._out.write(''.join(lines))
+        self._written += 1
+    
+    # Write out whatever files are left, finish off the NZB and move it into
+    # place. `meta` is a list of (type, value) for the <head>. Returns the
+    # filename, or None if there was nothing to write.
+    def close(self, meta=()):
+        for subject, nzbfile in list(self._files.items()):
+            self._write_file(subject, nzbfile)
+        self._files = {}
+        
+        if self._out is None:
+            return None
+        
+        if self._compress:
+            out = gzip.open(self.filename + '.tmp', 'wt', encoding='utf-8')
+        else:
+            out = open(self.filename + '.tmp', 'w', encoding='utf-8')
+        
+        with out:
+            gentime = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            out.write('<nzb><!--Generated by newsmangler v%s at %s-->\n' % (NM_VERSION, gentime))
+            if meta:
+                out.write('<head>%s</head>\n' % (''.join('<meta type=%s>%s</meta>' % (
+                    quoteattr(metatype), escape(value)) for metatype, value in meta)))
+            
+            self._out.seek(0)
+            shutil.copyfileobj(self._out, out)
+            out.write('</nzb>\n')
+        
+        self._out.close()
+        self._out = None
+        os.remove(self.filename + '.files')
+        os.replace(self.filename + '.tmp', self.filename)
+        
+        return self.filename
@@ -0,0 +1,493 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""PAR2 recovery files, built from the parts as they're read for posting.
+
+Recovery slices are the usual PAR2 Reed-Solomon code over GF(2^16): slice e
+is the sum of every input slice i multiplied by c_i^e. That's a sum, so input
+slices can be added in whatever order they turn up in, and we don't have to
+read the files a second time. The whole file MD5 does need them in order,
+if they turn up too far out of order the file gets read again for that. Batches of slices are worked on by a process
+pool, split up between the workers by columns so they never touch the same
+words.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    HAVE_NUMPY = False
+else:
+    HAVE_NUMPY = True
+
+from newsmangler.common import NM_VERSION
+
+# ---------------------------------------------------------------------------
+
+MAGIC = b'PAR2\0PKT'
+TYPE_MAIN = b'PAR 2.0\0Main\0\0\0\0'
+TYPE_FILEDESC = b'PAR 2.0\0FileDesc'
+TYPE_IFSC = b'PAR 2.0\0IFSC\0\0\0\0'
+TYPE_RECVSLIC = b'PAR 2.0\0RecvSlic'
+TYPE_CREATOR = b'PAR 2.0\0Creator\0'
+
+# GF(2^16) generator polynomial, and the number of non-zero elements
+GF_POLY = 0x1100B
+GF_ORDER = 65535
+
+# Input slice constants are 2^n for n coprime to 65535, there are only this
+# many of them.
+MAX_SLICES = 32768
+
+# Number of input slices sent to the workers at a time. Each worker gets at
+# least TASK_MIN_WORDS columns of them, and up to about TASK_WORDS words of
+# recovery slices to work on at once.
+BATCH_SLICES = 16
+TASK_MIN_WORDS = 16384
+TASK_WORDS = 1 << 22
+
+# How many slices of a file that turn up before the one the whole file hash
+# needs next get kept around for it
+EARLY_SLICES = 64
+
+# ---------------------------------------------------------------------------
+# exp/log tables for GF(2^16). exp is doubled so log(a) + log(b) never needs
+# wrapping, and log(0) points past that at a run of zeroes.
+_EXP = None
+_LOG = None
+
+def gf_tables():
+    global _EXP, _LOG
+    if _EXP is None:
+        exp = [0] * GF_ORDER
+        log = [0] * (GF_ORDER + 1)
+        x = 1
+        for i in range(GF_ORDER):
+            exp[i] = x
+            log[x] = i
+            x <<= 1
+            if x & 0x10000:
+                x ^= GF_POLY
+        log[0] = GF_ORDER * 2
+        
+        _EXP = np.zeros(GF_ORDER * 3 + 1, dtype=np.uint16)
+        _EXP[:GF_ORDER] = exp
+        _EXP[GF_ORDER:GF_ORDER * 2] = exp
+        _LOG = np.array(log, dtype=np.int64)
+    return _EXP, _LOG
+
+# Logs of the constants for the first `count` input slices
+def input_logs(count):
+    logs = []
+    n = 0
+    while len(logs) < count:
+        n += 1
+        if math.gcd(n, GF_ORDER) == 1:
+            logs.append(n)
+    return logs
+
+# Runs in a worker. Adds a batch of input slices to every recovery slice, for
+# words [start, end) only. Everything is memory mapped from files, so all the
+# workers see the same accumulators without anything being pickled.
+def _recover_task(acc_path, rows, words, batch_path, count, logs, start, end):
+    exp, log = gf_tables()
+    acc = np.memmap(acc_path, dtype='<u2', mode='r+', shape=(rows, words))
+    batch = np.memmap(batch_path, dtype='<u2', mode='r', shape=(BATCH_SLICES, words))
+    
+    # log(c_i^r) for input slice i and recovery slice r
+    factors = (np.arange(rows, dtype=np.int64)[:, None] * np.array(logs, dtype=np.int64)) % GF_ORDER
+    
+    result = np.zeros((rows, end - start), dtype=np.uint16)
+    for i in range(count):
+        block_logs = log.take(batch[i, start:end])
+        for r in range(rows):
+            result[r] ^= exp.take(block_logs + factors[r, i])
+    
+    acc[:, start:end] ^= result
+    del acc, batch
+
+# ---------------------------------------------------------------------------
+
+class Par2File:
+    """One source file: its IDs and hashes, and the checksum of each slice."""
+    def __init__(self, filepath, filename, filesize, block_size):
+        self.filepath = filepath
+        self.filename = filename
+        self.filesize = filesize
+        self.blocks = (filesize + block_size - 1) // block_size
+        self.first = 0
+        
+        with open(filepath, 'rb') as f:
+            self.hash16k = hashlib.md5(f.read(16384)).digest()
+        self.file_id = hashlib.md5(self.hash16k + struct.pack('<Q', filesize) +
+            filename.encode('utf-8')).digest()
+        
+        self.checksums = [None] * self.blocks
+        self.hash = None
+        
+        # The whole file hash has to be done in order, slices that turn up
+        # early wait here.
+        self._md5 = hashlib.md5()
+        self._next = 0
+        self._early = {}
+    
+    def add_data(self, block, data):
+        if self._md5 is None:
+            return
+        if block != self._next:
+            # Too many to keep, the hash gets done from the file at the end
+            if len(self._early) >= EARLY_SLICES:
+                self.drop()
+                return
+            self._early[block] = bytes(data)
+            return
+        
+        self._md5.update(data)
+        self._next += 1
+        while self._next in self._early:
+            self._md5.update(self._early.pop(self._next))
+            self._next += 1
+        
+        if self._next == self.blocks:
+            self.hash = self._md5.digest()
+    
+    # Stop working on the whole file hash as the slices come in
+    def drop(self):
+        self._md5 = None
+        self._early = {}
+    
+    # Read the file to get its hash, if it couldn't be done on the way
+    def finish_hash(self):
+        if self.hash is not None:
+            return
+        md5 = hashlib.md5()
+        with open(self.filepath, 'rb') as f:
+            left = self.filesize
+            while left > 0:
+                data = f.read(min(left, 1 << 20))
+                if not data:
+                    raise IOError('%s is shorter than it was' % (self.filepath))
+                md5.update(data)
+                left -= len(data)
+        self.hash = md5.digest()
+
+# ---------------------------------------------------------------------------
+
+class Par2Builder:
+    """Builds a PAR2 set for `files`, a list of (path, name, size).
+
+    Slices have to be fed in with feed() (or the callables from feeder())
+    as the files are read, in any order, from any thread. Once the last one
+    is in, the volumes are written out in the background and on_done(builder,
+    ok) gets called from that thread.
+    """
+    def __init__(self, basepath, files, block_size, redundancy, executor, workers):
+        if not HAVE_NUMPY:
+            raise ValueError('NumPy is needed to build PAR2 files')
+        if block_size % 4:
+            raise ValueError('PAR2 block size must be a multiple of 4')
+        
+        self.logger = logging.getLogger('par2')
+        
+        self.basepath = basepath
+        self.block_size = block_size
+        self.on_done = None
+        
+        self._executor = executor
+        self._workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._submit_lock = threading.Lock()
+        self._error = None
+        self._aborted = False
+        
+        # Files go in the order of their IDs, as a 128-bit little endian
+        # number. That's also the order their slices are numbered in.
+        self.files = [Par2File(filepath, filename, filesize, block_size)
+            for filepath, filename, filesize in files]
+        self.files.sort(key=lambda f: f.file_id[::-1])
+        self._by_path = {}
+        total = 0
+        for par2file in self.files:
+            par2file.first = total
+            total += par2file.blocks
+            self._by_path[par2file.filepath] = par2file
+        
+        if total > MAX_SLICES:
+            raise ValueError('%d slices is too many for one PAR2 set, use a bigger block size' % (total))
+        
+        self.total_blocks = total
+        self.recovery_blocks = min(GF_ORDER, max(1, int(math.ceil(total * redundancy / 100.0))))
+        self.volumes = self._plan_volumes()
+        
+        self._logs = input_logs(total)
+        self._seen = bytearray(total)
+        self._fed = 0
+        
+        main = [struct.pack('<QI', block_size, len(self.files))] + [f.file_id for f in self.files]
+        self.set_id = hashlib.md5(b''.join(main)).digest()
+        self._main = main
+        
+        # Recovery slices, and two batches of input slices: one being filled
+        # while the workers are busy with the other.
+        self._words = block_size // 2
+        self._tmpdir = tempfile.mkdtemp(prefix='newsmangler-par2-')
+        self._acc_path = self._scratch('recovery', self.recovery_blocks * block_size)
+        self._batch_paths = [self._scratch('batch%d' % (i), BATCH_SLICES * block_size) for i in range(2)]
+        self._batches = [np.memmap(path, dtype='<u2', mode='r+', shape=(BATCH_SLICES, self._words))
+            for path in self._batch_paths]
+        self._current = 0
+        self._count = 0
+        self._batch_logs = []
+        self._busy = [False, False]
+        self._submitting = 0
+        self._futures = []
+        self._futures_batch = None
+        
+        self.logger.debug('%s: %d slice(s) of %d bytes, %d recovery slice(s) in %d volume(s)',
+            basepath, total, block_size, self.recovery_blocks, len(self.volumes) - 1)
+    
+    # An index file with no recovery slices, then volumes of 1, 2, 4, ...
+    def _plan_volumes(self):
+        volumes = [(self.basepath + '.par2', 0, 0)]
+        width = max(2, len(str(self.recovery_blocks)))
+        start, count = 0, 1
+        while start < self.recovery_blocks:
+            count = min(count, self.recovery_blocks - start)
+            volumes.append(('%s.vol%0*d+%0*d.par2' % (self.basepath, width, start, width, count), start, count))
+            start += count
+            count *= 2
+        return volumes
+    
+    def _scratch(self, name, size):
+        path = os.path.join(self._tmpdir, name)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        return path
+    
+    # -----------------------------------------------------------------------
+    # A callable(begin, data) for a FileWrap to tell us what it read
+    def feeder(self, filepath):
+        par2file = self._by_path[filepath]
+        return lambda begin, data: self.feed(par2file, begin, data)
+    
+    # Some data was read from a file, `begin` has to be at the start of a
+    # slice.
+    def feed(self, par2file, begin, data):
+        data = memoryview(data).cast('B')
+        first = begin // self.block_size
+        for offset in range(0, len(data), self.block_size):
+            self._feed_slice(par2file, first + offset // self.block_size, data[offset:offset + self.block_size])
+    
+    def _feed_slice(self, par2file, block, data):
+        index = par2file.first + block
+        with self._lock:
+            # Parts get read again when they're retried
+            if self._seen[index] or self._aborted:
+                return
+            self._seen[index] = 1
+        
+        # The last slice is padded with zeroes for everything but the file hash
+        padded = data
+        if len(data) < self.block_size:
+            padded = bytes(data) + bytes(self.block_size - len(data))
+        par2file.checksums[block] = (hashlib.md5(padded).digest(), zlib.crc32(padded) & 0xffffffff)
+        
+        full = None
+        with self._lock:
+            par2file.add_data(block, data)
+            
+            # The workers might not be done with this batch yet
+            while self._busy[self._current]:
+                self._cond.wait()
+            if self._aborted:
+                return
+            
+            self._batches[self._current][self._count] = np.frombuffer(padded, dtype='<u2')
+            self._batch_logs.append(self._logs[index])
+            self._count += 1
+            if self._count == BATCH_SLICES:
+                full = self._swap()
+            
+            self._fed += 1
+            finished = (self._fed == self.total_blocks)
+        
+        if full is not None:
+            self._submit(*full)
+        if finished:
+            threading.Thread(target=self._finish, name='par2').start()
+    
+    # Part of a file couldn't be read. Without its slices there's no PAR2
+    # set, so unless we got them some other time, give up on it. Returns
+    # True if that's what happened, on_done gets told it wasn't ok.
+    def part_failed(self, filepath, begin, end):
+        par2file = self._by_path.get(filepath)
+        if par2file is None:
+            return False
+        
+        first = par2file.first + begin // self.block_size
+        last = par2file.first + (end + self.block_size - 1) // self.block_size
+        with self._lock:
+            if self._aborted or all(self._seen[first:last]):
+                return False
+            self._aborted = True
+            for f in self.files:
+                f.drop()
+        
+        threading.Thread(target=self._finish, name='par2').start()
+        return True
+    
+    # Take the current batch for the workers and start filling the other one.
+    # Called with the lock held, returns what _submit() wants.
+    def _swap(self):
+        full = (self._current, self._count, self._batch_logs)
+        self._busy[self._current] = True
+        self._submitting += 1
+        
+        self._current ^= 1
+        self._count = 0
+        self._batch_logs = []
+        return full
+    
+    # Hand a batch to the workers. Only one batch is worked on at a time as
+    # they all add to the same recovery slices, the workers split it up
+    # between them by columns. This waits for the previous batch without
+    # holding the lock, so slices keep going into the other one meanwhile.
+    def _submit(self, batch, count, logs):
+        with self._submit_lock:
+            previous = self._futures_batch
+            self._wait()
+            
+            rows = self.recovery_blocks
+            chunk = max(TASK_MIN_WORDS, min(-(-self._words // self._workers), TASK_WORDS // rows))
+            for start in range(0, self._words, chunk):
+                self._futures.append(self._executor.submit(_recover_task, self._acc_path, rows, self._words,
+                    self._batch_paths[batch], count, logs, start, min(self._words, start + chunk)))
+            self._futures_batch = batch
+        
+        # The previous batch can be filled again
+        with self._lock:
+            if previous is not None:
+                self._busy[previous] = False
+            self._submitting -= 1
+            self._cond.notify_all()
+    
+    # Wait for the workers, with the submit lock held
+    def _wait(self):
+        futures, self._futures = self._futures, []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as exc:
+                self._error = exc
+    
+    # -----------------------------------------------------------------------
+    # Everything is in, finish off the recovery slices and write the volumes
+    def _finish(self):
+        ok = False
+        try:
+            # Anyone still handing over a full batch goes first
+            with self._lock:
+                while self._submitting:
+                    self._cond.wait()
+                full = not self._aborted and self._count and self._swap() or None
+            
+            if full is not None:
+                self._submit(*full)
+            with self._submit_lock:
+                self._wait()
+            
+            if self._error is not None:
+                raise self._error
+            if not self._aborted:
+                for par2file in self.files:
+                    par2file.finish_hash()
+                self._write_volumes()
+                ok = True
+        except Exception:
+            self.logger.exception('Failed to build PAR2 files for %s', self.basepath)
+        finally:
+            self.cleanup()
+        
+        if self.on_done is not None:
+            self.on_done(self, ok)
+    
+    def _packet(self, ptype, *body):
+        md5 = hashlib.md5(self.set_id)
+        md5.update(ptype)
+        for chunk in body:
+            md5.update(chunk)
+        length = 64 + sum(len(chunk) for chunk in body)
+        return [MAGIC, struct.pack('<Q', length), md5.digest(), self.set_id, ptype] + list(body)
+    
+    def _critical_packets(self):
+        packets = self._packet(TYPE_MAIN, *self._main)
+        for f in self.files:
+            name = f.filename.encode('utf-8')
+            name += b'\0' * (-len(name) % 4)
+            packets += self._packet(TYPE_FILEDESC, f.file_id, f.hash, f.hash16k,
+                struct.pack('<Q', f.filesize), name)
+            packets += self._packet(TYPE_IFSC, f.file_id,
+                b''.join(md5 + struct.pack('<I', crc) for md5, crc in f.checksums))
+        
+        creator = ('Created by newsmangler v%s' % (NM_VERSION)).encode('ascii')
+        creator += b'\0' * (-len(creator) % 4)
+        packets += self._packet(TYPE_CREATOR, creator)
+        return b''.join(packets)
+    
+    def _write_volumes(self):
+        critical = self._critical_packets()
+        acc = np.memmap(self._acc_path, dtype='<u2', mode='r', shape=(self.recovery_blocks, self._words))
+        
+        for path, start, count in self.volumes:
+            with open(path + '.tmp', 'wb') as f:
+                for exponent in range(start, start + count):
+                    f.write(b''.join(self._packet(TYPE_RECVSLIC, struct.pack('<I', exponent),
+                        memoryview(acc[exponent]).cast('B'))))
+                f.write(critical)
+            os.replace(path + '.tmp', path)
+        
+        del acc
+        self.logger.info('Generated %d PAR2 file(s) with %d recovery slice(s) for %s',
+            len(self.volumes), self.recovery_blocks, self.basepath)
+    
+    # Get rid of our scratch files
+    def cleanup(self):
+        self._batches = []
+        for name in os.listdir(self._tmpdir):
+            os.remove(os.path.join(self._tmpdir, name))
+        os.rmdir(self._tmpdir)
+
+# ---------------------------------------------------------------------------
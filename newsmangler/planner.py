@@ -0,0 +1,173 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Keeps track of the parts we still have to post."""
+
+import collections
+import logging
+
+from array import array
+
+from newsmangler.common import MessageIDs
+
+# Once this many rows have been used up, think about throwing them away
+COMPACT_ROWS = 4096
+
+# ---------------------------------------------------------------------------
+
+class PlanFile:
+    __slots__ = ('filewrap', 'fileinfo', 'subject')
+
+    def __init__(self, filewrap, fileinfo, subject):
+        self.filewrap = filewrap
+        self.fileinfo = fileinfo
+        self.subject = subject
+
+# ---------------------------------------------------------------------------
+
+class ArticlePlanner:
+    """A compact table of (file index, part number, begin, end, Message-ID)
+    rows.
+
+    Sources are callables that get run one at a time, when we run out of
+    rows, to add more files and parts. Articles are only built when somebody
+    asks for one with next_article(). Message-IDs come from `msgids` (a
+    MessageIDs) as parts are added, so they're known before anything is
+    posted. Parts being posted again keep the Message-ID they had, those go
+    in the table as negative numbers.
+    """
+    def __init__(self, build_article, msgids=None):
+        self.logger = logging.getLogger('planner')
+        
+        self._build_article = build_article
+        self._sources = collections.deque()
+        self.msgids = msgids or MessageIDs('newsmangler.invalid')
+        
+        self.files = []
+        self._fileidx = array('l')
+        self._partnum = array('l')
+        self._begin = array('q')
+        self._end = array('q')
+        self._msgnum = array('q')
+        self._fixed = []
+        self._cursor = 0
+        
+        # Number of parts planned so far
+        self.total = 0
+    
+    # -----------------------------------------------------------------------
+    # Add a source of files to scan later, scan(*args) gets called when it's
+    # time.
+    def add_source(self, scan, *args):
+        self._sources.append((scan, args))
+    
+    # Add a file, returns the file index to use with add_part()
+    def add_file(self, filewrap, fileinfo, subject):
+        self.files.append(PlanFile(filewrap, fileinfo, subject))
+        return len(self.files) - 1
+    
+    # Add a part, returns the Message-ID it will be posted with. `msgid` is
+    # the one to use for a part that was posted before.
+    def add_part(self, fileidx, partnum, begin, end, msgid=None):
+        if msgid is None:
+            msgnum = self.msgids.allocate()
+        else:
+            self._fixed.append(msgid)
+            msgnum = -len(self._fixed)
+        self._fileidx.append(fileidx)
+        self._partnum.append(partnum)
+        self._begin.append(begin)
+        self._end.append(end)
+        self._msgnum.append(msgnum)
+        self.total += 1
+        return self._msgid(msgnum)
+    
+    def _msgid(self, msgnum):
+        if msgnum < 0:
+            return self._fixed[-msgnum - 1]
+        return self.msgids.format(msgnum)
+    
+    # -----------------------------------------------------------------------
+    # Number of parts we know about that haven't been handed out yet
+    def remaining(self):
+        return len(self._fileidx) - self._cursor
+    
+    # Is there anything at all left, including sources we haven't scanned?
+    def has_more(self):
+        return self.remaining() > 0 or len(self._sources) > 0
+    
+    # Scan sources until we have some parts to hand out. Returns False if
+    # there's nothing left anywhere.
+    def scan(self):
+        while not self.remaining() and self._sources:
+            scan, args = self._sources.popleft()
+            scan(*args)
+        return self.remaining() > 0
+    
+    # Scan every source we have left
+    def scan_all(self):
+        while self._sources:
+            scan, args = self._sources.popleft()
+            scan(*args)
+    
+    # Scan everything and hand out every part left without building any
+    # Articles, as [(PlanFile, [(partnum, begin, end), ...])] in the order
+    # they were planned. Message-IDs are left for whoever posts them.
+    def take_all(self):
+        self.scan_all()
+        
+        byfile = collections.OrderedDict()
+        for i in range(self._cursor, len(self._fileidx)):
+            byfile.setdefault(self._fileidx[i], []).append((self._partnum[i], self._begin[i], self._end[i]))
+        
+        for rows in (self._fileidx, self._partnum, self._begin, self._end, self._msgnum):
+            del rows[:]
+        self._cursor = 0
+        
+        return [(self.files[fileidx], rows) for fileidx, rows in byfile.items()]
+    
+    # Build the next article, None if there is nothing left
+    def next_article(self):
+        if not self.remaining() and not self.scan():
+            return None
+        
+        i = self._cursor
+        self._cursor += 1
+        
+        planfile = self.files[self._fileidx[i]]
+        article = self._build_article(planfile.filewrap, self._begin[i], self._end[i],
+            planfile.fileinfo, planfile.subject, self._partnum[i], self._msgid(self._msgnum[i]))
+        
+        # Throw away the rows we've used up once they're most of the table
+        if self._cursor >= COMPACT_ROWS and self._cursor * 2 >= len(self._fileidx):
+            for rows in (self._fileidx, self._partnum, self._begin, self._end, self._msgnum):
+                del rows[:self._cursor]
+            self._cursor = 0
+        
+        return article
+
+# ---------------------------------------------------------------------------
@@ -27,94 +27,281 @@
 
 """Main class for posting stuff."""
 
-import asyncore
-import select
+import asyncio
+import collections
+import heapq
+import random
 import time
 import sys
 import logging
 import os
+import tempfile
+import zlib
 
-try:
-    import xml.etree.cElementTree as ET
-except:
-    import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 
-from newsmangler import asyncnntp
+from newsmangler import par2
 from newsmangler import yenc
 from newsmangler.article import Article
-from newsmangler.common import NM_VERSION, niceFileSize_str, niceTime_str, safeFilename
-from newsmangler.filewrap import FileWrap
+from newsmangler.buffers import BufferPool
+from newsmangler.checksums import CHECKSUM_FILES, FileChecksum, write_checksum_file
+from newsmangler.common import NM_VERSION, MessageIDs, niceFileSize_str, niceTime_str, parseRate, safeFilename
+from newsmangler.encoder import EncodePipeline
+from newsmangler.eventloop import EventLoop
+from newsmangler.filewrap import FilePool, FileWrap, chain_watchers
+from newsmangler.journal import Journal, file_identity
+from newsmangler.metrics import HTTP_SUPPORT, MetricsServer, Registry
+from newsmangler.nzb import NZBWriter
+from newsmangler.planner import ArticlePlanner
+from newsmangler.ratelimit import RateLimiter
+from newsmangler.servers import RANK_PENALISED, ServerPool, ServerState
+from newsmangler.verify import AioStat, Verifier, read_nzb
+
+# How often to update the status line
+STATUS_INTERVAL = 0.5
+
+# Article sizes to try with article_size: auto, and how much to post for
+# each one.
+PROBE_SIZES = '384000 768000 1536000 3072000'
+PROBE_BYTES = 16 * 1024 * 1024
+DEFAULT_ARTICLE_SIZE = 768000
+
+# Posting engines we know about
+ENGINES = ('asyncore', 'asyncio')
 
 class PostMangler:
     def __init__(self, conf, debug):
         self.conf = conf
+        self.logger = logging.getLogger('postMangler')
         
-        self._conns = []
-        self._idle = []
+        # What worked for each server last time
+        self._state = None
+        path = self.conf['posting'].get('server_state', '~/.newsmangler.state')
+        if path:
+            self._state = ServerState(os.path.expanduser(path))
         
-        self.logger = logging.getLogger('postMangler')
+        self.reset_connections()
+        self._deferred = False
         
-        # Create a poll object for async bits to use. If the user doesn't have
-        # poll, we're going to have to fake it.
-        try:
-            asyncore.poller = select.poll()
-            self.logger.debug('Using select.poll() for sockets')
-        except AttributeError:
-            from newsmangler.fakepoll import FakePoll
-            asyncore.poller = FakePoll()
-            self.logger.debug('Using FakePoll.poll() for sockets')
+        # Servers with max_connections set get more or fewer connections as
+        # we go, unless we're probing for an article size.
+        self._adapt_timer = None
+        self._probing = False
+        
+        # Work out which posting engine to use. asyncore went away in Python
+        # 3.12, so fall back to asyncio if it's missing.
+        self.engine = self.conf['posting'].get('engine', 'asyncore')
+        if self.engine not in ENGINES:
+            self.logger.warning('Unknown engine "%s", using asyncore instead', self.engine)
+            self.engine = 'asyncore'
+        if self.engine == 'asyncore':
+            try:
+                import asyncore
+            except ImportError:
+                self.logger.warning('asyncore is not available, using asyncio instead')
+                self.engine = 'asyncio'
+        
+        # Create an event loop for the async bits to use. This picks the best
+        # selector the platform has, falling back to select() if need be.
+        self.loop = EventLoop()
 
         self.conf['posting']['skip_filenames'] = self.conf['posting'].get('skip_filenames', '').split()
         
-        self._articles = []
-        self._files = {}
-        self._msgids = {}
+        self._planner = None
+        self._pipeline = None
+        self._bufpool = None
+        self._article_ready = None
+        self._all_done = None
+        
+        # Articles waiting to be tried again as a heap of (when, seq, article),
+        # and the ones we gave up on as (article, reason).
+        self._retries = []
+        self._retry_seq = 0
+        self._failed = []
+        
+        # NZB writers for each collection, and the number of articles in each
+        # that we haven't finished with yet.
+        self._nzbs = {}
+        self._parts_left = {}
+        
+        # With nzb_first the NZBs are written while planning, from the
+        # Message-IDs we're going to use, and posted along with everything
+        # else.
+        self._nzb_planning = False
+        self._nzbs_written = False
+        
+        # Checksum files to write for each collection, the hashes they need,
+        # and the FileChecksum of every file in each collection.
+        self._checksum_files = []
+        for kind in self.conf['posting'].get('checksum_files', '').replace(',', ' ').split():
+            if kind not in CHECKSUM_FILES:
+                self.logger.warning('Unknown checksum file type "%s", ignoring it', kind)
+            elif kind not in self._checksum_files:
+                self._checksum_files.append(kind)
+        self._hashes = [CHECKSUM_FILES[kind] for kind in self._checksum_files if CHECKSUM_FILES[kind]]
+        self._checksums = {}
+        
+        # PAR2 sets being built, and ones that are finished and waiting to be
+        # planned. Their workers get started when the first set needs them.
+        # Whether we can build them at all gets checked once we know the
+        # article size.
+        self._par2_redundancy = self.conf['posting'].get('par2_redundancy', 0)
+        self._par2_pending = 0
+        self._par2_finished = collections.deque()
+        self._par2_builders = {}
+        self._par2_executor = None
+        
+        # How worker threads get things run in the posting loop
+        self._call_soon_threadsafe = self.loop.call_soon_threadsafe
+        
+        # Journal of posted parts, if we're keeping one, and the number of
+        # parts it told us to skip.
+        self._journal = None
+        self._skipped = 0
+        
+        # Message-IDs being checked by verify()
+        self.verifier = None
+        
+        # Worker processes doing the posting for us, see workers.py
+        self._coordinator = None
+        
+        # Whether each (host, port) can do streaming, once we know
+        self._streaming = {}
+        
+        # Every connection shares one bandwidth limit. The status line shows
+        # how fast we've gone since it last changed.
+        try:
+            rate = parseRate(self.conf['posting'].get('rate_limit', 0))
+        except ValueError as msg:
+            self.logger.warning('%s, not limiting the rate', msg)
+            rate = 0
+        self.limiter = RateLimiter(rate, self.conf['posting'].get('kernel_pacing', 1))
+        self._bytes = 0
+        self._rate_since = (time.time(), 0)
+        
+        # Metrics for the job, written to posting/metrics_file and served on
+        # posting/metrics_port every posting/metrics_interval seconds.
+        self._posted = 0
+        self.metrics = self.setup_metrics()
+        self._metrics_server = None
+        self._metrics_timer = None
+        
+        # Open files are shared between everything being posted, and there's
+        # a limit on how many we keep open at once.
+        self._filepool = FilePool(self.conf['posting'].get('max_open_files', 64),
+            self.conf['posting'].get('read_backend', 'read'))
+        self.logger.debug('Reading files with the %s backend', self._filepool.backend)
         
-        self._current_dir = None
         self.newsgroup = None
         self.post_title = None
         
-        # Some sort of useful logging junk about which yEncode we're using
-        self.logger.debug('Using %s module for yEnc', yenc.yEncMode())
-    
-    # Connect all of our connections
-    def connect(self):
-        for i in range(self.conf['server']['connections']):
-            conn = asyncnntp.AsyncNNTP(
-                    parent = self, 
-                    connid = i, 
-                    host = self.conf['server']['hostname'],
-                    port = self.conf['server']['port'], 
-                    bindto = None, 
-                    username = self.conf['server']['username'],
-                    password = self.conf['server']['password'],
-                    use_ssl = self.conf['server']['use_ssl']
-            )
-            conn.do_connect()
-            self._conns.append(conn)
-
-    # Poll our poll() object and do whatever is neccessary. Basically a combination
-    # of asyncore.poll2() and asyncore.readwrite(), without all the frippery.
-    def pollSocketEvents(self):
-        results = asyncore.poller.poll(0)
-        for fd, flags in results:
-            obj = asyncore.socket_map.get(fd)
-            if obj is None:
-                self.logger.critical('Invalid FD for pollSocketEvents(): %d', fd)
-                asyncore.poller.unregister(fd)
+        # Use the fastest yEnc encoder that works here. Checking and timing
+        # them takes a moment, so the results are kept in posting/yenc_cache.
+        cache = self.conf['posting'].get('yenc_cache', '~/.newsmangler.encoders')
+        yenc.selectEncoder(self.conf['posting'].get('yenc_encoder', 'auto'),
+            cache and os.path.expanduser(cache) or None)
+        self.logger.debug('Using the %s yEnc encoder', yenc.yEncMode())
+    
+    # Start again with no connections and fresh server stats
+    def reset_connections(self):
+        self._conns = []
+        self._idle = []
+        self._next_connid = 0
+        
+        # Connections waiting for an article with the asyncio engine, and
+        # whether next_article() just passed one over for a better one.
+        self._waiting = set()
+        
+        self._pools = self.server_pools()
+        self._pools_by_name = dict((pool.name, pool) for pool in self._pools)
+    
+    # The [server] section, and a [server:NAME] section for each extra
+    # server. Those get anything they don't set from [server].
+    def server_pools(self):
+        pools = [ServerPool(self.conf['server'].get('hostname', 'server'), self.conf['server'])]
+        for section in sorted(self.conf):
+            if section.startswith('server:'):
+                conf = dict(self.conf['server'])
+                conf.update(self.conf[section])
+                pools.append(ServerPool(section[7:], conf))
+        
+        # Servers that change their number of connections start with however
+        # many worked best last time.
+        for pool in pools:
+            connections = self._state and self._state.get(pool.key, 'connections')
+            if pool.adaptive and connections:
+                pool.set_target(connections)
+        
+        return pools
+    
+    # Connect all of our connections, start(conn) gets them going
+    def connect(self, connclass, start):
+        self._connclass = connclass
+        self._start_connection = start
+        for pool in self._pools:
+            for i in range(pool.target):
+                self.add_connection(pool)
+    
+    def add_connection(self, pool):
+        conn = self._connclass(
+                parent = self, 
+                pool = pool,
+                connid = self._next_connid, 
+                host = pool.conf['hostname'],
+                port = pool.conf['port'], 
+                bindto = None, 
+                username = pool.conf['username'],
+                password = pool.conf['password'],
+                use_ssl = pool.conf['use_ssl']
+        )
+        self._next_connid += 1
+        pool.conns.append(conn)
+        self._conns.append(conn)
+        self._start_connection(conn)
+    
+    # A connection has closed for good
+    def connection_closed(self, conn):
+        if conn in self._conns:
+            self._conns.remove(conn)
+        if conn in conn.pool.conns:
+            conn.pool.conns.remove(conn)
+    
+    # See if each server wants more or fewer connections. The ones that go
+    # are the ones doing the least: reconnecting, then idle, then busy.
+    def adapt_connections(self):
+        now = time.time()
+        for pool in self._pools:
+            if not pool.adaptive:
                 continue
             
-            try:
-                if flags & (select.POLLIN | select.POLLPRI):
-                    obj.handle_read_event()
-                if flags & select.POLLOUT:
-                    obj.handle_write_event()
-                if flags & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
-                    obj.handle_expt_event()
-            except (asyncore.ExitNow, KeyboardInterrupt, SystemExit):
-                raise
-            except:
-                obj.handle_error()
+            target = pool.adapt(now)
+            live = pool.live()
+            for i in range(target - len(live)):
+                self.add_connection(pool)
+            
+            live.sort(key=lambda conn: (conn.is_connected(), conn.in_flight()))
+            for conn in live[:max(0, len(live) - target)]:
+                conn.retire()
+            self.retry_ready()
+        
+        self._adapt_timer = self._call_later(self.conf['posting'].get('adapt_interval', 5),
+            self.adapt_connections)
+    
+    def start_adapting(self):
+        if not self._probing and any(pool.adaptive for pool in self._pools):
+            self._adapt_timer = self._call_later(self.conf['posting'].get('adapt_interval', 5),
+                self.adapt_connections)
+    
+    def stop_adapting(self):
+        if self._adapt_timer is not None:
+            self._adapt_timer.cancel()
+            self._adapt_timer = None
+        
+        # The next run starts with however many connections did best
+        if self._state is not None:
+            for pool in self._pools:
+                if pool.adaptive and pool.best[0] > 0:
+                    self._state.set(pool.key, connections=pool.best[1])
 
     # -----------------------------------------------------------------------
 
@@ -122,87 +309,920 @@ class PostMangler:
         self.newsgroup = newsgroup
         self.post_title = post_title
         
-        # Generate the list of articles we need to post
+        self.start_metrics_server()
+        try:
+            if self.conf['posting']['article_size'] == 'auto':
+                self.conf['posting']['article_size'] = self.auto_article_size()
+            if self._par2_redundancy:
+                self.check_par2()
+            
+            self.open_journal()
+            workers = self.conf['posting'].get('workers', 1)
+            if workers > 1:
+                self._post_sharded(postme, workers)
+            else:
+                self._post(postme)
+        finally:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if self._par2_executor is not None:
+                self._par2_executor.shutdown()
+                self._par2_executor = None
+            if self._state is not None:
+                self._state.save()
+            self.update_metrics()
+            if self._metrics_server is not None:
+                self._metrics_server.close()
+                self._metrics_server = None
+    
+    # -----------------------------------------------------------------------
+    # Everything we keep track of while posting. Things we count anyway are
+    # asked for when the metrics are updated, connections update the rest.
+    def setup_metrics(self):
+        metrics = Registry()
+        pools = lambda func: [({'server': pool.name}, func(pool)) for pool in self._pools]
+        pipeline = lambda func: func(self._pipeline) if self._pipeline is not None else 0
+        bufpool = lambda func: func(self._bufpool) if self._bufpool is not None else 0
+        
+        metrics.counter('newsmangler_bytes_sent_total', 'Bytes of articles sent',
+            func=lambda: self._bytes)
+        metrics.conn_bytes = metrics.counter('newsmangler_connection_bytes_sent_total',
+            'Bytes of articles sent by each connection', ('server', 'connection'))
+        metrics.counter('newsmangler_articles_posted_total', 'Articles the servers accepted',
+            func=lambda: self._posted)
+        metrics.counter('newsmangler_articles_failed_total', 'Articles we gave up on',
+            func=lambda: len(self._failed))
+        metrics.retried = metrics.counter('newsmangler_articles_retried_total',
+            'Failed articles queued to be tried again', ('server',))
+        metrics.gauge('newsmangler_articles_remaining', 'Articles not handed to a connection yet',
+            func=lambda: self.articles_left() if self._planner is not None else 0)
+        
+        metrics.gauge('newsmangler_ready_queue_depth', 'Encoded articles waiting for a connection',
+            func=lambda: pipeline(lambda p: p.ready_count()))
+        metrics.gauge('newsmangler_encode_queue_depth', 'Articles being encoded',
+            func=lambda: pipeline(lambda p: p.pending() - p.ready_count()))
+        metrics.counter('newsmangler_encoder_stall_seconds_total', 'Time spent waiting for the encoder',
+            func=lambda: pipeline(lambda p: p.encoder_stall))
+        metrics.counter('newsmangler_network_stall_seconds_total', 'Time the encoder spent waiting for connections',
+            func=lambda: pipeline(lambda p: p.network_stall))
+        metrics.encode_time = metrics.histogram('newsmangler_encode_seconds', 'Time taken to encode an article')
+        metrics.counter('newsmangler_buffer_pool_hits_total', 'Articles encoded into a buffer from the pool',
+            func=lambda: bufpool(lambda b: b.hits))
+        metrics.counter('newsmangler_buffer_pool_misses_total', 'Articles that needed a new buffer',
+            func=lambda: bufpool(lambda b: b.misses))
+        metrics.gauge('newsmangler_buffer_pool_free', 'Article buffers free to be encoded into',
+            func=lambda: bufpool(lambda b: b.available()))
+        
+        metrics.gauge('newsmangler_connections', 'Connections logged in to each server', ('server',),
+            func=lambda: pools(lambda pool: sum(conn.is_connected() for conn in pool.conns)))
+        metrics.gauge('newsmangler_connections_wanted', 'Connections we want to each server', ('server',),
+            func=lambda: pools(lambda pool: pool.target))
+        metrics.gauge('newsmangler_server_rate_bytes', 'Recent speed of each server per connection in bytes/s',
+            ('server',), func=lambda: pools(lambda pool: pool.rate or 0))
+        metrics.reconnects = metrics.counter('newsmangler_reconnects_total',
+            'Connections that were lost or failed to connect', ('server',))
+        metrics.responses = metrics.counter('newsmangler_responses_total', 'Responses from each server by code',
+            ('server', 'code'))
+        metrics.post_wait = metrics.histogram('newsmangler_post_wait_seconds',
+            'Time from sending POST to the 340 response', ('server',))
+        metrics.ack_wait = metrics.histogram('newsmangler_ack_wait_seconds',
+            'Time from sending an article to the server accepting or rejecting it', ('server',))
+        metrics.gauge('newsmangler_rate_limit_bytes', 'Bandwidth limit in bytes/s, 0 for none',
+            func=lambda: self.limiter.rate)
+        
+        return metrics
+    
+    def start_metrics_server(self):
+        port = self.conf['posting'].get('metrics_port', 0)
+        if not port:
+            return
+        if not HTTP_SUPPORT:
+            self.logger.warning('http.server is not available, not serving metrics')
+            return
+        
+        host = self.conf['posting'].get('metrics_host', '127.0.0.1')
+        try:
+            self._metrics_server = MetricsServer(self.metrics, host, port)
+        except OSError as msg:
+            self.logger.warning('Unable to serve metrics on %s:%s: %s', host, port, msg)
+        else:
+            self.logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+    
+    def update_metrics(self):
+        self.metrics.snapshot()
+        path = self.conf['posting'].get('metrics_file', '')
+        if path:
+            self.metrics.write(os.path.expanduser(path))
+    
+    def metrics_tick(self):
+        self.update_metrics()
+        self._metrics_timer = self._call_later(self.conf['posting'].get('metrics_interval', 5), self.metrics_tick)
+    
+    def start_metrics(self):
+        if self._metrics_server is not None or self.conf['posting'].get('metrics_file', ''):
+            self.metrics_tick()
+    
+    def stop_metrics(self):
+        if self._metrics_timer is not None:
+            self._metrics_timer.cancel()
+            self._metrics_timer = None
+    
+    # Change the bandwidth limit (bytes per second, 0 for none), this can be
+    # done while we're posting.
+    def set_rate_limit(self, rate):
+        if rate:
+            self.logger.info('Limiting the rate to %s/s', niceFileSize_str(rate))
+        else:
+            self.logger.info('Not limiting the rate')
+        self.limiter.set_rate(rate)
+        self._rate_since = (time.time(), self._bytes)
+        if self._coordinator is not None:
+            self._coordinator.set_rate_limit(rate)
+    
+    # Use the article size that did best for the server last time, or find
+    # one if we haven't yet.
+    def auto_article_size(self):
+        key = self._pools[0].key
+        article_size = self._state and self._state.get(key, 'article_size')
+        if article_size:
+            self.logger.info('Using an article size of %d for %s', article_size, key)
+            return article_size
+        
+        article_size = self.probe_article_size()
+        if self._state is not None:
+            self._state.set(key, article_size=article_size)
+        return article_size
+    
+    # Post posting/probe_bytes of junk to posting/probe_group with each of the
+    # probe sizes, and pick whichever got the most accepted by the servers
+    # each second. The connection count stays put while we do this.
+    def probe_article_size(self):
+        posting = self.conf['posting']
+        sizes = [int(size) for size in str(posting.get('probe_sizes', PROBE_SIZES)).split()]
+        self.logger.info('Trying article sizes of %s', ', '.join(str(size) for size in sizes))
+        
+        newsgroup, post_title, par2_redundancy = self.newsgroup, self.post_title, self._par2_redundancy
+        checksum_files, hashes, journal = self._checksum_files, self._hashes, self._journal
+        self.conf['posting'] = dict(posting, generate_nzbs=0, nzb_first=0)
+        self.newsgroup = posting.get('probe_group', 'alt.binaries.test')
+        self._par2_redundancy = 0
+        # Junk doesn't get checksum files or go in the journal
+        self._checksum_files, self._hashes, self._journal = [], [], None
+        self._probing = True
+        
+        fd, path = tempfile.mkstemp(prefix='newsmangler-probe-', suffix='.bin')
+        results = []
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(posting.get('probe_bytes', PROBE_BYTES)))
+            
+            for size in sizes:
+                self.conf['posting']['article_size'] = size
+                self.post_title = 'newsmangler probe %d' % (size)
+                self._post([path])
+                
+                goodput = sum(pool.bytes for pool in self._pools) / max(time.time() - self._start, 0.001)
+                self.logger.info('Article size %d: %s/s', size, niceFileSize_str(goodput))
+                results.append((goodput, size))
+        finally:
+            os.remove(path)
+            self.conf['posting'] = posting
+            self.newsgroup, self.post_title, self._par2_redundancy = newsgroup, post_title, par2_redundancy
+            self._checksum_files, self._hashes, self._journal = checksum_files, hashes, journal
+            self._probing = False
+            self._failed = []
+        
+        goodput, article_size = max(results)
+        if not goodput:
+            self.logger.warning('Nothing got posted while probing, using an article size of %d', DEFAULT_ARTICLE_SIZE)
+            return DEFAULT_ARTICLE_SIZE
+        
+        self.logger.info('Using an article size of %d', article_size)
+        return article_size
+    
+    def _post(self, postme):
+        self.reset_connections()
+        
+        # Work out what we need to post. Only the first lot of files gets
+        # scanned now, the rest are scanned as we run out of parts.
+        domain = self.conf['posting'].get('msgid_domain') or self.conf['server']['hostname']
+        self._planner = ArticlePlanner(self._build_article, MessageIDs(domain))
         self.generate_articleToPost_list(postme)
         
-        validArticlesAvailable = bool(self._articles)
+        if self.conf['posting']['generate_nzbs'] and self.conf['posting'].get('nzb_first', 0):
+            self.plan_nzbs()
+        
+        # PAR2 sets for files that were posted already still need posting
+        validArticlesAvailable = self._planner.scan() or self._par2_pending > 0
         if not validArticlesAvailable:
-            self.logger.warning('No valid articles to post!')
+            # We might be resuming something that finished already
+            if self._skipped:
+                self.logger.info('Everything has been posted already')
+                for dirname in list(self._checksums):
+                    self.finish_collection(dirname)
+            else:
+                self.logger.warning('No valid articles to post!')
             return
         
-        self.connect()
-
-        self.logger.info('Posting %d article(s)...', len(self._articles))
+        self._run()
+    
+    # Plan everything here and post it from `workers` processes, which
+    # tell us what they posted. Anything that needs to see every part being
+    # read can't be done that way.
+    def _post_sharded(self, postme, workers):
+        from newsmangler.workers import Coordinator
+        
+        if self._par2_redundancy:
+            self.logger.warning('PAR2 files can\'t be built with posting/workers, not generating them')
+            self._par2_redundancy = 0
+        if self._checksum_files:
+            self.logger.warning('Checksum files can\'t be built with posting/workers, not writing them')
+            self._checksum_files = []
+            self._hashes = []
+        if self.conf['posting'].get('nzb_first', 0):
+            self.logger.warning('NZBs can\'t be written first with posting/workers, writing them after')
+            self.conf['posting']['nzb_first'] = 0
+        
+        domain = self.conf['posting'].get('msgid_domain') or self.conf['server']['hostname']
+        self._planner = ArticlePlanner(self._build_article, MessageIDs(domain))
+        self.generate_articleToPost_list(postme)
+        
+        planned = self._planner.take_all()
+        if planned:
+            self._bytes = 0
+            self._posted = 0
+            self._start = time.time()
+            self._rate_since = (self._start, 0)
+            
+            self._coordinator = Coordinator(self, workers)
+            try:
+                self._coordinator.run(planned)
+            finally:
+                self._coordinator = None
+        elif self._skipped:
+            self.logger.info('Everything has been posted already')
+        else:
+            self.logger.warning('No valid articles to post!')
+        
+        self._filepool.close()
+        for dirname in list(self._checksums):
+            self.finish_collection(dirname)
+    
+    # A worker process posted a part for us
+    def part_posted(self, fileinfo, subject, partnum, msgid, article_size, posttime):
+        self._posted += 1
+        self._bytes += article_size
+        if self._journal is not None:
+            self._journal.part_done(fileinfo['journal'], partnum, article_size, msgid)
+        self.remember_msgid(fileinfo, subject, partnum, msgid, article_size, posttime)
+        self.collection_part_done(fileinfo['dirname'])
+    
+    # A worker process gave up on a part
+    def part_failed(self, fileinfo, subject, partnum):
+        if self.nzb_segments_wanted():
+            self.nzb_writer(fileinfo['dirname']).skip_segment(subject % (1), fileinfo['parts'])
+        self.collection_part_done(fileinfo['dirname'])
+    
+    # Post everything the planner has for us
+    def _run(self):
+        self.logger.info('Posting using %s...', self.engine)
 
-        # And post primary loop
         self._bytes = 0
-        last_stuff = start = time.time()
+        self._posted = 0
+        self._start = start = time.time()
+        self._rate_since = (start, 0)
+        cpu_start = time.process_time()
+        
+        self.start_buffer_pool()
+        if self.engine == 'asyncio':
+            asyncio.run(self._post_asyncio())
+        else:
+            self._post_asyncore()
+        
+        interval = time.time() - start
+        speed = self._bytes / interval
+        self.logger.info('Posting complete - %d article(s), %s in %s (%s/s)', self._posted,
+            niceFileSize_str(self._bytes), niceTime_str(interval), niceFileSize_str(speed))
+        
+        # CPU time for this process, encoder threads included, worker
+        # processes not.
+        cpu = time.process_time() - cpu_start
+        self.logger.info('Used %.2fs of CPU time (%s per CPU second)', cpu,
+            niceFileSize_str(self._bytes / max(cpu, 0.001)))
+        
+        # Counters see where this run got to before the next one starts
+        # them again
+        self.metrics.snapshot()
+        
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self.logger.info('Stalled %.1fs waiting for the encoder, %.1fs waiting for the network',
+                self._pipeline.encoder_stall, self._pipeline.network_stall)
+            self._pipeline = None
+        
+        if self._bufpool is not None:
+            self.logger.info('Article buffers: %d from the pool, %d allocated', self._bufpool.hits,
+                self._bufpool.misses)
+        
+        # How each server did
+        if len(self._pools) > 1:
+            for pool in self._pools:
+                self.logger.info('%s: %d article(s), %s (%s/s per connection), %d failure(s)',
+                    pool.name, pool.posted, niceFileSize_str(pool.bytes),
+                    niceFileSize_str(pool.rate or 0), pool.failed)
+        
+        self._filepool.close()
+        
+        # Let everyone know what didn't make it
+        if self._failed:
+            self.logger.error('%d article(s) could not be posted:', len(self._failed))
+            for article, reason in self._failed:
+                self.logger.error('  %s (%d attempt(s)) - %s', article.headers['Subject'],
+                    article.attempts, reason)
+        
+        # If we have some collections left over, we might have to finish off
+        # their NZBs and checksum files
+        for dirname in list(self._checksums):
+            self.finish_collection(dirname)
+    
+    # -----------------------------------------------------------------------
+    # Check that every segment in some NZBs is on the server, with pipelined
+    # STATs over a pool of connections. Returns [(path, entry, missing
+    # segments)] for the files that have any missing.
+    def verify(self, nzbpaths):
+        nzbs = []
+        for path in nzbpaths:
+            try:
+                nzbs.append((path, read_nzb(path)))
+            except (OSError, ValueError) as msg:
+                self.logger.error('Unable to read %s: %s', path, msg)
+        
+        msgids = [segment.msgid for path, entries in nzbs for entry in entries for segment in entry.segments]
+        if not msgids:
+            self.logger.warning('No segments to check!')
+            return []
+        
+        self.reset_connections()
+        pool = self._pools[0]
+        name = self.conf['posting'].get('verify_server', '')
+        if name in self._pools_by_name:
+            pool = self._pools_by_name[name]
+        elif name:
+            self.logger.warning('Unknown verify_server "%s", using %s instead', name, pool.name)
+        
+        self.logger.info('Checking %d segment(s) on %s...', len(msgids), pool.name)
+        start = time.time()
+        asyncio.run(self._verify_asyncio(pool, msgids))
+        interval = time.time() - start
+        self.logger.info('Checked %d segment(s) in %s (%.0f/s)', len(msgids), niceTime_str(interval),
+            len(msgids) / max(interval, 0.001))
+        
+        verifier = self.verifier
+        results = []
+        for path, entries in nzbs:
+            found = missing = unknown = 0
+            for entry in entries:
+                lost = [segment for segment in entry.segments if segment.msgid in verifier.missing]
+                unknown += sum(segment.msgid in verifier.unknown for segment in entry.segments)
+                found += len(entry.segments) - len(lost)
+                missing += len(lost)
+                if lost:
+                    self.logger.warning('  %s - %d of %d segment(s) missing', entry.subject, len(lost),
+                        len(entry.segments))
+                    results.append((path, entry, lost))
+                
+                # Segments that never made it into the NZB can't be checked
+                # or posted again, we don't know their Message-IDs.
+                total = entry.total()
+                if total and len(entry.segments) < total:
+                    self.logger.warning('  %s - %d segment(s) are not in the NZB', entry.subject,
+                        total - len(entry.segments))
+            
+            if unknown:
+                self.logger.info('%s: %d segment(s) found, %d missing, %d unable to check', path,
+                    found - unknown, missing, unknown)
+            else:
+                self.logger.info('%s: %d segment(s) found, %d missing', path, found, missing)
+        
+        for msgid, line in list(verifier.unknown.items())[:10]:
+            self.logger.warning('Unable to check %s - "%s"', msgid, line)
+        if len(verifier.unknown) > 10:
+            self.logger.warning('... and %d more', len(verifier.unknown) - 10)
+        
+        return results
+    
+    # Connections share the Message-IDs, everyone's done once they're gone
+    async def _verify_asyncio(self, pool, msgids):
+        self.verifier = Verifier(msgids)
+        self._all_done = self.verifier.finished
+        self._call_later = asyncio.get_running_loop().call_later
+        
+        self._tasks = set()
+        self._connclass = AioStat
+        self._start_connection = lambda conn: self._tasks.add(asyncio.ensure_future(conn.run()))
+        for i in range(pool.target):
+            self.add_connection(pool)
+        
+        status = asyncio.ensure_future(self._verify_status())
+        while self._tasks:
+            done, pending = await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                self._tasks.discard(task)
+                task.result()
+        status.cancel()
+        self._all_done = None
+    
+    async def _verify_status(self):
+        start = time.time()
+        total = self.verifier.remaining()
         while True:
-            now = time.time()
+            await asyncio.sleep(STATUS_INTERVAL)
+            left = self.verifier.remaining()
+            sys.stdout.write('%d segment(s) left to check - %.0f/s     \r' % (left,
+                (total - left) / max(time.time() - start, 0.001)))
+            sys.stdout.flush()
+    
+    # Verify some NZBs, then post whatever is missing again from the files in
+    # `sourcedirs`, with the Message-IDs in the NZB. Parts are found from the
+    # segment number and the article size, so that has to be what was used
+    # to post them. Returns the number of segments we couldn't post.
+    def repair(self, nzbpaths, sourcedirs):
+        results = self.verify(nzbpaths)
+        if not results:
+            self.logger.info('Nothing to repair')
+            return 0
+        
+        article_size = self.conf['posting']['article_size']
+        if article_size == 'auto':
+            article_size = self._state and self._state.get(self._pools[0].key, 'article_size')
+            if not article_size:
+                self.logger.error('Unable to tell which article size was used, set posting/article_size')
+                return sum(len(lost) for path, entry, lost in results)
+        
+        posting, par2_redundancy = self.conf['posting'], self._par2_redundancy
+        self.conf['posting'] = dict(posting, article_size=article_size, generate_nzbs=0, nzb_first=0)
+        self._par2_redundancy = 0
+        self._unrepaired = 0
+        self._failed = []
+        try:
+            self.reset_connections()
+            domain = self.conf['posting'].get('msgid_domain') or self.conf['server']['hostname']
+            self._planner = ArticlePlanner(self._build_article, MessageIDs(domain))
+            self._planner.add_source(self._plan_repair, results, sourcedirs)
+            if self._planner.scan():
+                self._run()
+        finally:
+            self.conf['posting'] = posting
+            self._par2_redundancy = par2_redundancy
+        
+        return self._unrepaired + len(self._failed)
+    
+    # Plan the missing parts of each file, as long as we can find it and it's
+    # the right size for the number of parts it was posted in.
+    def _plan_repair(self, results, sourcedirs):
+        article_size = self.conf['posting']['article_size']
+        
+        for path, entry, lost in results:
+            filename = entry.filename()
+            filePath = None
+            for dirname in sourcedirs:
+                if filename and os.path.isfile(os.path.join(dirname, filename)):
+                    filePath = os.path.abspath(os.path.join(dirname, filename))
+                    break
             
-            # Poll our sockets for events
-            self.pollSocketEvents()
+            subject = entry.subject_format()
+            if filePath is None or subject is None:
+                self.logger.error('Unable to find the file for %s, not reposting it', entry.subject)
+                self._unrepaired += len(lost)
+                continue
+            
+            fileSize = os.path.getsize(filePath)
+            parts = (fileSize + article_size - 1) // article_size
+            if parts != entry.total():
+                self.logger.error('%s is %d parts of %d bytes, but was posted in %d, not reposting it',
+                    filePath, parts, article_size, entry.total())
+                self._unrepaired += len(lost)
+                continue
+            
+            bogus = [segment for segment in lost if not 1 <= segment.number <= parts]
+            if bogus:
+                self.logger.warning('%s has %d segment(s) numbered past its %d part(s), skipping them',
+                    entry.subject, len(bogus), parts)
+                self._unrepaired += len(bogus)
+                lost = [segment for segment in lost if 1 <= segment.number <= parts]
+                if not lost:
+                    continue
+            
+            collection = os.path.basename(path)
+            fileinfo = {
+                    'dirname': collection,
+                    'filename': filename,
+                    'filepath': filePath,
+                    'filesize': fileSize,
+                    'parts': parts,
+                    'newsgroups': ','.join(entry.groups),
+                    'from': entry.poster,
+            }
+            
+            fileidx = self._planner.add_file(FileWrap(filePath, len(lost), self._filepool), fileinfo, subject)
+            self._parts_left[collection] = self._parts_left.get(collection, 0) + len(lost)
+            for segment in lost:
+                begin = (segment.number - 1) * article_size
+                self._planner.add_part(fileidx, segment.number, begin, min(fileSize, begin + article_size),
+                    segment.msgid)
+            self.logger.info('Reposting %d segment(s) of %s', len(lost), filePath)
+    
+    # -----------------------------------------------------------------------
+    # Start a journal of posted parts if we're asked to keep one, or pick up
+    # an old one if we're resuming.
+    def open_journal(self):
+        path = self.conf['posting'].get('journal', '')
+        resume = self.conf['posting'].get('resume', False)
+        if not path:
+            if resume:
+                self.logger.warning('Unable to resume without a journal, set posting/journal or use -j!')
+            return
+        
+        self._journal = Journal(os.path.expanduser(path), resume,
+            self.conf['posting'].get('journal_sync', 1))
+    
+    # Post primary loop for the asyncore engine
+    def _post_asyncore(self):
+        from newsmangler.asyncnntp import AsyncNNTP
+        
+        self.connect(AsyncNNTP, AsyncNNTP.do_connect)
+        
+        self.start_pipeline(self.loop.call_soon_threadsafe)
+        self._call_later = self.loop.call_later
+        self.start_adapting()
+        self.start_metrics()
+        
+        self._status_timer = self.loop.call_later(STATUS_INTERVAL, self.status_update)
+        while True:
+            # Connections we're getting rid of can go once they're done
+            for conn in [conn for conn in self._idle if conn.retiring and conn.in_flight() == 0]:
+                conn.shutdown()
             
             # Possibly post some more parts now
-            while self._idle and self._articles:
-                conn = self._idle.pop(0)
-                article = self._articles.pop(0)
+            while self._idle:
+                # The best connection that will take something gets it
+                now = time.time()
+                for conn in sorted(self._idle, key=lambda conn: self.preference(conn.pool, now)):
+                    article = self.next_article(conn)
+                    if article is not None:
+                        break
+                else:
+                    break
+                self._idle.remove(conn)
                 conn.post_article(article)
             
-            # Do some stuff every now and then
-            if now - last_stuff >= 0.5:
-                last_stuff = now
-                
-                for conn in self._conns:
-                    conn.reconnect_check(now)
-                
-                if self._bytes:
-                    interval = now - start
-                    speed = self._bytes / interval / 1024
-                    left = len(self._articles) + (len(self._conns) - len(self._idle))
-                    sys.stdout.write('%d article(s) remaining - %.1fKB/s     \r' % (left, speed))
-                    sys.stdout.flush()
-            
-            # All done?            
-            allWorkersIdle = ( len(self._idle) == self.conf['server']['connections'])
-            ArticlesLeft = ( len(self._articles) != 0 )
+            # All done? Connections that are reconnecting don't count, they
+            # put anything they were posting back in the queue.
+            allWorkersIdle = ( sum(conn.in_flight() for conn in self._conns) == 0 )
+            ArticlesLeft = self.has_work()
             if not ArticlesLeft and allWorkersIdle:
-                interval = time.time() - start
-                speed = self._bytes / interval
-                self.logger.info('Posting complete - %s in %s (%s/s)',
-                    niceFileSize_str(self._bytes), niceTime_str(interval), niceFileSize_str(speed))
-                
-                # If we have some msgids left over, we might have to generate
-                # a .NZB
-                if self.conf['posting']['generate_nzbs'] and self._msgids:
-                    self.generate_nzb()
-                
+                self._status_timer.cancel()
                 break
             
-            # And sleep for a bit to try and cut CPU chompage
-            time.sleep(0.01)
-    
-    def remember_msgid(self, article_size, article):
-        if self.conf['posting']['generate_nzbs']:
-            if self._current_dir != article._fileinfo['dirname']:
-                if self._msgids:
-                    self.generate_nzb()
-                    self._msgids = {}
-                
-                self._current_dir = article._fileinfo['dirname']
+            # Wait until a socket is ready or a timer is due
+            self.loop.run_once()
+        
+        self.stop_adapting()
+        self.stop_metrics()
+        for conn in list(self._conns):
+            conn.shutdown()
+    
+    # Post primary loop for the asyncio engine, one task per connection
+    async def _post_asyncio(self):
+        from newsmangler.aionntp import AioNNTP
+        
+        # Connections wait on this when the encoder hasn't caught up yet
+        self._article_ready = asyncio.Event()
+        self._all_done = asyncio.Event()
+        self.start_pipeline(asyncio.get_running_loop().call_soon_threadsafe)
+        self._call_later = asyncio.get_running_loop().call_later
+        self._call_soon_threadsafe = asyncio.get_running_loop().call_soon_threadsafe
+        if self._pipeline is not None:
+            self._pipeline.on_ready = self._article_ready.set
+        
+        # Connections can come and go as we post
+        self._tasks = set()
+        self.connect(AioNNTP, lambda conn: self._tasks.add(asyncio.ensure_future(conn.run())))
+        self.start_adapting()
+        self.start_metrics()
+        
+        status = asyncio.ensure_future(self._status_asyncio())
+        while self._tasks:
+            done, pending = await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                self._tasks.discard(task)
+                task.result()
+        status.cancel()
+        self.stop_adapting()
+        self.stop_metrics()
+    
+    async def _status_asyncio(self):
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            self.status_line(sum(conn.in_flight() for conn in self._conns))
+    
+    # -----------------------------------------------------------------------
+    # Start encoding articles ahead of the connections, if we've been asked to
+    def start_pipeline(self, call_soon_threadsafe):
+        workers = self.conf['posting'].get('encoder_workers', 2)
+        if not workers:
+            return
+        
+        connections = sum(max(pool.target, pool.max_connections) for pool in self._pools)
+        depth = self.conf['posting'].get('encoder_queue', connections + workers)
+        use_processes = (self.conf['posting'].get('encoder_pool', 'thread') == 'process')
+        
+        self._pipeline = EncodePipeline(self._planner, workers, depth, use_processes, call_soon_threadsafe,
+            self._bufpool)
+        self._pipeline.on_failed = self.prepare_failed
+        if self._bufpool is not None:
+            self._bufpool.on_free = self._pipeline.buffer_freed
+        self._pipeline.fill()
+    
+    # Buffers to encode articles into, enough for the encoder queue and every
+    # article the connections can have in flight unless posting/buffer_pool
+    # says otherwise. Only connections that might stream have more than one
+    # in flight. Articles prepared in worker processes don't use them.
+    def start_buffer_pool(self):
+        self._bufpool = None
+        count = self.conf['posting'].get('buffer_pool', 'auto')
+        if not count or self.conf['posting'].get('encoder_pool', 'thread') == 'process':
+            return
+        
+        if count == 'auto':
+            workers = self.conf['posting'].get('encoder_workers', 2)
+            connections = sum(max(pool.target, pool.max_connections) for pool in self._pools)
+            count = 0
+            for pool in self._pools:
+                window = 1
+                if pool.conf.get('streaming', 'auto'):
+                    window = pool.conf.get('stream_window', 8)
+                count += max(pool.target, pool.max_connections) * window
+            if workers:
+                count += self.conf['posting'].get('encoder_queue', connections + workers)
+        
+        size = yenc.yEncodeBufferSize(self.conf['posting']['article_size'])
+        self._bufpool = BufferPool(count, size)
+    
+    # Get the next article for `conn` to post, None if there isn't one ready
+    # right now or another server should get it. Articles that are due to be
+    # tried again go first.
+    def next_article(self, conn=None):
+        while self._par2_finished:
+            self.plan_par2(*self._par2_finished.popleft())
+        
+        self._deferred = False
+        if conn is not None and not self.may_take(conn):
+            return None
+        
+        if self._retries and self._retries[0][0] <= time.time() and self.retry_here(self._retries[0][2], conn):
+            article = heapq.heappop(self._retries)[2]
+        elif self._pipeline is not None:
+            article = self._pipeline.get()
+        else:
+            article = self._planner.next_article()
+        
+        if article is not None and conn is not None:
+            conn.pool.dispatched += 1
+            article.server = conn.pool.name
+            article.dispatched_at = time.time()
+        return article
+    
+    # Get the next article to post, waiting for the encoder if we have to.
+    # Returns None once there's nothing left.
+    async def next_article_async(self, conn=None):
+        while True:
+            article = self.next_article(conn)
+            if article is not None or not self.has_work() or (conn is not None and conn.retiring):
+                return article
+            
+            # A better connection was woken up to take it, let it run
+            if self._deferred:
+                await asyncio.sleep(0)
+                continue
             
-            subj = article._subject % (1)
-            if subj not in self._msgids:
-                self._msgids[subj] = [int(time.time())]
-            #self._msgids[subj].append((article.headers['Message-ID'], article_size))
-            self._msgids[subj].append((article, article_size))
+            self._waiting.add(conn)
+            self._article_ready.clear()
+            try:
+                await self._article_ready.wait()
+            finally:
+                self._waiting.discard(conn)
+    
+    # -----------------------------------------------------------------------
+    # How much we'd like to give work to a server, lower is better: servers
+    # that are failing, then slow ones, go last. Otherwise they take turns
+    # by weight.
+    def preference(self, pool, now):
+        best_rate = max([p.rate for p in self._pools if p.rate] or [0])
+        return (pool.rank(now, best_rate), pool.load())
+    
+    # Should this connection get an article right now? Servers that keep
+    # failing get nothing while anyone else can post, and if a connection to
+    # a better server is waiting for something to do it goes there.
+    def may_take(self, conn):
+        if conn.retiring:
+            return False
+        if len(self._pools) == 1:
+            return True
+        
+        now = time.time()
+        mine = self.preference(conn.pool, now)
+        if mine[0] == RANK_PENALISED:
+            for pool in self._pools:
+                if pool.connected() and self.preference(pool, now)[0] != RANK_PENALISED:
+                    return False
+        
+        if not self.new_article_ready():
+            return True
+        
+        # Whoever we hand it over to will take it, unless they've been
+        # penalised too.
+        waiting = self._idle if self.engine == 'asyncore' else self._waiting
+        for other in waiting:
+            theirs = self.preference(other.pool, now)
+            if other.pool is not conn.pool and theirs[0] != RANK_PENALISED and theirs < mine:
+                self._deferred = True
+                self.retry_ready()
+                return False
+        return True
+    
+    # Is a new article ready to go right now? Retries aren't handed over,
+    # retry_here() decides where those go.
+    def new_article_ready(self):
+        if self._pipeline is not None:
+            return self._pipeline.ready()
+        return self._planner.has_more()
+    
+    # Articles that failed on a server go to a different one if they can
+    def retry_here(self, article, conn):
+        if conn is None or conn.pool.name not in article.failed_on:
+            return True
+        
+        now = time.time()
+        for pool in self._pools:
+            if pool.name not in article.failed_on and pool.connected() and \
+                    self.preference(pool, now)[0] != RANK_PENALISED:
+                return False
+        return True
+    
+    # Number of articles we know about that haven't been handed to a
+    # connection yet
+    def articles_left(self):
+        left = self._planner.remaining() + len(self._retries)
+        if self._pipeline is not None:
+            left += self._pipeline.pending()
+        return left
+    
+    # Is there anything left that hasn't been handed to a connection yet?
+    def has_work(self):
+        return (self._planner.has_more() or len(self._retries) > 0 or self._par2_pending > 0 or
+            (self._pipeline is not None and self._pipeline.pending() > 0))
+    
+    # -----------------------------------------------------------------------
+    # A connection posted an article
+    def post_success(self, article):
+        self._posted += 1
+        
+        msgid = article.headers['Message-ID']
+        article_size = article.prepared_size()
+        self.metrics.encode_time.observe(article.encode_time)
+        pool = self._pools_by_name.get(article.server)
+        if pool is not None:
+            pool.post_ok(article_size, time.time() - article.dispatched_at)
+        
+        if self._journal is not None:
+            self._journal.part_done(article._fileinfo['journal'], article._partnum, article_size, msgid)
+        
+        self.remember_msgid(article._fileinfo, article._subject, article._partnum, msgid,
+            article_size, int(time.time()))
+        self.article_done(article)
+    
+    # Do we still want to hear about segments for the NZBs?
+    def nzb_segments_wanted(self):
+        return self.conf['posting']['generate_nzbs'] and not self._nzbs_written
+    
+    # Remember the Message-ID of a posted part for the NZB
+    def remember_msgid(self, fileinfo, subject, partnum, msgid, article_size, posttime):
+        if self.nzb_segments_wanted():
+            self.nzb_writer(fileinfo['dirname']).add_segment(subject % (1), fileinfo['parts'],
+                partnum, msgid, article_size, posttime)
+    
+    # A connection couldn't post an article. Try it again later, waiting
+    # longer each time, until we run out of attempts.
+    def post_failed(self, article, reason, retry=True):
+        if article.is_prepared():
+            self.metrics.encode_time.observe(article.encode_time)
+        article.release()
+        article.attempts += 1
+        
+        pool = self._pools_by_name.get(article.server)
+        if pool is not None:
+            if pool.name not in article.failed_on:
+                article.failed_on += (pool.name,)
+            # Wake things up when the server can have work again
+            penalty = pool.post_failed(time.time())
+            if penalty:
+                self._call_later(penalty, self.retry_ready)
+        
+        if not retry or article.attempts >= self.conf['posting'].get('retry_attempts', 5):
+            self.logger.warning('Giving up on %s after %d attempt(s)', article.headers['Subject'],
+                article.attempts)
+            self._failed.append((article, reason))
+            if self.nzb_segments_wanted():
+                self.nzb_writer(article._fileinfo['dirname']).skip_segment(article._subject % (1),
+                    article._fileinfo['parts'])
+            self.article_done(article)
+            return
+        
+        # Exponential backoff with some jitter, so connections that failed
+        # at the same time don't all try again at the same time.
+        delay = self.conf['posting'].get('retry_delay', 2) * 2 ** (article.attempts - 1)
+        delay = min(delay, self.conf['posting'].get('retry_max_delay', 120))
+        delay *= random.uniform(0.5, 1.5)
+        self.logger.info('Trying %s again in %.1fs', article.headers['Subject'], delay)
+        
+        self.metrics.retried.labels(server=article.server or '').inc()
+        
+        self._retry_seq += 1
+        heapq.heappush(self._retries, (time.time() + delay, self._retry_seq, article))
+        self._call_later(delay, self.retry_ready)
+    
+    # The encoder couldn't prepare an article. Reading the file again isn't
+    # going to go any better, give up on it so the collection can finish.
+    # The PAR2 set for it can't be finished without that part either.
+    def prepare_failed(self, article, reason):
+        fileinfo = article._fileinfo
+        builder = self._par2_builders.get(fileinfo['dirname'])
+        if builder is not None and builder.part_failed(fileinfo['filepath'], article._begin, article._end):
+            self.logger.warning('Not generating PAR2 files for "%s", part of %s could not be read',
+                fileinfo['dirname'], fileinfo['filename'])
+        self.post_failed(article, reason, retry=False)
+    
+    def retry_ready(self):
+        # asyncio connections might be waiting for an article
+        if self._article_ready is not None:
+            self._article_ready.set()
+    
+    # We're finished with an article one way or another
+    def article_done(self, article):
+        self.collection_part_done(article._fileinfo['dirname'])
+    
+    # Once a collection has no articles left we can write out its NZB
+    def collection_part_done(self, dirname):
+        self._parts_left[dirname] -= 1
+        if self._parts_left[dirname] == 0:
+            del self._parts_left[dirname]
+            self.finish_collection(dirname)
+        
+        # Let asyncio connections waiting to reconnect, or for an article,
+        # know if that was the last one.
+        if self._all_done is not None and not self.has_work():
+            self._all_done.set()
+            self._article_ready.set()
+    
+    # Update the status line every now and then
+    def status_update(self):
+        self.status_line(sum(conn.in_flight() for conn in self._conns))
+        self._status_timer = self.loop.call_later(STATUS_INTERVAL, self.status_update)
     
+    def status_line(self, busy):
+        if self._bytes:
+            interval = time.time() - self._start
+            speed = self._bytes / interval / 1024
+            left = self.articles_left() + busy
+            if self.limiter.rate:
+                since, nbytes = self._rate_since
+                speed = (self._bytes - nbytes) / max(time.time() - since, 0.001) / 1024
+                sys.stdout.write('%d article(s) remaining - %.1fKB/s of %.1fKB/s     \r' % (left, speed,
+                    self.limiter.rate / 1024))
+            else:
+                sys.stdout.write('%d article(s) remaining - %.1fKB/s     \r' % (left, speed))
+            sys.stdout.flush()
+    
+    # Should connections to this server use streaming? None means we don't
+    # know yet and they should ask.
+    def streaming_for(self, server, host, port):
+        setting = server.get('streaming', 'auto')
+        if setting == 'auto':
+            return self._streaming.get((host, port))
+        return bool(setting)
+    
+    def remember_streaming(self, host, port, streaming):
+        if (host, port) not in self._streaming:
+            self.logger.info('%s:%s %s streaming', host, port, streaming and 'supports' or 'does not support')
+        self._streaming[(host, port)] = streaming
+    
+    # Add the things we need to post to the planner, they get scanned later
     def generate_articleToPost_list(self, filesToPost):
         if self.post_title:
             # "files" mode is just one lot of files
-            self._gal_prepare_files(
-                    postTitle = self.post_title, 
-                    files = filesToPost)
+            self._planner.add_source(self._gal_prepare_files, self.post_title, filesToPost)
         else:
             # "dirs" mode could be a whole bunch
             for dirName in filesToPost:
@@ -210,16 +1230,32 @@ class PostMangler:
                 if not dirName:
                     continue
                 
-                self._gal_prepare_files(
-                        postTitle = os.path.basename(dirName), 
-                        files = os.listdir(dirName), 
-                        basePath = dirName)
+                self._planner.add_source(self._gal_prepare_dir, dirName)
+    
+    def _gal_prepare_dir(self, dirName):
+        self._gal_prepare_files(
+                postTitle = os.path.basename(dirName), 
+                files = os.listdir(dirName), 
+                basePath = dirName)
     
     # Do the heavy lifting for generate_articleToPost_list
     def _gal_prepare_files(self, postTitle, files, basePath=''):
         article_size = self.conf['posting']['article_size']
         
         goodFiles = self.filterGoodFiles(files, basePath)
+        planned = self._planner.total
+        skipped = 0
+        
+        # PAR2 volumes get posted once they're built, after everything else,
+        # but they count towards the number of files.
+        builder = self.start_par2(postTitle, goodFiles)
+        fileCount = len(goodFiles)
+        filenNumberFormatter = '%%0%sd' % len(str(len(files)))
+        if builder is not None:
+            fileCount += len(builder.volumes)
+            filenNumberFormatter = '%%0%sd' % len(str(len(files) + len(builder.volumes)))
+            builder.on_done = lambda builder, ok: self.par2_done(postTitle, builder, ok,
+                len(goodFiles) + 1, fileCount, filenNumberFormatter)
         
         # Do stuff with files
         n = 1
@@ -228,42 +1264,208 @@ class PostMangler:
             if partial:
                 parts += 1
             
-            self._files[filePath] = FileWrap(filePath, parts)
-
             # Build a subject
             real_filename = os.path.split(fileName)[1]
-            
-            filenNumberFormatter = '%%0%sd' % len(str(len(files)))
             fileNum = filenNumberFormatter % n
+            subject = self.make_subject(postTitle, fileNum, fileCount, real_filename, parts)
             
-            partCountFormatter = '%%0%sd' % len(str(parts))
-            subject = '%s [%s/%d] - "%s" yEnc (%s/%d)' % (
-                postTitle, fileNum, len(goodFiles), real_filename, partCountFormatter, parts
-            )
-            
-            # Apply a subject prefix
-            if self.conf['posting']['subject_prefix']:
-                subject = '%s %s' % (self.conf['posting']['subject_prefix'], subject)
+            watcher = None
+            if builder is not None:
+                watcher = builder.feeder(filePath)
             
-            # Now make up our parts
-            fileinfo = {
+            skipped += self._plan_file(postTitle, filePath, real_filename, fileSize, parts, subject, watcher)
+            n += 1
+        
+        self._skipped += skipped
+        if skipped:
+            self.logger.info('Planned %d article(s) in %d file(s) for "%s", %d posted already',
+                self._planner.total - planned, len(goodFiles), postTitle, skipped)
+        elif goodFiles:
+            self.logger.info('Planned %d article(s) in %d file(s) for "%s"',
+                self._planner.total - planned, len(goodFiles), postTitle)
+    
+    def make_subject(self, postTitle, fileNum, fileCount, filename, parts):
+        partCountFormatter = '%%0%sd' % len(str(parts))
+        subject = '%s [%s/%d] - "%s" yEnc (%s/%d)' % (
+            postTitle, fileNum, fileCount, filename, partCountFormatter, parts
+        )
+        
+        # Apply a subject prefix
+        if self.conf['posting']['subject_prefix']:
+            subject = '%s %s' % (self.conf['posting']['subject_prefix'], subject)
+        
+        return subject
+    
+    # Make up the parts for a file. Returns how many were skipped because
+    # the journal says they were posted already. watcher(begin, data) gets
+    # to see every part of the file as it's read.
+    def _plan_file(self, postTitle, filePath, real_filename, fileSize, parts, subject, watcher=None):
+        article_size = self.conf['posting']['article_size']
+        now = int(time.time())
+        skipped = 0
+        
+        # The whole file CRC32 comes from the part CRC32s as they're encoded,
+        # any hashes from the data as it's read.
+        checksum = FileChecksum(real_filename, fileSize, self._hashes)
+        self._checksums.setdefault(postTitle, []).append(checksum)
+        if self._hashes:
+            watcher = chain_watchers(watcher, checksum.feed)
+        
+        fileinfo = {
                 'dirname': postTitle,
                 'filename': real_filename,
                 'filepath': filePath,
                 'filesize': fileSize,
                 'parts': parts,
-            }
-            self.logger.debug("fileInfo: %s" % str(fileinfo))
+        }
+        self.logger.debug("fileInfo: %s" % str(fileinfo))
+        fileinfo['checksum'] = checksum
+        
+        # Skip any parts the journal says were posted already
+        done = {}
+        if self._journal is not None:
+            key, identity = file_identity(filePath, fileSize)
+            fileinfo['journal'] = key
+            self._journal.add_file(key, identity)
+            done = self._journal.done_parts(key)
+        
+        fileidx = self._planner.add_file(FileWrap(filePath, parts - len(done), self._filepool, watcher), fileinfo, subject)
+        self._parts_left[postTitle] = self._parts_left.get(postTitle, 0) + parts - len(done)
+        for i in range(parts):
+            partnum = i + 1
+            begin = i * article_size
+            end = min(fileSize, partnum * article_size)
+            
+            if partnum in done:
+                record = done[partnum]
+                # Parts posted last time only get read again if something
+                # needs to see them, the CRC32 might as well come along.
+                if watcher is not None:
+                    data = self._filepool.read(filePath, begin, end)
+                    watcher(begin, data)
+                    checksum.add_crc(begin, end - begin, zlib.crc32(data))
+                self.remember_msgid(fileinfo, subject, partnum, record['msgid'], record['bytes'], record['time'])
+                skipped += 1
+                continue
+            
+            msgid = self._planner.add_part(fileidx, partnum, begin, end)
+            
+            # We don't know how big the article will be yet, the part size
+            # will have to do.
+            if self._nzb_planning:
+                self.remember_msgid(fileinfo, subject, partnum, msgid, end - begin, now)
+        
+        # Nothing else is going to read this one
+        if watcher is not None and len(done) == parts:
+            self._filepool.forget(filePath)
+        
+        return skipped
+    
+    # Scan everything and write out the NZBs before we post anything. Each
+    # NZB then gets posted as the last file of its collection.
+    def plan_nzbs(self):
+        self._nzb_planning = True
+        self._planner.scan_all()
+        self._nzb_planning = False
+        self._nzbs_written = True
+        
+        article_size = self.conf['posting']['article_size']
+        for dirname in list(self._nzbs):
+            filename = self._nzbs.pop(dirname).close()
+            if not filename:
+                continue
+            self.logger.info('Generated the nzb file %s before posting', filename)
+            
+            filePath = os.path.abspath(filename)
+            fileSize = os.path.getsize(filePath)
+            parts = max(1, (fileSize + article_size - 1) // article_size)
+            
+            partCountFormatter = '%%0%sd' % len(str(parts))
+            subject = '%s - "%s" yEnc (%s/%d)' % (dirname, filename, partCountFormatter, parts)
+            if self.conf['posting']['subject_prefix']:
+                subject = '%s %s' % (self.conf['posting']['subject_prefix'], subject)
             
-            for i in range(parts):
-                partnum = i + 1
-                begin = i * article_size
-                end = min(fileSize, partnum * article_size)
+            self._skipped += self._plan_file(dirname, filePath, filename, fileSize, parts, subject)
+    
+    # -----------------------------------------------------------------------
+    # Make sure we can build PAR2 sets the way we've been asked to
+    def check_par2(self):
+        article_size = self.conf['posting']['article_size']
+        block_size = self.conf['posting'].get('par2_block_size', 0) or article_size
+        
+        if not par2.HAVE_NUMPY:
+            self.logger.warning('PAR2 generation needs NumPy, not generating PAR2 files')
+        elif block_size % 4 or article_size % block_size:
+            self.logger.warning('par2_block_size must be a multiple of 4 that article_size is a multiple of, '
+                'not generating PAR2 files')
+        elif self.conf['posting'].get('nzb_first', 0):
+            self.logger.warning('PAR2 files are built while posting, they can\'t go in an NZB made before '
+                'posting. Not generating PAR2 files')
+        else:
+            self._par2_block_size = block_size
+            return
+        
+        self._par2_redundancy = 0
+    
+    # Start building a PAR2 set for a collection, if we're doing that
+    def start_par2(self, postTitle, goodFiles):
+        if not self._par2_redundancy or not goodFiles:
+            return None
+        
+        if self._par2_executor is None:
+            workers = self.conf['posting'].get('par2_workers', 0) or os.cpu_count() or 1
+            self._par2_executor = ProcessPoolExecutor(max_workers=workers)
+            self._par2_workers = workers
+            # Get the workers going now, before there are encoder threads
+            # around to fork.
+            for i in range(workers):
+                self._par2_executor.submit(par2.gf_tables)
+        
+        basepath = os.path.join(self.conf['posting'].get('par2_dir', ''), safeFilename(postTitle))
+        try:
+            builder = par2.Par2Builder(basepath, [(filePath, fileName, fileSize)
+                for filePath, fileName, fileSize in goodFiles], self._par2_block_size,
+                self._par2_redundancy, self._par2_executor, self._par2_workers)
+        except ValueError as msg:
+            self.logger.warning('Not generating PAR2 files for "%s": %s', postTitle, msg)
+            return None
+        
+        # The collection isn't finished until the volumes are posted
+        self._par2_builders[postTitle] = builder
+        self._par2_pending += 1
+        self._parts_left[postTitle] = self._parts_left.get(postTitle, 0) + 1
+        return builder
+    
+    # Called from the thread that wrote a PAR2 set, the posting loop picks
+    # it up in next_article().
+    def par2_done(self, *args):
+        self._par2_finished.append(args)
+        self._call_soon_threadsafe(self.retry_ready)
+    
+    # Plan the PAR2 volumes as the last files of their collection
+    def plan_par2(self, postTitle, builder, ok, n, fileCount, filenNumberFormatter):
+        self._par2_pending -= 1
+        self._par2_builders.pop(postTitle, None)
+        
+        if ok:
+            article_size = self.conf['posting']['article_size']
+            planned = self._planner.total
+            skipped = 0
+            for path, start, count in builder.volumes:
+                filePath = os.path.abspath(path)
+                fileName = os.path.basename(path)
+                fileSize = os.path.getsize(filePath)
+                parts = (fileSize + article_size - 1) // article_size
                 
-                article = self._build_article(self._files[filePath], begin, end, fileinfo, subject, partnum)
-                self._articles.append(article)
+                subject = self.make_subject(postTitle, filenNumberFormatter % n, fileCount, fileName, parts)
+                skipped += self._plan_file(postTitle, filePath, fileName, fileSize, parts, subject)
+                n += 1
             
-            n += 1
+            self._skipped += skipped
+            self.logger.info('Planned %d article(s) in %d PAR2 file(s) for "%s"',
+                self._planner.total - planned, len(builder.volumes), postTitle)
+        
+        self.collection_part_done(postTitle)
     
     def filterGoodFiles(self, files, basePath):
         goodFiles = []
@@ -285,63 +1487,75 @@ class PostMangler:
         return goodFiles
     
     # Build an article for posting.
-    def _build_article(self, fileWrapper, begin, end, fileinfo, subject, partnum):
-        art = Article(fileWrapper, begin, end, fileinfo, subject, partnum)
+    def _build_article(self, fileWrapper, begin, end, fileinfo, subject, partnum, msgid):
+        art = Article(fileWrapper, begin, end, fileinfo, subject, partnum, self._bufpool)
         
-        art.headers['From'] = self.conf['posting']['from']
-        art.headers['Newsgroups'] = self.newsgroup
+        # Parts being posted again go where they went the first time
+        art.headers['From'] = fileinfo.get('from') or self.conf['posting']['from']
+        art.headers['Newsgroups'] = fileinfo.get('newsgroups') or self.newsgroup
         art.headers['Subject'] = subject % (partnum)
-        art.headers['Message-ID'] = '<%.5f.%d@%s>' % (time.time(), partnum, self.conf['server']['hostname'])
+        art.headers['Message-ID'] = msgid
         art.headers['X-Newsposter'] = 'newsmangler %s (%s) - https://github.com/madcowfred/newsmangler\r\n' % (
             NM_VERSION, yenc.yEncMode())
 
         return art
     
     # -----------------------------------------------------------------------
-    # Generate a .NZB file!
-    def generate_nzb(self):
-        filename = 'newsmangler_%s.nzb' % safeFilename(self._current_dir)
-
-        self.logger.debug('Begin generation of %s', filename)
-
-        gentime = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())
-        root = ET.Element('nzb')
-        root.append( ET.Comment('Generated by newsmangler v%s at %s' % (NM_VERSION, gentime)) )
-
-        for subject, msgids in self._msgids.items():
-            posttime = msgids.pop(0)
-
-            # file
-            f = ET.SubElement(root, 'file',
-                {
-                    'poster': self.conf['posting']['from'],
-                    'date': str(posttime),
-                    'subject': subject,
-                }
-            )
+    # Get the NZB writer for a collection, files get written to it as soon
+    # as all of their parts are done.
+    def nzb_writer(self, dirname):
+        writer = self._nzbs.get(dirname)
+        if writer is None:
+            filename = 'newsmangler_%s.nzb' % safeFilename(dirname)
+            compress = self.conf['posting'].get('nzb_gzip', 0)
+            if compress:
+                filename += '.gz'
             
-            # newsgroups
-            groups = ET.SubElement(f, 'groups')
-            for newsgroup in self.newsgroup.split(','):
-                group = ET.SubElement(groups, 'group')
-                group.text = newsgroup
+            self.logger.debug('Begin generation of %s', filename)
+            writer = self._nzbs[dirname] = NZBWriter(filename, self.conf['posting']['from'],
+                self.newsgroup.split(','), compress)
+        
+        return writer
+    
+    # Finish off the .NZB file for a collection! The checksums we're writing
+    # files for go in its <head> too, as "HASH *filename".
+    def generate_nzb(self, dirname, checksums=()):
+        meta = []
+        for kind in self._checksum_files:
+            for checksum in checksums:
+                if kind == 'sfv':
+                    meta.append(('crc32', checksum.crc32(), checksum.filename))
+                else:
+                    meta.append((kind, checksum.hexdigest(CHECKSUM_FILES[kind]), checksum.filename))
+        
+        filename = self._nzbs.pop(dirname).close([(kind, '%s *%s' % (value, name))
+            for kind, value, name in meta if value is not None])
+        if filename:
+            self.logger.info('Successfully generated the nzb file %s', filename)
+    
+    # Write the checksum files for a collection
+    def write_checksums(self, dirname, checksums):
+        for kind in self._checksum_files:
+            filename = 'newsmangler_%s.%s' % (safeFilename(dirname), kind)
+            try:
+                written = write_checksum_file(filename, kind, checksums,
+                    'Generated by newsmangler v%s' % (NM_VERSION))
+            except OSError as msg:
+                self.logger.error('Unable to write %s: %s', filename, msg)
+                continue
             
-            # segments
-            segments = ET.SubElement(f, 'segments')
-            temp = [(m._partnum, m, article_size) for m, article_size in msgids]
-            temp.sort()
-            for partnum, article, article_size in temp:
-                segment = ET.SubElement(segments, 'segment',
-                    {
-                        'bytes': str(article_size),
-                        'number': str(partnum),
-                    }
-                )
-                segment.text = str(article.headers['Message-ID'][1:-1])
-
-        with open(filename, 'wb') as nzbfile:
-            ET.ElementTree(root).write(nzbfile, xml_declaration=True)
-
-        self.logger.info('Successfully generated the nzb file %s', filename)
+            if written:
+                self.logger.info('Successfully generated the %s file %s', kind.upper(), filename)
+            if written < len(checksums):
+                self.logger.warning('%d file(s) left out of %s, not all of their parts were read',
+                    len(checksums) - written, filename)
+    
+    # Every article in a collection is done with
+    def finish_collection(self, dirname):
+        checksums = self._checksums.pop(dirname, [])
+        if checksums:
+            self.write_checksums(dirname, checksums)
+        if dirname in self._nzbs:
+            self.generate_nzb(dirname, checksums)
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,163 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""A bandwidth limit shared by all of our connections."""
+
+import logging
+import socket
+import sys
+import time
+
+# ---------------------------------------------------------------------------
+
+# Linux has had SO_MAX_PACING_RATE since 3.13, Python just doesn't know the
+# number. The kernel takes a u32 of bytes per second, all ones is no limit.
+SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE',
+    47 if sys.platform.startswith('linux') else None)
+PACING_UNLIMITED = 0xffffffff
+
+# With our own token bucket each connection gets to send PACING_SLICE
+# seconds worth of its share at a time, and never less than PACING_MIN
+# bytes. The bucket holds BURST_TIME seconds worth at most.
+PACING_SLICE = 0.01
+PACING_MIN = 4096
+BURST_TIME = 0.05
+
+# ---------------------------------------------------------------------------
+
+class RateLimiter:
+    """A token bucket shared by every connection, rate is in bytes per
+    second and 0 means no limit. Connections ask allow() how much they can
+    send and tell used() how much they did. Nobody gets more than their share
+    of the rate at a time, so one connection can't burst ahead of the others.
+    
+    Where the kernel can pace sockets itself (SO_MAX_PACING_RATE) the limit
+    is split evenly between the sockets and the kernel does all the work.
+    """
+    def __init__(self, rate=0, kernel_pacing=True):
+        self.logger = logging.getLogger('ratelimit')
+        
+        self.rate = 0
+        self.kernel_pacing = kernel_pacing and SO_MAX_PACING_RATE is not None
+        self._socks = []
+        self._paced = False
+        
+        self._tokens = 0.0
+        self._last = time.time()
+        
+        self.set_rate(rate)
+    
+    # Change the limit, this can happen while we're posting
+    def set_rate(self, rate):
+        self.rate = max(0, int(rate))
+        self._refill()
+        self._tokens = min(self._tokens, self.capacity())
+        self.update_pacing()
+    
+    # -----------------------------------------------------------------------
+    # Sockets sharing the limit
+    def add(self, sock):
+        self._socks.append(sock)
+        self.update_pacing()
+    
+    def remove(self, sock):
+        if sock in self._socks:
+            self._socks.remove(sock)
+            self.update_pacing()
+    
+    # Give every socket its share of the limit, or take the limit off again.
+    # If the kernel won't do it we use the token bucket from then on.
+    def update_pacing(self):
+        if not self.kernel_pacing or not (self.rate or self._paced):
+            return
+        
+        self._paced = bool(self.rate)
+        if self.rate:
+            share = min(PACING_UNLIMITED - 1, max(1, self.rate // max(1, len(self._socks))))
+        else:
+            share = PACING_UNLIMITED
+        
+        for sock in self._socks:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, share)
+            except (OSError, ValueError) as msg:
+                self.logger.info('Kernel pacing is not available (%s), limiting the rate ourselves', msg)
+                self.kernel_pacing = False
+                break
+        
+        # Don't leave half of them paced
+        if not self.kernel_pacing:
+            for sock in self._socks:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, PACING_UNLIMITED)
+                except (OSError, ValueError):
+                    pass
+            self._paced = False
+    
+    # -----------------------------------------------------------------------
+    def limited(self):
+        return self.rate > 0 and not self.kernel_pacing
+    
+    # How much one connection gets to send at a time
+    def quantum(self):
+        return max(PACING_MIN, int(self.rate * PACING_SLICE / max(1, len(self._socks))))
+    
+    def capacity(self):
+        return max(self.quantum(), self.rate * BURST_TIME)
+    
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self._tokens = min(self.capacity(), self._tokens + (now - self._last) * self.rate)
+        self._last = now
+    
+    # How much of nbytes can be sent right now. 0 means wait for delay()
+    # seconds and ask again.
+    def allow(self, nbytes):
+        if not self.limited():
+            return nbytes
+        
+        self._refill()
+        want = min(nbytes, self.quantum())
+        if self._tokens < want:
+            return 0
+        return want
+    
+    def used(self, nbytes):
+        if self.limited():
+            self._tokens -= nbytes
+    
+    def delay(self, nbytes):
+        if not self.limited():
+            return 0
+        
+        self._refill()
+        want = min(nbytes, self.quantum())
+        return max(0.001, (want - self._tokens) / self.rate)
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,243 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Groups of connections to each server, and how they've been doing."""
+
+import collections
+import json
+import logging
+import os
+
+# ---------------------------------------------------------------------------
+
+# A server that failed at least half of this many recent posts gets left
+# alone for a while.
+RECENT_POSTS = 8
+RECENT_MIN = 4
+
+# A server posting articles at less than this fraction of the speed of the
+# fastest one is slow, and only gets work nobody else is waiting for.
+SLOW_RATIO = 0.25
+SLOW_MIN_POSTS = 4
+
+# How quickly the speed estimate follows new samples
+RATE_ALPHA = 0.2
+
+# Preference classes, lower is better
+RANK_OK = 0
+RANK_SLOW = 1
+RANK_PENALISED = 2
+
+# Adapting the number of connections: another connection has to make things
+# at least ADAPT_GAIN faster to stay, errors cut the number to ADAPT_DECREASE
+# of what it was, and after backing off we wait ADAPT_HOLD intervals before
+# trying more again.
+ADAPT_GAIN = 0.05
+ADAPT_DECREASE = 0.75
+ADAPT_HOLD = 3
+
+# ---------------------------------------------------------------------------
+
+class ServerPool:
+    """The connections to one server.
+
+    `conf` is the server's config section. Articles are shared out between
+    pools in proportion to their weight, when there's a choice to be made.
+    """
+    def __init__(self, name, conf):
+        self.logger = logging.getLogger('servers')
+        
+        self.name = name
+        self.conf = conf
+        self.key = '%s:%s' % (conf.get('hostname', name), conf.get('port', 119))
+        self.weight = max(1, conf.get('weight', 1))
+        self.conns = []
+        
+        # How many connections we want. With max_connections set this goes
+        # up and down between the limits as we see how the server copes.
+        self.target = conf.get('connections', 1)
+        self.min_connections = max(1, conf.get('min_connections', 1))
+        self.max_connections = conf.get('max_connections', 0)
+        self.adaptive = self.max_connections >= self.min_connections
+        if self.adaptive:
+            self.set_target(self.target)
+        self.conn_errors = 0
+        
+        # (bytes/s, connections) for the best interval so far
+        self.best = (0, self.target)
+        self._sample = None
+        self._goodput = 0
+        self._grew = False
+        self._hold = 0
+        
+        self.dispatched = 0
+        self.posted = 0
+        self.failed = 0
+        self.bytes = 0
+        
+        # Bytes per second for each article, from being handed to a
+        # connection to being accepted.
+        self.rate = None
+        self.penalised_until = 0
+        self._recent = collections.deque(maxlen=RECENT_POSTS)
+    
+    # How much work we've had, for our weight
+    def load(self):
+        return self.dispatched / float(self.weight)
+    
+    def connected(self):
+        return any(conn.is_connected() for conn in self.conns)
+    
+    # Connections that aren't on their way out
+    def live(self):
+        return [conn for conn in self.conns if not conn.retiring]
+    
+    def set_target(self, connections):
+        self.target = max(self.min_connections, min(self.max_connections, connections))
+    
+    # -----------------------------------------------------------------------
+    def post_ok(self, nbytes, elapsed):
+        self.posted += 1
+        self.bytes += nbytes
+        self._recent.append(True)
+        
+        rate = nbytes / max(elapsed, 0.001)
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += RATE_ALPHA * (rate - self.rate)
+    
+    # Returns the number of seconds we're being left alone for, if this was
+    # one failure too many.
+    def post_failed(self, now):
+        self.failed += 1
+        self._recent.append(False)
+        
+        if len(self._recent) < RECENT_MIN or self._recent.count(False) * 2 < len(self._recent):
+            return 0
+        
+        self._recent.clear()
+        penalty = self.conf.get('penalty_time', 30)
+        self.penalised_until = now + penalty
+        self.logger.warning('%s: too many failed posts, moving work to other servers for %ds',
+            self.name, penalty)
+        return penalty
+    
+    # A connection couldn't connect or log in, the server might not want
+    # this many.
+    def conn_failed(self):
+        self.conn_errors += 1
+    
+    # Work out how many connections we want from how the last interval went:
+    # one more while that keeps making things faster, a lot fewer if the
+    # server complained. Returns the new target.
+    def adapt(self, now):
+        sample = (now, self.bytes, self.failed + self.conn_errors)
+        last, self._sample = self._sample, sample
+        if last is None:
+            return self.target
+        
+        goodput = (sample[1] - last[1]) / max(now - last[0], 0.001)
+        errors = sample[2] - last[2]
+        
+        target = self.target
+        if errors:
+            target = min(target - 1, int(target * ADAPT_DECREASE))
+            self._hold = ADAPT_HOLD
+        elif self._grew and goodput < self._goodput * (1 + ADAPT_GAIN):
+            # That last one didn't help
+            target -= 1
+            self._hold = ADAPT_HOLD
+        elif self._hold:
+            self._hold -= 1
+        else:
+            target += 1
+        
+        if not errors and goodput > self.best[0]:
+            self.best = (goodput, self.target)
+        self._goodput = goodput
+        
+        old = self.target
+        self.set_target(target)
+        self._grew = self.target > old
+        if self.target != old:
+            self.logger.info('%s: %d error(s), %.1fKB/s, %s to %d connection(s)', self.name,
+                errors, goodput / 1024, 'going up' if self._grew else 'dropping', self.target)
+        return self.target
+    
+    def rank(self, now, best_rate):
+        if now < self.penalised_until:
+            return RANK_PENALISED
+        if best_rate and self.posted >= SLOW_MIN_POSTS and self.rate < best_rate * SLOW_RATIO:
+            return RANK_SLOW
+        return RANK_OK
+
+# ---------------------------------------------------------------------------
+
+class ServerState:
+    """What worked best for each server last time, so the next run can start
+    from there. Kept in a JSON file as {server key: {name: value}}.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger('servers')
+        
+        self.path = path
+        self.changed = False
+        self._state = {}
+        
+        try:
+            with open(path) as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as msg:
+            self.logger.warning('Unable to read server state from %s: %s', path, msg)
+    
+    def get(self, key, name, default=None):
+        return self._state.get(key, {}).get(name, default)
+    
+    def set(self, key, **values):
+        self._state.setdefault(key, {}).update(values)
+        self.changed = True
+    
+    # Write it all out, a file that isn't finished yet never replaces a good
+    # one.
+    def save(self):
+        if not self.changed:
+            return
+        
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as msg:
+            self.logger.warning('Unable to save server state to %s: %s', self.path, msg)
+            return
+        self.changed = False
+
+# ---------------------------------------------------------------------------
@@ -1,7 +1,8 @@
 import unittest
 from sys import version_info
 
-from yenc import _yenc_encodeEscaped, _yenc_splitIntoLines, yEncode_Python3
+from newsmangler import yenc
+from newsmangler.yenc import _yenc_encodeEscaped, _yenc_splitIntoLines, yEncode_Python3
 
 class TestYencoding(unittest.TestCase):
 	def setUp(self):
@@ -48,6 +49,194 @@ class TestYencoding(unittest.TestCase):
 		
 		result = _yenc_splitIntoLines(b'.sd\t', 4) 
 		self.assertEqual([b'..sd=\x49'], result )
+		
+		#a lone dot on the last line must be doubled too
+		result = _yenc_splitIntoLines(b'asdf.', 4)
+		self.assertEqual([b'asdf', b'..'], result)
+
+# Raw bytes that end up as the awkward characters once encoded
+AWKWARD = bytes([(c + 256 - 42) % 256 for c in (0, 9, 10, 13, 32, 46, 61)])
+
+# Checks a yEncodeInto function against yEncode_Python3, the subclasses set
+# encodeInto to the one they test
+class YencIntoTests(object):
+	encodeInto = None
+	
+	def encode_both(self, data, maxLineLen=128):
+		from io import BytesIO
+		expected = BytesIO()
+		expected_crc = yEncode_Python3(expected, bytes(data), maxLineLen)
+		
+		buf = bytearray(yenc.yEncodeBufferSize(len(data), maxLineLen))
+		used, crc = self.encodeInto(buf, data, maxLineLen)
+		self.assertEqual(expected.getvalue(), bytes(buf[:used]))
+		self.assertEqual(expected_crc, crc)
+	
+	def test_matches_python(self):
+		self.encode_both(b'Hello world', 4)
+		self.encode_both(bytes(range(256)) * 20)
+		self.encode_both(memoryview(b'Hello world'))
+		self.encode_both(b'')
+	
+	def test_awkward_line_boundaries(self):
+		import random
+		rand = random.Random(42)
+		for length in (1, 2, 3, 4, 5, 9, 10, 11, 200):
+			for i in range(200):
+				data = bytes(rand.choice(AWKWARD) for j in range(length))
+				self.encode_both(data, 4)
+	
+	def test_worst_case_fits(self):
+		for char in AWKWARD:
+			for maxLineLen in (4, 5, 128):
+				self.encode_both(bytes([char]) * 1000, maxLineLen)
+
+class TestYencInto(YencIntoTests, unittest.TestCase):
+	encodeInto = staticmethod(yenc.yEncodeInto_Python)
+
+@unittest.skipIf(not yenc.HAVE_NUMPY, "NumPy is not installed")
+class TestYencNumPy(YencIntoTests, unittest.TestCase):
+	encodeInto = staticmethod(yenc.yEncodeInto_NumPy)
+	
+	def test_encode_postfile(self):
+		from io import BytesIO
+		data = AWKWARD * 1000
+		expected, actual = BytesIO(), BytesIO()
+		expected_crc = yEncode_Python3(expected, data, 8)
+		actual_crc = yenc.yEncode_NumPy(actual, data, 8)
+		self.assertEqual(expected.getvalue(), actual.getvalue())
+		self.assertEqual(expected_crc, actual_crc)
+	
+	def test_encode_many(self):
+		datas = [b'', AWKWARD * 30, b'Hello world', AWKWARD[::-1] * 50]
+		results = yenc.yEncodeMany_NumPy(datas, 8)
+		self.assertEqual(len(datas), len(results))
+		
+		for data, (encoded, crc) in zip(datas, results):
+			from io import BytesIO
+			expected = BytesIO()
+			self.assertEqual(yEncode_Python3(expected, data, 8), crc)
+			self.assertEqual(expected.getvalue(), bytes(encoded))
+	
+class TestYdecoding(unittest.TestCase):
+	def encode(self, data, maxLineLen=128):
+		from io import BytesIO
+		postfile = BytesIO()
+		crc = yEncode_Python3(postfile, data, maxLineLen)
+		return postfile.getvalue(), crc
+	
+	def test_round_trip(self):
+		import random
+		rand = random.Random(42)
+		datas = [b'', b'.', b'..', AWKWARD * 100, bytes(range(256)) * 20]
+		datas.extend(bytes(rand.choice(AWKWARD) for j in range(length)) for length in (1, 2, 5, 9, 200))
+		
+		for name, decode in yenc.DECODERS.items():
+			for data in datas:
+				for maxLineLen in (4, 128):
+					encoded = self.encode(data, maxLineLen)[0]
+					self.assertEqual(data, decode(encoded), name)
+					self.assertEqual(data, decode(memoryview(encoded)), name)
 	
+	def test_odd_escapes(self):
+		# Other encoders escape whatever they like, and might leave a bare LF
+		# or a stray = on the end
+		data = bytes(range(256))
+		encoded = b''.join(b'=' + bytes([(c + 106) % 256]) for c in data if (c + 106) % 256 not in (10, 13, 61))
+		expected = bytes(c for c in data if (c + 106) % 256 not in (10, 13, 61))
+		for name, decode in yenc.DECODERS.items():
+			self.assertEqual(expected, decode(encoded), name)
+			self.assertEqual(b'ab', decode(b'\x8b\n\x8c='), name)
+	
+	def test_split(self):
+		self.assertEqual({'part': '1', 'line': '128', 'size': '5', 'name': 'my file=1.bin '},
+			yenc.ySplit('=ybegin part=1 line=128 size=5 name=my file=1.bin \r\n'))
+		self.assertEqual(('yend', {'size': 5, 'part': 1, 'pcrc32': '3610a686'}),
+			yenc.yParseLine(b'=yend size=5 part=1 pcrc32=3610a686\r\n'))
+		self.assertRaises(yenc.YencError, yenc.yParseLine, '=ypart begin=x end=5')
+	
+	def test_article(self):
+		data = bytes(range(256)) * 4
+		encoded, crc = self.encode(data)
+		body = b'=ybegin part=2 total=3 line=128 size=5000 name=a b.bin\r\n=ypart begin=1025 end=2048\r\n'
+		body += encoded + b'=yend size=1024 part=2 pcrc32=' + crc.encode('ascii') + b' crc32=ffffffff\r\n'
+		
+		headers, decoded = yenc.yDecodeArticle(body)
+		self.assertEqual(data, decoded)
+		self.assertEqual('a b.bin', headers['ybegin']['name'])
+		self.assertEqual(2048, headers['ypart']['end'])
+		
+		for old, new, error in [(b'end=2048', b'end=2049', 'part is 1024 bytes, expected 1025'),
+				(b'pcrc32=', b'pcrc32=1', 'pcrc32 mismatch'),
+				(b'=yend size=1024 part=2', b'=yend size=1024 part=1', '=yend part is 1, =ybegin says 2'),
+				(b'=yend', b'=yned', 'no =yend line')]:
+			with self.assertRaises(yenc.YencError) as cm:
+				yenc.yDecodeArticle(body.replace(old, new))
+			self.assertEqual(error, str(cm.exception))
+		
+		# Single part posts can just have the file's CRC
+		body = b'=ybegin line=128 size=1024 name=a\r\n' + encoded + b'=yend size=1024 crc32=' + crc.encode('ascii') + b'\r\n'
+		self.assertEqual(data, yenc.yDecodeArticle(body)[1])
+
+class TestEncoderRegistry(unittest.TestCase):
+	def setUp(self):
+		self.mode = yenc.yEncMode()
+		yenc._selected.clear()
+	
+	def tearDown(self):
+		yenc.useEncoder(self.mode)
+		yenc._selected.clear()
+	
+	def test_encoders_are_good(self):
+		for name, (encode, description) in yenc.ENCODERS.items():
+			self.assertIsNone(yenc.checkEncoder(encode), name)
+	
+	def test_bad_encoders(self):
+		def no_dots(postfile, data):
+			from io import BytesIO
+			encoded = BytesIO()
+			crc = yEncode_Python3(encoded, data)
+			postfile.write(encoded.getvalue().replace(b'\r\n..', b'\r\n.'))
+			return crc
+		def bad_crc(postfile, data):
+			yEncode_Python3(postfile, data)
+			return '00000000'
+		def broken(postfile, data):
+			raise ValueError('nope')
+		
+		self.assertEqual('line starting with an undoubled dot', yenc.checkEncoder(no_dots))
+		self.assertEqual('wrong CRC', yenc.checkEncoder(bad_crc))
+		self.assertEqual('failed with ValueError: nope', yenc.checkEncoder(broken))
+	
+	def test_decode(self):
+		for data in (b'', AWKWARD * 50, bytes(range(256)) * 10):
+			from io import BytesIO
+			postfile = BytesIO()
+			yEncode_Python3(postfile, data, 8)
+			self.assertEqual(data, yenc.yDecode(postfile.getvalue()))
+	
+	def test_select(self):
+		self.assertEqual('python', yenc.selectEncoder('python'))
+		self.assertEqual('python', yenc.yEncMode())
+		self.assertIn(yenc.selectEncoder('nonsense'), yenc.ENCODERS)
+	
+	def test_select_cache(self):
+		import json, os, tempfile
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'encoders')
+			yenc.selectEncoder('auto', path)
+			with open(path) as f:
+				cached = json.load(f)
+			self.assertEqual(set(yenc.ENCODERS), set(cached['results']))
+			
+			# Rig the results, they should be used instead of timing again
+			for result in cached['results'].values():
+				result['mbps'] = 1.0
+			cached['results']['python']['mbps'] = 1000.0
+			with open(path, 'w') as f:
+				json.dump(cached, f)
+			yenc._selected.clear()
+			self.assertEqual('python', yenc.selectEncoder('auto', path))
+
 if __name__ == '__main__':
     unittest.main(verbosity=3)
@@ -0,0 +1,259 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Check that the segments in an NZB made it to the server."""
+
+import asyncio
+import collections
+import gzip
+import re
+
+from xml.etree import ElementTree
+
+from newsmangler.aionntp import AioNNTP, NNTPError, MSGID_RE
+
+# ---------------------------------------------------------------------------
+
+FILENAME_RE = re.compile(r'"([^"]+)"')
+PARTS_RE = re.compile(r'\((\d+)/(\d+)\)')
+
+# STATs each connection has waiting for a response, unless the server
+# section says otherwise
+VERIFY_WINDOW = 200
+
+# ---------------------------------------------------------------------------
+
+class NZBSegment:
+    __slots__ = ('number', 'bytes', 'msgid')
+
+    def __init__(self, number, nbytes, msgid):
+        self.number = number
+        self.bytes = nbytes
+        self.msgid = msgid
+
+class NZBEntry:
+    """A <file> from an NZB. The filename and the number of parts come out
+    of the subject, which is what every poster we know of does."""
+    def __init__(self, subject, poster, date):
+        self.subject = subject
+        self.poster = poster
+        self.date = date
+        self.groups = []
+        self.segments = []
+    
+    def _parts_match(self):
+        matches = list(PARTS_RE.finditer(self.subject))
+        return matches[-1] if matches else None
+    
+    # The filename in quotes, None if there isn't one
+    def filename(self):
+        m = FILENAME_RE.search(self.subject)
+        return m and m.group(1)
+    
+    # Number of parts the file was posted in, None if we can't tell
+    def total(self):
+        m = self._parts_match()
+        return m and int(m.group(2))
+    
+    # The subject with the part number as a %d, for building articles
+    def subject_format(self):
+        m = self._parts_match()
+        if m is None:
+            return None
+        return '%s(%%0%dd/%s)%s' % (self.subject[:m.start()].replace('%', '%%'), len(m.group(1)),
+            m.group(2), self.subject[m.end():].replace('%', '%%'))
+
+# Read an NZB, gzipped or not. Returns a list of NZBEntry. Elements are
+# thrown away as we go, big NZBs don't need a big tree.
+def read_nzb(path):
+    with open(path, 'rb') as f:
+        gzipped = (f.read(2) == b'\x1f\x8b')
+    
+    entries = []
+    entry = None
+    with (gzip.open if gzipped else open)(path, 'rb') as f:
+        try:
+            for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+                # Ignore the namespace, plenty of NZBs don't have one
+                tag = elem.tag.rsplit('}', 1)[-1]
+                if event == 'start':
+                    if tag == 'file':
+                        entry = NZBEntry(elem.get('subject', ''), elem.get('poster', ''), elem.get('date'))
+                elif entry is None:
+                    continue
+                elif tag == 'group' and elem.text:
+                    entry.groups.append(elem.text.strip())
+                elif tag == 'segment' and elem.text:
+                    entry.segments.append(NZBSegment(int(elem.get('number', 0)), int(elem.get('bytes', 0)),
+                        '<%s>' % (elem.text.strip().strip('<>'))))
+                elif tag == 'file':
+                    entries.append(entry)
+                    entry = None
+                    elem.clear()
+        except ElementTree.ParseError as msg:
+            raise ValueError('not a valid NZB: %s' % (msg))
+    
+    return entries
+
+# ---------------------------------------------------------------------------
+
+class Verifier:
+    """The Message-IDs we have to check, shared by every connection.
+
+    Connections take() a batch at a time and report each result(). Anything
+    a connection had outstanding when it died gets requeue()d. `finished` is
+    set once we have a result for everything. Needs to be made inside the
+    running event loop.
+    """
+    def __init__(self, msgids):
+        self._queue = collections.deque(msgids)
+        self._outstanding = 0
+        self._wake = asyncio.Event()
+        self.finished = asyncio.Event()
+        
+        self.found = 0
+        self.missing = set()
+        # Message-IDs we got something other than 223 or 430 for, and what
+        self.unknown = {}
+    
+    def take(self, count):
+        batch = []
+        while self._queue and len(batch) < count:
+            batch.append(self._queue.popleft())
+        self._outstanding += len(batch)
+        return batch
+    
+    def requeue(self, msgids):
+        self._queue.extendleft(reversed(msgids))
+        self._outstanding -= len(msgids)
+        self._wake.set()
+    
+    def result(self, msgid, resp, line):
+        self._outstanding -= 1
+        if resp == '223':
+            self.found += 1
+        elif resp == '430':
+            self.missing.add(msgid)
+        else:
+            self.unknown[msgid] = line
+        
+        if self.done():
+            self.finished.set()
+            self._wake.set()
+    
+    # Number of Message-IDs we don't have a result for yet
+    def remaining(self):
+        return len(self._queue) + self._outstanding
+    
+    def done(self):
+        return self.remaining() == 0
+    
+    # Wait for something to be requeued, or for everything to be done
+    async def wait(self):
+        self._wake.clear()
+        await self._wake.wait()
+
+# ---------------------------------------------------------------------------
+
+class AioStat(AioNNTP):
+    """A connection that checks articles are there with STAT. Responses come
+    back in the order the commands were sent, so we keep up to verify_window
+    of them going at once and top them up in batches."""
+    def __init__(self, *args, **kwargs):
+        AioNNTP.__init__(self, *args, **kwargs)
+        self._pending = collections.deque()
+    
+    # We're not going to post anything
+    async def _check_streaming(self):
+        pass
+    
+    def in_flight(self):
+        return len(self._pending)
+    
+    async def run(self):
+        verifier = self.parent.verifier
+        while not verifier.done():
+            try:
+                if self._writer is None:
+                    await self._connect()
+                    self.logger.debug('%d: ready.', self.connid)
+                
+                await self.check(verifier)
+            except (OSError, NNTPError) as msg:
+                self.logger.warning('%d: %s!', self.connid, msg)
+                if self._writer is None or not self._pending:
+                    self.pool.conn_failed()
+                self._reconnects.inc()
+                verifier.requeue(list(self._pending))
+                self._pending.clear()
+                await self.close()
+                await self.pause(self.server['reconnect_delay'])
+                continue
+            
+            # Nothing left to take, but someone else might drop theirs
+            if not verifier.done():
+                await verifier.wait()
+        
+        if self._writer is not None:
+            try:
+                await self._command('QUIT')
+            except (OSError, NNTPError):
+                pass
+            await self.close()
+        
+        self.parent.connection_closed(self)
+    
+    # STAT everything we can get, returns once there's nothing left to take
+    # and we've heard back about everything we sent.
+    async def check(self, verifier):
+        window = self.server.get('verify_window', VERIFY_WINDOW)
+        pending = self._pending
+        
+        while True:
+            if len(pending) <= window // 2:
+                batch = verifier.take(window - len(pending))
+                if batch:
+                    pending.extend(batch)
+                    self._writer.write(''.join('STAT %s\r\n' % (msgid) for msgid in batch).encode('utf-8'))
+            
+            if not pending:
+                return
+            
+            await self._writer.drain()
+            resp, line = await self._read_response()
+            
+            # 223 has the Message-ID in it, make sure we're still in step
+            msgid = pending[0]
+            m = MSGID_RE.search(line)
+            if resp == '223' and m and m.group(1) != msgid:
+                raise NNTPError('response out of order - "%s"' % (line))
+            
+            pending.popleft()
+            verifier.result(msgid, resp, line)
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,379 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Post from several worker processes, each with a share of the parts and of
+the connections."""
+
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+from newsmangler import yenc
+from newsmangler.checksums import FileChecksum
+from newsmangler.common import MessageIDs, niceFileSize_str, niceTime_str, setupLogger
+from newsmangler.filewrap import FileWrap
+from newsmangler.planner import ArticlePlanner
+from newsmangler.postmangler import STATUS_INTERVAL, PostMangler
+
+HAVE_AFFINITY = hasattr(os, 'sched_setaffinity')
+
+# ---------------------------------------------------------------------------
+# Our share of `total` when it's split between `count` of us
+def share(total, index, count):
+    return total // count + (1 if index < total % count else 0)
+
+# The config for worker `index` of `count`. Every server's connections are
+# split between the workers, so the total is still what was asked for, and
+# a server with no connections left for this worker is left out. The
+# coordinator does the NZBs, journal and server state.
+def worker_conf(original, index, count):
+    conf = dict((section, dict(values)) for section, values in original.items())
+    for section in list(conf):
+        if section != 'server' and not section.startswith('server:'):
+            continue
+        
+        values = dict(original['server'], **original[section])
+        connections = share(values.get('connections', 1), index, count)
+        if values.get('max_connections', 0):
+            maximum = share(values['max_connections'], index, count)
+            conf[section]['max_connections'] = maximum
+            conf[section]['min_connections'] = max(1, min(values.get('min_connections', 1), maximum))
+            connections = max(1, min(connections, maximum)) if maximum else 0
+        
+        if connections == 0 and section != 'server':
+            del conf[section]
+        else:
+            conf[section]['connections'] = max(1, connections)
+    
+    # PostMangler splits this up when it starts
+    if isinstance(conf['posting'].get('skip_filenames'), list):
+        conf['posting']['skip_filenames'] = ' '.join(conf['posting']['skip_filenames'])
+    conf['posting'].update(generate_nzbs=0, nzb_first=0, journal='', resume=False, par2_redundancy=0,
+        checksum_files='', server_state='', metrics_port=0, metrics_file='')
+    return conf
+
+# How many workers we can have: each one needs at least one connection to
+# the main server.
+def max_workers(conf):
+    return max(1, conf['server'].get('max_connections', 0) or conf['server'].get('connections', 1))
+
+# Split the CPUs we're allowed to use between `count` workers
+def cpu_sets(count):
+    if not HAVE_AFFINITY:
+        return [None] * count
+    cpus = sorted(os.sched_getaffinity(0))
+    per = max(1, len(cpus) // count)
+    sets = []
+    for i in range(count):
+        start = (i * per) % len(cpus)
+        sets.append(cpus[start:start + per])
+    return sets
+
+# ---------------------------------------------------------------------------
+# What runs in a worker process
+def worker_main(wid, conf, newsgroup, jobs, results, control, cpus, debug):
+    if cpus and HAVE_AFFINITY:
+        os.sched_setaffinity(0, cpus)
+    if not logging.getLogger().handlers:
+        setupLogger(debug)
+    
+    mangler = ShardMangler(conf, debug, wid, results, control)
+    try:
+        mangler.post_shard(newsgroup, jobs)
+    finally:
+        mangler.loop.close()
+    results.send(('done', wid))
+
+class ShardMangler(PostMangler):
+    """Posts a shard of the parts in a worker process.
+
+    Posted and failed parts are sent back over the `results` pipe instead
+    of going in an NZB or a journal, and changes to the rate limit come in
+    on the `control` pipe.
+    """
+    def __init__(self, conf, debug, wid, results, control):
+        PostMangler.__init__(self, conf, debug)
+        self._wid = wid
+        self._results = results
+        self._control = control
+    
+    def post_shard(self, newsgroup, jobs):
+        self.newsgroup = newsgroup
+        self.reset_connections()
+        
+        domain = self.conf['posting'].get('msgid_domain') or self.conf['server']['hostname']
+        self._planner = ArticlePlanner(self._build_article, MessageIDs(domain))
+        self._planner.add_source(self._plan_jobs, jobs)
+        if self._planner.scan():
+            self._run()
+    
+    # Plan the parts we were given. Files we have every part of get their
+    # CRC32 in the last one.
+    def _plan_jobs(self, jobs):
+        for job in jobs:
+            fileinfo = dict(job['fileinfo'], job=job['id'])
+            rows = job['rows']
+            if len(rows) == fileinfo['parts']:
+                fileinfo['checksum'] = FileChecksum(fileinfo['filename'], fileinfo['filesize'])
+            
+            fileidx = self._planner.add_file(FileWrap(fileinfo['filepath'], len(rows), self._filepool),
+                fileinfo, job['subject'])
+            self._parts_left[fileinfo['dirname']] = self._parts_left.get(fileinfo['dirname'], 0) + len(rows)
+            for partnum, begin, end in rows:
+                self._planner.add_part(fileidx, partnum, begin, end)
+    
+    def remember_msgid(self, fileinfo, subject, partnum, msgid, article_size, posttime):
+        self._results.send(('posted', self._wid, fileinfo['job'], partnum, msgid, article_size, posttime))
+    
+    def post_failed(self, article, reason, retry=True):
+        failed = len(self._failed)
+        PostMangler.post_failed(self, article, reason, retry)
+        if len(self._failed) > failed:
+            self._results.send(('failed', self._wid, article._fileinfo['job'], article._partnum, reason))
+    
+    # The coordinator shows the status line, we just see if it wants
+    # anything.
+    def status_line(self, busy):
+        while self._control.poll():
+            command, value = self._control.recv()
+            if command == 'rate':
+                self.set_rate_limit(value)
+
+# ---------------------------------------------------------------------------
+
+class Worker:
+    __slots__ = ('wid', 'slot', 'process', 'results', 'control', 'pending')
+
+    def __init__(self, wid, slot, process, results, control, pending):
+        self.wid = wid
+        self.slot = slot
+        self.process = process
+        self.results = results
+        self.control = control
+        self.pending = pending
+
+class Coordinator:
+    """Splits everything `mangler` has planned between worker processes.
+
+    Each file goes to one worker, apart from files big enough that they
+    have to be split up to keep the workers even. `mangler` hears about
+    every part the workers post or give up on as if it had posted them
+    itself, so its journal and NZBs are the same as always. A worker that
+    dies has its unfinished parts handed to a new one, up to
+    posting/worker_restarts times. Each worker gets pipes of its own, so one
+    dying halfway through sending something can't get in anyone else's way.
+    """
+    def __init__(self, mangler, workers):
+        self.logger = logging.getLogger('coordinator')
+        self.mangler = mangler
+        self.conf = mangler.conf
+        
+        self.workers = min(workers, max_workers(self.conf))
+        if self.workers < workers:
+            self.logger.warning('Only %d connection(s) to %s, using %d worker(s)', max_workers(self.conf),
+                self.conf['server']['hostname'], self.workers)
+        
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = {}
+        self._next_wid = 0
+        self._restarts = self.conf['posting'].get('worker_restarts', 3)
+        self._cpus = [None] * self.workers
+        if self.conf['posting'].get('worker_pinning', 0):
+            if HAVE_AFFINITY:
+                self._cpus = cpu_sets(self.workers)
+            else:
+                self.logger.warning('CPU pinning is not available here')
+        
+        self._files = []
+        self._failed = []
+    
+    # -----------------------------------------------------------------------
+    # Cut the planned parts up into jobs and share them out, biggest first
+    # to whoever has the least.
+    def split(self, planned):
+        total = sum(end - begin for planfile, rows in planned for partnum, begin, end in rows)
+        target = max(1, total // self.workers)
+        
+        jobs = []
+        for planfile, rows in planned:
+            fileid = len(self._files)
+            self._files.append(planfile)
+            
+            size = sum(end - begin for partnum, begin, end in rows)
+            pieces = max(1, min(len(rows), (size + target // 2) // target))
+            per = -(-len(rows) // pieces)
+            for i in range(0, len(rows), per):
+                jobs.append((fileid, rows[i:i + per]))
+        
+        shards = [[] for i in range(self.workers)]
+        sizes = [0] * self.workers
+        for fileid, rows in sorted(jobs, key=lambda job: -sum(end - begin for partnum, begin, end in job[1])):
+            i = sizes.index(min(sizes))
+            shards[i].append((fileid, rows))
+            sizes[i] += sum(end - begin for partnum, begin, end in rows)
+        return shards
+    
+    def start_worker(self, slot, shard):
+        jobs = []
+        pending = set()
+        for fileid, rows in sorted(shard):
+            planfile = self._files[fileid]
+            fileinfo = dict((key, planfile.fileinfo[key])
+                for key in ('dirname', 'filename', 'filepath', 'filesize', 'parts'))
+            jobs.append({'id': fileid, 'fileinfo': fileinfo, 'subject': planfile.subject, 'rows': rows})
+            pending.update((fileid, partnum) for partnum, begin, end in rows)
+        
+        wid = self._next_wid
+        self._next_wid += 1
+        conf = worker_conf(self.conf, slot, self.workers)
+        # Use the encoder we picked rather than timing them all again
+        conf['posting']['yenc_encoder'] = yenc.yEncMode()
+        if self.mangler.limiter.rate:
+            conf['posting']['rate_limit'] = '%.3fK' % (self.mangler.limiter.rate / self.workers / 1024)
+        
+        results, child_results = self._context.Pipe(duplex=False)
+        child_control, control = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=worker_main, name='newsmangler-worker-%d' % (wid),
+            args=(wid, conf, self.mangler.newsgroup, jobs, child_results, child_control, self._cpus[slot],
+                logging.getLogger().isEnabledFor(logging.DEBUG)))
+        process.start()
+        # Only the worker has these ends now, so we see EOF when it goes
+        child_results.close()
+        child_control.close()
+        self._workers[wid] = Worker(wid, slot, process, results, control, pending)
+        self.logger.debug('Started worker %d (pid %d) with %d part(s)', wid, process.pid, len(pending))
+    
+    # -----------------------------------------------------------------------
+    def handle(self, message):
+        kind, wid = message[:2]
+        worker = self._workers.get(wid)
+        if worker is None or kind == 'done':
+            return
+        
+        fileid, partnum = message[2:4]
+        if (fileid, partnum) not in worker.pending:
+            return
+        worker.pending.discard((fileid, partnum))
+        
+        planfile = self._files[fileid]
+        if kind == 'posted':
+            msgid, article_size, posttime = message[4:]
+            self.mangler.part_posted(planfile.fileinfo, planfile.subject, partnum, msgid, article_size, posttime)
+        elif kind == 'failed':
+            self.give_up(planfile, partnum, message[4])
+    
+    def give_up(self, planfile, partnum, reason):
+        self._failed.append((planfile.subject % (partnum), reason))
+        self.mangler.part_failed(planfile.fileinfo, planfile.subject, partnum)
+    
+    # Handle everything a worker has sent so far. Returns False once it has
+    # gone away, a message cut short by that is thrown away.
+    def receive(self, worker):
+        try:
+            while worker.results.poll():
+                self.handle(worker.results.recv())
+        except (EOFError, OSError):
+            return False
+        return True
+    
+    # A worker has exited, anything it didn't finish goes to a new one
+    def worker_exited(self, worker):
+        worker.process.join()
+        self.receive(worker)
+        worker.results.close()
+        worker.control.close()
+        del self._workers[worker.wid]
+        if not worker.pending:
+            return
+        
+        if self._restarts <= 0:
+            self.logger.error('Worker %d exited with %d part(s) left and we\'re out of restarts, '
+                'giving up on them', worker.wid, len(worker.pending))
+            for fileid, partnum in sorted(worker.pending):
+                self.give_up(self._files[fileid], partnum, 'worker exited')
+            return
+        
+        self._restarts -= 1
+        self.logger.warning('Worker %d exited (%s) with %d part(s) left, handing them to a new one',
+            worker.wid, worker.process.exitcode, len(worker.pending))
+        
+        article_size = self.conf['posting']['article_size']
+        rows = collections.defaultdict(list)
+        for fileid, partnum in sorted(worker.pending):
+            begin = (partnum - 1) * article_size
+            rows[fileid].append((partnum, begin, min(self._files[fileid].fileinfo['filesize'], begin + article_size)))
+        self.start_worker(worker.slot, list(rows.items()))
+    
+    # Change everyone's share of the rate limit
+    def set_rate_limit(self, rate):
+        for worker in self._workers.values():
+            try:
+                worker.control.send(('rate', rate / self.workers))
+            except OSError:
+                pass
+    
+    # -----------------------------------------------------------------------
+    # Post everything from ArticlePlanner.take_all()
+    def run(self, planned):
+        shards = self.split(planned)
+        parts = sum(len(rows) for planfile, rows in planned)
+        self.logger.info('Posting %d article(s) with %d worker(s)', parts, self.workers)
+        
+        start = time.time()
+        try:
+            for slot, shard in enumerate(shards):
+                if shard:
+                    self.start_worker(slot, shard)
+            
+            while self._workers:
+                waiting = [worker.results for worker in self._workers.values()]
+                waiting += [worker.process.sentinel for worker in self._workers.values()]
+                multiprocessing.connection.wait(waiting, STATUS_INTERVAL)
+                
+                for worker in list(self._workers.values()):
+                    if not self.receive(worker) or not worker.process.is_alive():
+                        self.worker_exited(worker)
+                
+                self.mangler.status_line(sum(len(worker.pending) for worker in self._workers.values()))
+        finally:
+            for worker in self._workers.values():
+                worker.process.terminate()
+                worker.process.join()
+            self._workers = {}
+        
+        interval = time.time() - start
+        self.logger.info('Posting complete - %d article(s), %s in %s (%s/s)', self.mangler._posted,
+            niceFileSize_str(self.mangler._bytes), niceTime_str(interval),
+            niceFileSize_str(self.mangler._bytes / max(interval, 0.001)))
+        
+        if self._failed:
+            self.logger.error('%d article(s) could not be posted:', len(self._failed))
+            for subject, reason in self._failed:
+                self.logger.error('  %s - %s', subject, reason)
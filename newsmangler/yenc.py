@@ -27,19 +27,43 @@
 
 """Useful functions for yEnc encoding/decoding."""
 
+import collections
+import json
+import logging
+import os
+import platform
 import re
+import threading
+import time
 import zlib
+from io import BytesIO
 from sys import version_info
 
 # ---------------------------------------------------------------------------
 
-HAVE_PSYCO = False
 HAVE_YENC = False
 HAVE_YENC_FRED = False
 
+# Encoders from other people, if they're around
+try:
+	import sabyenc3
+except ImportError:
+	sabyenc3 = None
+
+try:
+	import rapidyenc
+except ImportError:
+	rapidyenc = None
+
+try:
+	import numpy as np
+except ImportError:
+	HAVE_NUMPY = False
+else:
+	HAVE_NUMPY = True
+
 # ---------------------------------------------------------------------------
 # Translation tables
-YDEC_TRANS = ''.join([chr((i + 256 - 42) % 256) for i in range(256)])
 YENC_TRANS = ''.join([chr((i + 42) % 256) for i in range(256)])
 
 if (version_info > (3,0)):
@@ -52,36 +76,113 @@ if (version_info > (3,0)):
 
 #yenc_trans42 = string.join(map(lambda x: chr((x+42) % 256), range(256)), "")
 
-YDEC_MAP = {}
-for i in range(256):
-	YDEC_MAP[chr(i)] = chr((i + 256 - 64) % 256)
+YDEC_TABLE = bytes([(i - 42) % 256 for i in range(256)])
 
 # ---------------------------------------------------------------------------
 
-def yDecode(data):
-	# unescape any escaped char (grr)
-	data = re.sub(r'=(.)', yunescape, data)
-	return data.translate(YDEC_TRANS)
+# What an escaped character turns into, before YDEC_TABLE
+YDEC_ESCAPES = dict((bytes([i]), bytes([(i - 64) % 256])) for i in range(256))
+YDEC_ESCAPES[b''] = b''
 
-def yunescape(m):
-	return YDEC_MAP[m.group(1)]
+# Decoders take the data lines of a yEnc article (no =y lines) as bytes or
+# anything else with the buffer interface, and return the decoded bytes.
+# CR and LF are always escaped, so any left are line endings, and a doubled
+# dot at the start of a line goes back to one.
+
+def yDecode_Python(data):
+	'Decode yEnc data lines using bytes operations'
+	data = bytes(data)
+	if data.startswith(b'..'):
+		data = data[1:]
+	if b'\r\n..' in data:
+		data = data.replace(b'\r\n..', b'\r\n.')
+	data = b''.join(data.split(b'\r\n'))
+	if b'\n' in data or b'\r' in data:
+		data = data.replace(b'\n', b'').replace(b'\r', b'')
+	
+	# Everything after an = starts with an escaped character. This beats a
+	# replace() for each escape there is, those copy the whole part each time.
+	pieces = data.split(b'=')
+	if len(pieces) > 1:
+		out = [pieces[0]]
+		for piece in pieces[1:]:
+			out.append(YDEC_ESCAPES[piece[:1]])
+			out.append(piece[1:])
+		data = b''.join(out)
+	
+	return data.translate(YDEC_TABLE)
+
+def yDecode_NumPy(data):
+	'Decode yEnc data lines using NumPy'
+	encoded = np.frombuffer(data, dtype=np.uint8)
+	size = len(encoded)
+	drop = (encoded == 10) | (encoded == 13)
+	
+	# Lines that start with two dots lose the first one
+	starts = np.flatnonzero(encoded[:-2] == 10) + 1
+	drop[starts[(encoded[starts] == 46) & (encoded[starts + 1] == 46)]] = True
+	if size > 1 and encoded[0] == 46 and encoded[1] == 46:
+		drop[0] = True
+	
+	# Whatever follows an = is 64 more than it should be, and the =s go
+	escapes = np.flatnonzero(encoded == 61)
+	decoded = encoded - np.uint8(42)
+	following = escapes + 1
+	decoded[following[following < size]] -= np.uint8(64)
+	drop[escapes] = True
+	
+	return decoded[~drop].tobytes()
+
+# Fastest first
+DECODERS = collections.OrderedDict()
+if HAVE_NUMPY:
+	DECODERS['numpy'] = yDecode_NumPy
+DECODERS['python'] = yDecode_Python
+
+yDecode = next(iter(DECODERS.values()))
+
+# ---------------------------------------------------------------------------
+# C encoders. They hand back one lump of encoded data, which might not have
+# the dots at the start of lines doubled or a CRLF on the end.
+
+def _yenc_finish(postfile, yenced):
+	if yenced.startswith(b'.'):
+		postfile.write(b'.')
+	postfile.write(yenced.replace(b'\r\n.', b'\r\n..'))
+	
+	if yenced and not yenced.endswith(b'\r\n'):
+		postfile.write(b'\r\n')
 
 def yEncode_C(postfile, data):
 	# If we don't have my modified yenc module, we have to do the . quoting
 	# ourselves. This is about 50% slower.
 	if HAVE_YENC_FRED:
-		yenced, tempcrc = _yenc.encode_string(data, escapedots=1)[:2]
+		yenced, tempcrc = _yenc.encode_string(bytes(data), escapedots=1)[:2]
+		postfile.write(yenced)
+		if yenced and not yenced.endswith(b'\r\n'):
+			postfile.write(b'\r\n')
 	else:
-		yenced, tempcrc = _yenc.encode_string(data)[:2]
-		yenced = yenced.replace('\r\n.', '\r\n..')
-	
-	postfile.write(yenced)
-	
-	if not yenced.endswith('\r\n'):
-		postfile.write('\r\n')
+		yenced, tempcrc = _yenc.encode_string(bytes(data))[:2]
+		_yenc_finish(postfile, yenced)
 	
 	return '%08x' % ((tempcrc ^ -1) & 2**32 - 1)
 
+# sabyenc3 and rapidyenc give us the data, and maybe a CRC as well. zlib's
+# CRC is quick enough that we don't bother using theirs.
+def yEncode_sabyenc3(postfile, data):
+	yenced = sabyenc3.encode(bytes(data))
+	if isinstance(yenced, tuple):
+		yenced = yenced[0]
+	_yenc_finish(postfile, yenced)
+	return CRC32(data)
+
+def yEncode_rapidyenc(postfile, data):
+	yenced = rapidyenc.encode(bytes(data))
+	if isinstance(yenced, tuple):
+		yenced = yenced[0]
+	_yenc_finish(postfile, yenced)
+	return CRC32(data)
+
 
 ENCODE_NONE		= 0
 ENCODE_BASE64 	= 64
@@ -124,6 +225,9 @@ def _yenc_splitIntoLines(translated, maxLineLen=128):
 		if start == end - 1:
 			if line[0] in (ord('\t'), ord(' ')):
 				line = b'=' + char_to_yenc_byte(line[0], ENCODE_BASE64)
+			# a lone dot would end the article early
+			elif line[0] == ord('.'):
+				line = b'.' + line
 		else:
 			if line[0] in (ord('\t'), ord(' ')):
 				line = b'=' + char_to_yenc_byte(line[0], ENCODE_BASE64) + line[1:-1]
@@ -159,34 +263,331 @@ def yEncode_Python3(postfile, data, maxLineLen=128):
 	return CRC32(data)
 
 # ---------------------------------------------------------------------------
+# Pure Python encoder that writes straight into a caller supplied buffer. The
+# escaping is done with C level translate/replace calls, after that the only
+# Python work is one trip around the loop per line, copying slices of the
+# escaped data into place. Output matches yEncode_Python3 byte for byte.
+
+YENC_TABLE = bytes([(i + 42) % 256 for i in range(256)])
+YENC_ESCAPES = [(bytes([c]), bytes([61, c + 64])) for c in (61, 0, 10, 13)]
+
+# Byte classes for the line splitters: 1 = TAB/SPACE, 2 = dot, 3 = '='
+YENC_LINE_CLASSES = bytes([{9: 1, 32: 1, 46: 2, 61: 3}.get(i, 0) for i in range(256)])
+
+def yEncodeBufferSize(datalen, maxLineLen=128):
+	'Worst case size of datalen bytes of yEnc encoded data'
+	# Everything might need escaping, and every line might grow by a
+	# dot/escape at the start, an escape at the end, one byte to avoid
+	# splitting an escape, and CRLF.
+	escaped = datalen * 2
+	return escaped + (escaped // (maxLineLen - 1) + 2) * 5
+
+# Translate and escape data
+def _yenc_escape(data):
+	escaped = bytes(data).translate(YENC_TABLE)
+	for char, replacement in YENC_ESCAPES:
+		if char in escaped:
+			escaped = escaped.replace(char, replacement)
+	return escaped
+
+# Write out a line that starts or ends with something awkward, the line
+# would be src[start:end] otherwise. Returns the new output position and
+# where the next line starts.
+def _yenc_awkward_line(out, o, src, start, end):
+	classes = YENC_LINE_CLASSES
+	first = classes[src[start]]
+	last = classes[src[end - 1]]
+	copy_from = start
+	trail = False
+	
+	# TAB/SPACE at the start gets escaped, and the line loses a byte at the
+	# end to make up for it.
+	if first == 1:
+		out[o] = 61
+		out[o + 1] = src[start] + 64
+		o += 2
+		copy_from += 1
+		if start < end - 1:
+			end -= 1
+		if end - 1 > start:
+			last = classes[src[end - 1]]
+		else:
+			last = 0
+	
+	# Dot at the start gets doubled
+	elif first == 2:
+		out[o] = 46
+		o += 1
+	
+	# Single byte lines don't get their end looked at
+	if start == end - 1:
+		last = 0
+	
+	# Don't split an escape, and escape TAB/SPACE at the end
+	if last == 3:
+		end += 1
+	elif last == 1:
+		end -= 1
+		trail = True
+	
+	n = end - copy_from
+	out[o:o + n] = src[copy_from:end]
+	o += n
+	
+	if trail:
+		out[o] = 61
+		out[o + 1] = src[end] + 64
+		o += 2
+		end += 1
+	
+	out[o] = 13
+	out[o + 1] = 10
+	return o + 2, end
+
+def yEncodeInto_Python(buf, data, maxLineLen=128):
+	'''Encode data into buf, which must be at least yEncodeBufferSize() bytes.
+	Returns (bytes used, crc).'''
+	escaped = _yenc_escape(data)
+	classes = escaped.translate(YENC_LINE_CLASSES)
+	src = memoryview(escaped)
+	out = memoryview(buf)
+	
+	o = 0
+	start = 0
+	datalen = len(escaped)
+	while start < datalen:
+		end = start + maxLineLen
+		if end > datalen:
+			end = datalen
+		
+		# Nothing special about this line, just copy it
+		if not classes[start] and not classes[end - 1]:
+			n = end - start
+			out[o:o + n] = src[start:end]
+			out[o + n] = 13
+			out[o + n + 1] = 10
+			o += n + 2
+			start = end
+		else:
+			o, start = _yenc_awkward_line(out, o, src, start, end)
+	
+	return o, CRC32(data)
+
+# Scratch buffers for yEncode_Python, one per thread
+_scratch = threading.local()
+
+# Encode with one of the yEncodeInto functions, reusing a scratch buffer
+def _yenc_write(encodeInto, postfile, data, maxLineLen):
+	needed = yEncodeBufferSize(len(data), maxLineLen)
+	
+	# Pool buffers can be written to directly
+	reserve = getattr(postfile, 'reserve', None)
+	if reserve is not None:
+		used, crc = encodeInto(reserve(needed), data, maxLineLen)
+		postfile.commit(used)
+		return crc
+	
+	buf = getattr(_scratch, 'buf', None)
+	if buf is None or len(buf) < needed:
+		buf = _scratch.buf = bytearray(needed)
+	
+	used, crc = encodeInto(buf, data, maxLineLen)
+	postfile.write(memoryview(buf)[:used])
+	return crc
+
+def yEncode_Python(postfile, data, maxLineLen=128):
+	'Encode data into yEnc format, reusing a scratch buffer'
+	return _yenc_write(yEncodeInto_Python, postfile, data, maxLineLen)
+
+# ---------------------------------------------------------------------------
+# NumPy yEnc encoder. Escaping is done the same way as yEncodeInto_Python.
+# Where a line ends depends on where the one before it ended, but nearly
+# every line is just the next maxLineLen bytes of escaped data. The awkward
+# ones (starting with TAB/SPACE or a dot, or ending with TAB/SPACE or in the
+# middle of an escape) are found by looking at the first and last bytes of
+# the next few hundred lines at once. Each run of plain lines before one is
+# copied into place as the rows of a 2D array, with CRLF in the last two
+# columns, and only the awkward lines are written out one by one. Output
+# matches yEncode_Python3 byte for byte.
 
-YSPLIT_RE = re.compile(r'(\S+)=')
+# Number of lines to look through at a time for an awkward one
+YENC_NUMPY_LINES = 256
 
-# Split a =y* line into key/value pairs
+def yEncodeInto_NumPy(buf, data, maxLineLen=128):
+	'''Encode data into buf, which must be at least yEncodeBufferSize() bytes.
+	Returns (bytes used, crc).'''
+	escaped = _yenc_escape(data)
+	src = memoryview(escaped)
+	out = memoryview(buf)
+	length = len(escaped)
+	
+	srcarray = np.frombuffer(escaped, dtype=np.uint8)
+	outarray = np.frombuffer(buf, dtype=np.uint8)
+	crlf = np.array([13, 10], dtype=np.uint8)
+	width = maxLineLen + 2
+	
+	o = 0
+	start = 0
+	while True:
+		lines = min(YENC_NUMPY_LINES, (length - start) // maxLineLen)
+		if not lines:
+			break
+		
+		# The first and last bytes of the next few full lines. A line is
+		# awkward if it starts with TAB/SPACE or a dot (class 1 or 2), or
+		# ends with TAB/SPACE or '=' (class 1 or 3).
+		end = start + lines * maxLineLen
+		firsts = escaped[start:end:maxLineLen].translate(YENC_LINE_CLASSES)
+		lasts = escaped[start + maxLineLen - 1:end:maxLineLen].translate(YENC_LINE_CLASSES)
+		plain = lines - max(len(firsts.lstrip(b'\0\3')), len(lasts.lstrip(b'\0\2')))
+		
+		if plain:
+			rows = outarray[o:o + plain * width].reshape(plain, width)
+			rows[:, :maxLineLen] = srcarray[start:start + plain * maxLineLen].reshape(plain, maxLineLen)
+			rows[:, maxLineLen:] = crlf
+			o += plain * width
+			start += plain * maxLineLen
+		if plain < lines:
+			o, start = _yenc_awkward_line(out, o, src, start, start + maxLineLen)
+	
+	# What's left doesn't make a full line
+	while start < length:
+		o, start = _yenc_awkward_line(out, o, src, start, min(start + maxLineLen, length))
+	
+	return o, CRC32(data)
+
+def yEncodeMany_NumPy(datas, maxLineLen=128):
+	'Encode several parts into one buffer, returns a list of (encoded, crc) pairs'
+	datas = [memoryview(data).cast('B') for data in datas]
+	buf = bytearray(sum(yEncodeBufferSize(len(data), maxLineLen) for data in datas))
+	
+	results = []
+	view = memoryview(buf)
+	offset = 0
+	for data in datas:
+		used, crc = yEncodeInto_NumPy(view[offset:], data, maxLineLen)
+		results.append((view[offset:offset + used], crc))
+		offset += used
+	
+	return results
+
+def yEncode_NumPy(postfile, data, maxLineLen=128):
+	'Encode data into yEnc format using NumPy'
+	return _yenc_write(yEncodeInto_NumPy, postfile, data, maxLineLen)
+
+# ---------------------------------------------------------------------------
+
+class YencError(ValueError):
+	pass
+
+YFIELD_RE = re.compile(r'(\S+?)=(\S*)')
+YNAME_RE = re.compile(r'(?:^|\s)name=')
+
+# Split a =y* line into key/value pairs. name= is always last and the rest of
+# the line is the filename, spaces and all.
 def ySplit(line):
 	fields = {}
 	
-	parts = YSPLIT_RE.split(line)[1:]
-	if len(parts) % 2:
-		return fields
+	if line.startswith('=y'):
+		line = line.partition(' ')[2]
 	
-	for i in range(0, len(parts), 2):
-		key, value = parts[i], parts[i+1]
-		fields[key] = value.strip()
+	m = YNAME_RE.search(line)
+	if m:
+		fields['name'] = line[m.end():].rstrip('\r\n')
+		line = line[:m.start()]
+	
+	for key, value in YFIELD_RE.findall(line):
+		fields[key] = value
 	
 	return fields
 
+# Fields that are numbers, the rest are left as strings
+YINT_FIELDS = ('part', 'total', 'line', 'size', 'begin', 'end')
+
+# Parse a =ybegin, =ypart or =yend line, str or bytes. Returns the kind of
+# line ('ybegin', 'ypart' or 'yend') and its fields.
+def yParseLine(line):
+	if not isinstance(line, str):
+		line = bytes(line).decode('latin-1')
+	if not line.startswith('=y'):
+		raise YencError('not a =y line')
+	
+	fields = ySplit(line)
+	for key in YINT_FIELDS:
+		if key in fields:
+			try:
+				fields[key] = int(fields[key])
+			except ValueError:
+				raise YencError('bad %s= in =%s' % (key, line[1:].split(None, 1)[0]))
+	
+	return line[1:].split(None, 1)[0], fields
+
+# Decode the body of a yEnc article: =ybegin, maybe =ypart, the data and
+# =yend. Returns ({'ybegin': fields, 'ypart': fields, 'yend': fields}, data).
+# With `check` the sizes and CRCs have to add up, or we raise YencError.
+def yDecodeArticle(body, check=True):
+	body = bytes(body)
+	
+	if body.startswith(b'=ybegin '):
+		begin = 0
+	else:
+		begin = body.find(b'\n=ybegin ') + 1
+		if not begin:
+			raise YencError('no =ybegin line')
+	eol = body.find(b'\n', begin) + 1
+	if eol == 0:
+		raise YencError('no data')
+	
+	headers = {'ypart': {}}
+	kind, headers['ybegin'] = yParseLine(body[begin:eol])
+	if body.startswith(b'=ypart ', eol):
+		start = body.find(b'\n', eol) + 1
+		kind, headers['ypart'] = yParseLine(body[eol:start])
+	else:
+		start = eol
+	
+	end = body.rfind(b'\n=yend ', start - 1)
+	if end < 0:
+		raise YencError('no =yend line')
+	kind, headers['yend'] = yParseLine(body[end + 1:].split(b'\n', 1)[0])
+	data = yDecode(memoryview(body)[start:end + 1])
+	
+	if check:
+		yCheckPart(headers, data)
+	return headers, data
+
+# Make sure decoded data matches what the =y lines say about it
+def yCheckPart(headers, data):
+	ybegin, ypart, yend = headers['ybegin'], headers['ypart'], headers['yend']
+	
+	if ypart and 'begin' in ypart and 'end' in ypart:
+		expected = ypart['end'] - ypart['begin'] + 1
+		if len(data) != expected:
+			raise YencError('part is %d bytes, expected %d' % (len(data), expected))
+	elif not ypart and 'size' in ybegin and len(data) != ybegin['size']:
+		raise YencError('file is %d bytes, expected %d' % (len(data), ybegin['size']))
+	
+	if 'size' in yend and yend['size'] != len(data):
+		raise YencError('=yend size is %d, part is %d bytes' % (yend['size'], len(data)))
+	if 'part' in ybegin and 'part' in yend and ybegin['part'] != yend['part']:
+		raise YencError('=yend part is %d, =ybegin says %d' % (yend['part'], ybegin['part']))
+	
+	# crc32 is for the whole file, which is this part if there's no =ypart
+	for key in (('pcrc32',) if ypart else ('pcrc32', 'crc32')):
+		if key in yend:
+			try:
+				crc = int(yend[key], 16)
+			except ValueError:
+				raise YencError('bad %s' % (key))
+			if crc != zlib.crc32(data) & 0xffffffff:
+				raise YencError('%s mismatch' % (key))
+			break
+
 # ---------------------------------------------------------------------------
 
+# Name of the encoder yEncode() is using
 def yEncMode():
-	if HAVE_YENC_FRED:
-		return 'yenc-fred'
-	elif HAVE_YENC:
-		return 'yenc-vanilla'
-	elif HAVE_PSYCO:
-		return 'python-psyco'
-	else:
-		return 'python-vanilla'
+	return _mode
 
 # ---------------------------------------------------------------------------
 # Make a human readable CRC32 value
@@ -194,20 +595,174 @@ def CRC32(data):
 	return '%08x' % (zlib.crc32(data) & 2**32 - 1)
 
 # ---------------------------------------------------------------------------
-# Use the _yenc C module if it's available. If not, try to use psyco to speed
-# up part encoding 25-30%.
+# Encoders we know about, in the order we'd pick them without benchmarking.
+# Each one is encode(postfile, data) and returns the CRC of data.
+
+ENCODERS = collections.OrderedDict()
+
+def registerEncoder(name, encode, description):
+	ENCODERS[name] = (encode, description)
+
 try:
 	import _yenc
 except ImportError:
-	try:
-		import psyco
-	except ImportError:
-		pass
-	else:
-		HAVE_PSYCO = True
-		psyco.bind(yEncode_Python3)
-	yEncode = yEncode_Python3
+	pass
 else:
 	HAVE_YENC = True
-	HAVE_YENC_FRED = ('Freddie mod' in _yenc.__doc__)
-	yEncode = yEncode_C
+	HAVE_YENC_FRED = ('Freddie mod' in (_yenc.__doc__ or ''))
+	registerEncoder('yenc', yEncode_C, 'yenc C module%s' % (HAVE_YENC_FRED and ' (Freddie mod)' or ''))
+
+if sabyenc3 is not None:
+	registerEncoder('sabyenc3', yEncode_sabyenc3, 'sabyenc3 %s' % (getattr(sabyenc3, '__version__', '')))
+if rapidyenc is not None:
+	registerEncoder('rapidyenc', yEncode_rapidyenc, 'rapidyenc %s' % (getattr(rapidyenc, '__version__', '')))
+if HAVE_NUMPY:
+	registerEncoder('numpy', yEncode_NumPy, 'NumPy %s' % (np.__version__))
+registerEncoder('python', yEncode_Python, 'pure Python')
+
+# Until someone picks one, use the first that's there
+_mode = next(iter(ENCODERS))
+yEncode = ENCODERS[_mode][0]
+
+def useEncoder(name):
+	global _mode, yEncode
+	_mode = name
+	yEncode = ENCODERS[name][0]
+
+# ---------------------------------------------------------------------------
+# Raw bytes that end up as the awkward characters once encoded: NUL, TAB, LF,
+# CR, SPACE, dot and =.
+AWKWARD = bytes([(c + 256 - 42) % 256 for c in (0, 9, 10, 13, 32, 46, 61)])
+
+# How long to spend timing each encoder, and the size of part it encodes
+BENCH_TIME = 0.1
+BENCH_SIZE = 768000
+
+# Check that an encoder gives us good yEnc: the right CRC, lines an NNTP
+# server won't choke on, and the same data back when it's decoded. Returns
+# None if it's fine, or what's wrong.
+def checkEncoder(encode):
+	samples = [b'', b'.', b'Hello world', bytes(range(256)) * 8, AWKWARD * 300,
+		bytes([AWKWARD[5]]) * 1000, os.urandom(100000)]
+	samples.extend(AWKWARD[i:] + AWKWARD[:i] * 40 for i in range(len(AWKWARD)))
+	
+	for data in samples:
+		postfile = BytesIO()
+		try:
+			crc = encode(postfile, data)
+		except Exception as msg:
+			return 'failed with %s: %s' % (type(msg).__name__, msg)
+		
+		out = postfile.getvalue()
+		if crc != CRC32(data):
+			return 'wrong CRC'
+		if data and not out.endswith(b'\r\n'):
+			return 'no CRLF at the end'
+		
+		for line in out.split(b'\r\n')[:-1]:
+			if b'\r' in line or b'\n' in line or b'\0' in line:
+				return 'unescaped CR, LF or NUL'
+			if line.startswith(b'.') and not line.startswith(b'..'):
+				return 'line starting with an undoubled dot'
+			if len(line) > 998:
+				return 'line too long'
+		
+		if yDecode(out) != data:
+			return 'decodes to something else'
+	
+	return None
+
+# Time an encoder, returns MB/s. It gets run enough times to take about
+# BENCH_TIME seconds.
+def benchEncoder(encode, data, duration=BENCH_TIME):
+	postfile = BytesIO()
+	start = time.perf_counter()
+	encode(postfile, data)
+	once = max(time.perf_counter() - start, 1e-6)
+	
+	iterations = max(1, int(duration / once))
+	start = time.perf_counter()
+	for i in range(iterations):
+		postfile.seek(0)
+		encode(postfile, data)
+	elapsed = max(time.perf_counter() - start, 1e-6)
+	return len(data) * iterations / elapsed / 1024 / 1024
+
+# Check and time every encoder we have. Returns {name: {'description',
+# 'error', 'mbps'}}, bad encoders don't get timed.
+def benchEncoders(duration=BENCH_TIME, size=BENCH_SIZE):
+	data = os.urandom(size)
+	results = collections.OrderedDict()
+	for name, (encode, description) in ENCODERS.items():
+		error = checkEncoder(encode)
+		mbps = 0.0
+		if error is None:
+			mbps = benchEncoder(encode, data, duration)
+		results[name] = {'description': description, 'error': error, 'mbps': mbps}
+	return results
+
+# Results are only good for the same Python, machine and encoders
+def _cacheKey():
+	return '%s %s %s: %s' % (platform.python_implementation(), platform.python_version(),
+		platform.machine(), ', '.join(description for encode, description in ENCODERS.values()))
+
+_selected = {}
+
+# Pick the encoder to use. 'auto' checks and times them all and uses the
+# fastest one that works, remembering the results in cache_path (if given)
+# so we don't have to do it every time. Anything else is the name of the
+# encoder to use, as long as it works. Returns the name.
+def selectEncoder(preferred='auto', cache_path=None):
+	logger = logging.getLogger('yenc')
+	
+	if preferred != 'auto':
+		if preferred not in ENCODERS:
+			logger.warning('yEnc encoder "%s" is not available, picking one', preferred)
+		else:
+			error = checkEncoder(ENCODERS[preferred][0])
+			if error is None:
+				useEncoder(preferred)
+				return preferred
+			logger.warning('yEnc encoder "%s" gives bad output (%s), picking another', preferred, error)
+	
+	# Once is enough for each process
+	key = _cacheKey()
+	if key in _selected:
+		useEncoder(_selected[key])
+		return _selected[key]
+	
+	results = None
+	if cache_path:
+		try:
+			with open(cache_path) as f:
+				cached = json.load(f)
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError) as msg:
+			logger.warning('Unable to read yEnc encoder results from %s: %s', cache_path, msg)
+		else:
+			if cached.get('key') == key and set(cached.get('results', {})) == set(ENCODERS):
+				results = cached['results']
+	
+	if results is None:
+		results = benchEncoders()
+		for name, result in results.items():
+			if result['error'] is not None:
+				logger.warning('yEnc encoder "%s" gives bad output (%s), not using it', name, result['error'])
+			else:
+				logger.debug('yEnc encoder "%s": %.1fMB/s', name, result['mbps'])
+		
+		if cache_path:
+			tmp = cache_path + '.tmp'
+			try:
+				with open(tmp, 'w') as f:
+					json.dump({'key': key, 'results': results}, f, indent=1)
+				os.replace(tmp, cache_path)
+			except OSError as msg:
+				logger.warning('Unable to save yEnc encoder results to %s: %s', cache_path, msg)
+	
+	good = [(result['mbps'], name) for name, result in results.items() if result['error'] is None]
+	name = max(good)[1] if good else 'python'
+	_selected[key] = name
+	useEncoder(name)
+	return name
@@ -1,5 +1,19 @@
+import gzip
+import hashlib
+import io
+import importlib.util
+import json
+import os
+import pickle
+import random
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
+import unittest.mock
 import time
+import zlib
 
 try:
 	import xml.etree.cElementTree as ET
@@ -8,8 +22,27 @@ except:
 
 #from newsmangler import asyncnntp
 
+from newsmangler.aionntp import AioNNTP
 from newsmangler.article import Article
+from newsmangler.buffers import BufferPool
+from newsmangler.checksums import FileChecksum, crc32_combine
 from newsmangler.common import *
+from newsmangler.encoder import EncodePipeline
+from newsmangler.eventloop import EventLoop
+from newsmangler.fakenntp import FakeNNTPServer, check_article
+from newsmangler.filewrap import BACKENDS, FilePool, FileWrap
+from newsmangler.journal import Journal, file_identity
+from newsmangler.metrics import Registry
+from newsmangler.nzb import NZBWriter
+from newsmangler import par2
+from newsmangler import yenc
+from newsmangler import planner
+from newsmangler.planner import ArticlePlanner
+from newsmangler.ratelimit import SO_MAX_PACING_RATE, RateLimiter
+from newsmangler.postmangler import PostMangler
+from newsmangler.servers import RANK_OK, RANK_PENALISED, RANK_SLOW, ServerPool, ServerState
+from newsmangler.verify import read_nzb
+from newsmangler import workers
 
 
 class DummyFileWrapper:
@@ -53,14 +86,1171 @@ class TestArticle(unittest.TestCase):
 
 	
 	def test_article(self):
-		self.art.prepare()
+		size = self.art.prepare()
 		
 		ioRepresentation = self.art.postfile
 		print(ioRepresentation.getvalue())
+		
+		data = b''.join(self.art.buffers())
+		self.assertEqual(size, len(data))
+		self.assertTrue(data.startswith(b'From: testFrom@Account\r\n'))
+		self.assertTrue(data.endswith(b' pcrc32=8bd69e52\r\n.\r\n'))
 	
 	def test_test(self):
 	    print(self.fileWrapper.read_part(1,2))
 	    #r––™J¡™œ–Ž4
+
+class TestChecksums(unittest.TestCase):
+	def test_crc32_combine(self):
+		for size in (0, 1, 7, 4096, 768000):
+			a, b = os.urandom(1000), os.urandom(size)
+			self.assertEqual(zlib.crc32(a + b), crc32_combine(zlib.crc32(a), zlib.crc32(b), size))
+	
+	def test_parts_out_of_order(self):
+		data = os.urandom(10000)
+		parts = [(begin, data[begin:begin + 3000]) for begin in range(0, len(data), 3000)]
+		random.shuffle(parts)
+		
+		checksum = FileChecksum('x', len(data), ['md5', 'sha1'])
+		for begin, part in parts:
+			self.assertEqual(None, checksum.crc32())
+			checksum.add_crc(begin, len(part), zlib.crc32(part))
+			checksum.feed(begin, memoryview(part))
+		
+		# Retried parts get seen again
+		begin, part = parts[0]
+		checksum.add_crc(begin, len(part), zlib.crc32(part))
+		checksum.feed(begin, part)
+		self.assertEqual('%08x' % (zlib.crc32(data)), checksum.crc32())
+		self.assertEqual(hashlib.md5(data).hexdigest(), checksum.hexdigest('md5'))
+		self.assertEqual(hashlib.sha1(data).hexdigest(), checksum.hexdigest('sha1'))
+		
+		# Copies sent to encoder processes don't know anything
+		self.assertEqual(None, pickle.loads(pickle.dumps(checksum)).crc32())
+	
+	def test_last_part_gets_file_crc(self):
+		fd, path = tempfile.mkstemp()
+		os.write(fd, os.urandom(2500))
+		os.close(fd)
+		self.addCleanup(os.remove, path)
+		
+		fileinfo = {'filename': 'x', 'filesize': 2500, 'parts': 3, 'checksum': FileChecksum('x', 2500)}
+		wrap = FileWrap(path, 3)
+		articles = [Article(wrap, i * 1000, min(2500, i * 1000 + 1000), fileinfo, 'x (%d/3)', i + 1)
+			for i in range(3)]
+		
+		# The last part was encoded first, it gets the CRC32 once the others are
+		articles[2].prepare()
+		self.assertNotIn(b' crc32=', b''.join(articles[2].buffers()))
+		articles[0].prepare()
+		articles[1].prepare()
+		data = b''.join(articles[2].buffers())
+		with open(path, 'rb') as f:
+			self.assertTrue(data.endswith((' crc32=%08x\r\n.\r\n' % (zlib.crc32(f.read()))).encode('ascii')))
+		self.assertEqual(len(data), articles[2].prepared_size())
+
+class TestBufferPool(unittest.TestCase):
+	def test_reuse(self):
+		pool = BufferPool(1, 100)
+		first = pool.get()
+		first.write(b'abc')
+		buf = first.buf
+		pool.put(first)
+		
+		second = pool.get()
+		self.assertTrue(second.buf is buf)
+		self.assertEqual(0, second.tell())
+		self.assertEqual(b'', second.getvalue())
+		
+		# The pool is out, this one gets thrown away when it comes back
+		third = pool.get()
+		self.assertEqual(0, pool.available())
+		pool.put(third)
+		pool.put(second)
+		self.assertEqual((2, 1, 1), (pool.hits, pool.misses, pool.available()))
+	
+	def test_allocated_when_needed(self):
+		pool = BufferPool(1000, 1 << 20)
+		self.assertEqual(([], 1000), (pool._free, pool.available()))
+		articlebuf = pool.get()
+		pool.put(articlebuf)
+		self.assertEqual((1, 1, 0), (len(pool._free), pool.hits, pool.misses))
+	
+	def test_auto_size(self):
+		for streaming, count in ((0, 4 + 6), ('auto', 4 * 8 + 6)):
+			conf = {
+				'posting': {'from': 'a <a@b>', 'default_group': 'alt.test', 'article_size': 8000, 'yenc_cache': '',
+					'server_state': '', 'encoder_workers': 2},
+				'server': {'hostname': '127.0.0.1', 'port': 1, 'connections': 4, 'streaming': streaming},
+			}
+			mangler = PostMangler(conf, False)
+			mangler.start_buffer_pool()
+			mangler.loop.close()
+			self.assertEqual(count, mangler._bufpool.count)
+	
+	def test_busy_buffer_not_reused(self):
+		pool = BufferPool(1, 10)
+		articlebuf = pool.get()
+		articlebuf.write(b'0123456789abc')
+		view = articlebuf.getbuffer()
+		buf = articlebuf.buf
+		pool.put(articlebuf)
+		
+		self.assertEqual(1, pool.discarded)
+		self.assertFalse(pool.get().buf is buf)
+		self.assertEqual(b'0123456789abc', bytes(view))
+	
+	def test_article_encodes_into_pool(self):
+		fileinfo = {'filename': 'x', 'filesize': 11, 'parts': 1}
+		plain = Article(DummyFileWrapper(), 0, 11, fileinfo, 'x', 1)
+		pooled = Article(DummyFileWrapper(), 0, 11, fileinfo, 'x', 1, BufferPool(1, yenc.yEncodeBufferSize(11)))
+		plain.prepare()
+		pooled.prepare()
+		self.assertEqual(0, pooled._bufpool.available())
+		self.assertEqual(b''.join(plain.buffers()), b''.join(pooled.buffers()))
+		
+		pooled.release()
+		self.assertEqual(1, pooled._bufpool.available())
+		self.assertEqual(1, pooled._bufpool.hits)
+
+class TestRateLimiter(unittest.TestCase):
+	def test_parse_rate(self):
+		self.assertEqual(0, parseRate(0))
+		self.assertEqual(800 * 1024, parseRate('800'))
+		self.assertEqual(50 * 1024 ** 2, parseRate('50M'))
+		self.assertEqual(50000000, parseRate('400Mbit'))
+		self.assertEqual(50 * 1024 ** 2, parseRate('50MB/s'))
+		self.assertEqual(800 * 1024, parseRate('800 KB'))
+		self.assertEqual(50000000, parseRate('400Mbps'))
+		self.assertEqual(50000000, parseRate('400Mbit/s'))
+		self.assertRaises(ValueError, parseRate, '50MB/hour')
+		self.assertRaises(ValueError, parseRate, 'lots')
+	
+	def test_token_bucket(self):
+		limiter = RateLimiter(1024 ** 2, kernel_pacing=False)
+		limiter.add(object())
+		limiter.add(object())
+		self.assertEqual(5242, limiter.quantum())
+		
+		# Nobody gets more than their share at a time, and once the bucket
+		# is empty we have to wait.
+		limiter._tokens = limiter.capacity()
+		self.assertEqual(100, limiter.allow(100))
+		self.assertEqual(5242, limiter.allow(1000000))
+		limiter._tokens = 0
+		self.assertEqual(0, limiter.allow(1000000))
+		self.assertTrue(0 < limiter.delay(1000000) <= 5242.0 / 1024 ** 2)
+		
+		limiter.set_rate(0)
+		self.assertEqual(1000000, limiter.allow(1000000))
+	
+	@unittest.skipUnless(SO_MAX_PACING_RATE is not None, 'no kernel pacing')
+	def test_kernel_pacing(self):
+		import socket
+		socks = [socket.socket(), socket.socket()]
+		try:
+			try:
+				socks[0].setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, 1000)
+			except OSError:
+				self.skipTest('no kernel pacing')
+			
+			limiter = RateLimiter(100000)
+			for sock in socks:
+				limiter.add(sock)
+			self.assertFalse(limiter.limited())
+			self.assertEqual(50000, socks[1].getsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE))
+			limiter.remove(socks[0])
+			self.assertEqual(100000, socks[1].getsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE))
+		finally:
+			for sock in socks:
+				sock.close()
+
+class TestMetrics(unittest.TestCase):
+	def test_render(self):
+		metrics = Registry()
+		sent = metrics.counter('sent_total', 'Bytes sent', ('server',))
+		metrics.gauge('left', 'Articles left', func=lambda: 3)
+		wait = metrics.histogram('wait_seconds', 'Waiting', buckets=(0.1, 1.0))
+		
+		sent.labels(server='one').inc(100)
+		sent.labels(server='one').inc(20)
+		wait.observe(0.05)
+		wait.observe(0.5)
+		wait.observe(5)
+		metrics.snapshot()
+		
+		lines = metrics.text.splitlines()
+		self.assertTrue('# TYPE sent_total counter' in lines)
+		self.assertTrue('sent_total{server="one"} 120' in lines)
+		self.assertTrue('left 3' in lines)
+		self.assertTrue('wait_seconds_bucket{le="0.1"} 1' in lines)
+		self.assertTrue('wait_seconds_bucket{le="1.0"} 2' in lines)
+		self.assertTrue('wait_seconds_bucket{le="+Inf"} 3' in lines)
+		self.assertTrue('wait_seconds_count 3' in lines)
+		
+		data = json.loads(metrics.json)
+		self.assertEqual(120, data['sent_total']['samples'][0]['value'])
+		self.assertEqual(3, data['wait_seconds']['samples'][0]['buckets']['+Inf'])
+	
+	def test_counters_keep_going_up(self):
+		metrics = Registry()
+		posted = [0]
+		metrics.counter('posted_total', 'Articles posted', func=lambda: posted[0])
+		metrics.counter('by_server_total', 'Articles posted', ('server',),
+			func=lambda: [({'server': 'one'}, posted[0] * 2)])
+		
+		# A new run starts counting again
+		for value, total in ((5, 5), (8, 8), (0, 8), (3, 11), (1, 12)):
+			posted[0] = value
+			metrics.snapshot()
+			lines = metrics.text.splitlines()
+			self.assertTrue('posted_total %d' % (total) in lines)
+			self.assertTrue('by_server_total{server="one"} %d' % (total * 2) in lines)
+
+class TestEventLoop(unittest.TestCase):
+	def setUp(self):
+		self.loop = EventLoop()
+		self.fired = []
+	
+	def tearDown(self):
+		self.loop.close()
+	
+	def test_timers_fire_in_order(self):
+		self.loop.call_later(0.02, self.fired.append, 2)
+		self.loop.call_later(0.01, self.fired.append, 1)
+		cancelled = self.loop.call_later(0.01, self.fired.append, 3)
+		cancelled.cancel()
+		
+		start = time.time()
+		while len(self.fired) < 2 and time.time() - start < 1:
+			self.loop.run_once()
+		
+		self.assertEqual([1, 2], self.fired)
+	
+	def test_run_once_blocks_until_timer(self):
+		self.loop.call_later(0.05, self.fired.append, 1)
+		start = time.time()
+		self.loop.run_once()
+		self.assertEqual([1], self.fired)
+		self.assertTrue(time.time() - start >= 0.04)
+
+class TestFilePool(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.paths = []
+		for i in range(3):
+			path = os.path.join(self.tmpdir, 'file%d' % (i))
+			with open(path, 'wb') as f:
+				f.write(bytes(range(256)) * (i + 1))
+			self.paths.append(path)
+	
+	def tearDown(self):
+		for path in self.paths:
+			os.remove(path)
+		os.rmdir(self.tmpdir)
+	
+	def test_backends_read_the_same(self):
+		for backend in BACKENDS:
+			pool = FilePool(2, backend)
+			wrap = FileWrap(self.paths[2], 3, pool)
+			got = [bytes(wrap.read_part(i * 256, (i + 1) * 256)) for i in range(3)]
+			self.assertEqual([bytes(range(256))] * 3, got, backend)
+			pool.close()
+	
+	def test_open_files_are_limited(self):
+		pool = FilePool(2, 'read')
+		for path in self.paths:
+			self.assertEqual(b'\x00\x01', pool.read(path, 0, 2))
+		self.assertEqual(2, len(pool._open))
+		self.assertEqual(self.paths[1:], list(pool._open))
+		
+		# Files being read from don't get closed
+		f = pool.acquire(self.paths[1])
+		pool.read(self.paths[0], 0, 2)
+		self.assertTrue(self.paths[1] in pool._open)
+		pool.release(self.paths[1], f)
+		pool.close()
+	
+	def test_finished_files_are_closed(self):
+		pool = FilePool(2, 'read')
+		wrap = FileWrap(self.paths[0], 2, pool)
+		wrap.read_part(0, 128)
+		self.assertTrue(self.paths[0] in pool._open)
+		wrap.read_part(128, 256)
+		self.assertFalse(self.paths[0] in pool._open)
+
+class TestJournal(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp()
+		os.close(fd)
+	
+	def tearDown(self):
+		os.remove(self.path)
+	
+	def test_resume(self):
+		key, identity = file_identity(self.path)
+		journal = Journal(self.path, sync_interval=0.01)
+		journal.add_file(key, identity)
+		journal.part_done(key, 1, 100, '<1@test>')
+		journal.part_done(key, 3, 50, '<3@test>')
+		journal.close()
+		
+		# A line cut short by a crash gets ignored
+		with open(self.path, 'a') as f:
+			f.write('{"part": "%s", "num": 2, "by' % (key))
+		
+		journal = Journal(self.path, resume=True)
+		self.assertEqual([1, 3], sorted(journal.done_parts(key)))
+		self.assertEqual('<3@test>', journal.done_parts(key)[3]['msgid'])
+		journal.close()
+		
+		# Not resuming ignores the old records but keeps them around
+		journal = Journal(self.path)
+		self.assertEqual({}, journal.done_parts(key))
+		journal.part_done(key, 4, 10, '<4@test>')
+		journal.close()
+		journal = Journal(self.path, resume=True)
+		self.assertEqual([1, 3, 4], sorted(journal.done_parts(key)))
+		journal.close()
+	
+	def test_only_when_asked(self):
+		conf = {
+			'posting': {'from': 'a <a@b>', 'default_group': 'alt.test', 'article_size': 8000, 'yenc_cache': '',
+				'server_state': '', 'resume': True},
+			'server': {'hostname': '127.0.0.1', 'port': 1, 'connections': 1},
+		}
+		mangler = PostMangler(conf, False)
+		mangler.open_journal()
+		self.assertEqual(None, mangler._journal)
+		
+		conf['posting']['journal'] = self.path
+		mangler.open_journal()
+		self.assertTrue(mangler._journal is not None)
+		mangler._journal.close()
+		mangler.loop.close()
+	
+	def test_identity_changes(self):
+		key, identity = file_identity(self.path)
+		with open(self.path, 'wb') as f:
+			f.write(b'something else')
+		self.assertNotEqual(key, file_identity(self.path)[0])
+
+class TestNZBWriter(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp()
+		os.close(fd)
+	
+	def tearDown(self):
+		os.remove(self.path)
+	
+	def test_files_written_when_done(self):
+		writer = NZBWriter(self.path, 'Bob <bob@home>', ['a.b.test'], compress=True)
+		writer.add_segment('two (1/2)', 2, 2, '<2b@test>', 20, 200)
+		writer.add_segment('one & co (1/1)', 1, 1, '<1a@test>', 10, 100)
+		self.assertEqual(['two (1/2)'], list(writer._files))
+		writer.skip_segment('three (1/1)', 1)
+		writer.add_segment('two (1/2)', 2, 1, '<2a@test>', 30, 150)
+		self.assertEqual({}, writer._files)
+		self.assertEqual(self.path, writer.close())
+		
+		with gzip.open(self.path) as f:
+			root = ET.parse(f).getroot()
+		files = root.findall('file')
+		self.assertEqual(['one & co (1/1)', 'two (1/2)'], [f.get('subject') for f in files])
+		self.assertEqual('150', files[1].get('date'))
+		self.assertEqual(['2a@test', '2b@test'], [s.text for s in files[1].iter('segment')])
+		self.assertEqual(['1', '2'], [s.get('number') for s in files[1].iter('segment')])
+	
+	def test_nothing_posted(self):
+		writer = NZBWriter(self.path, 'Bob <bob@home>', ['a.b.test'])
+		writer.skip_segment('one (1/1)', 1)
+		self.assertEqual(None, writer.close())
+
+@unittest.skipUnless(par2.HAVE_NUMPY, 'needs NumPy')
+class TestPar2(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.files = []
+		for i, size in enumerate((5000, 4096, 123)):
+			path = os.path.join(self.tmpdir, 'file%d' % (i))
+			with open(path, 'wb') as f:
+				f.write(os.urandom(size))
+			self.files.append((path, 'file%d' % (i), size))
+	
+	def tearDown(self):
+		for name in os.listdir(self.tmpdir):
+			os.remove(os.path.join(self.tmpdir, name))
+		os.rmdir(self.tmpdir)
+	
+	def test_parity_slice(self):
+		from concurrent.futures import ThreadPoolExecutor
+		executor = ThreadPoolExecutor(2)
+		builder = par2.Par2Builder(os.path.join(self.tmpdir, 'set'), self.files, 1024, 20, executor, 2)
+		self.assertEqual(10, builder.total_blocks)
+		self.assertEqual(['set.par2', 'set.vol00+01.par2', 'set.vol01+01.par2'],
+			[os.path.basename(path) for path, start, count in builder.volumes])
+		
+		done = threading.Event()
+		builder.on_done = lambda builder, ok: (self.assertTrue(ok), done.set())
+		
+		# Parts turn up in any order, and again when they're retried
+		reads = []
+		for path, name, size in self.files:
+			with open(path, 'rb') as f:
+				data = f.read()
+			reads.extend((path, begin, data[begin:begin + 2048]) for begin in range(0, size, 2048))
+		random.shuffle(reads)
+		for path, begin, data in reads + reads[:2]:
+			builder.feeder(path)(begin, data)
+		self.assertTrue(done.wait(10))
+		executor.shutdown()
+		self.check_parity(builder, 1024)
+	
+	def test_many_batches(self):
+		from concurrent.futures import ThreadPoolExecutor
+		executor = ThreadPoolExecutor(2)
+		builder = par2.Par2Builder(os.path.join(self.tmpdir, 'set'), self.files, 64, 5, executor, 2)
+		self.assertTrue(builder.total_blocks > par2.BATCH_SLICES * 4)
+		
+		done = threading.Event()
+		builder.on_done = lambda builder, ok: (self.assertTrue(ok), done.set())
+		
+		# Several readers at once, while the workers are busy with batches
+		def feed(path, size):
+			with open(path, 'rb') as f:
+				data = f.read()
+			for begin in range(0, size, 256):
+				builder.feeder(path)(begin, data[begin:begin + 256])
+		threads = [threading.Thread(target=feed, args=(path, size)) for path, name, size in self.files]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertTrue(done.wait(10))
+		executor.shutdown()
+		self.check_parity(builder, 64)
+	
+	def test_slices_far_out_of_order(self):
+		from concurrent.futures import ThreadPoolExecutor
+		executor = ThreadPoolExecutor(1)
+		builder = par2.Par2Builder(os.path.join(self.tmpdir, 'set'), self.files, 64, 5, executor, 1)
+		done = threading.Event()
+		builder.on_done = lambda builder, ok: (self.assertTrue(ok), done.set())
+		
+		# Backwards is as far out of order as it gets, the hash comes from
+		# reading the file again
+		with unittest.mock.patch.object(par2, 'EARLY_SLICES', 4):
+			for path, name, size in self.files:
+				with open(path, 'rb') as f:
+					data = f.read()
+				for begin in reversed(range(0, size, 64)):
+					builder.feeder(path)(begin, data[begin:begin + 64])
+				par2file = builder._by_path[path]
+				self.assertTrue(len(par2file._early) <= 4)
+			self.assertTrue(done.wait(10))
+		executor.shutdown()
+		
+		for par2file in builder.files:
+			with open(par2file.filepath, 'rb') as f:
+				self.assertEqual(hashlib.md5(f.read()).digest(), par2file.hash)
+		self.check_parity(builder, 64)
+	
+	def test_part_failed(self):
+		from concurrent.futures import ThreadPoolExecutor
+		executor = ThreadPoolExecutor(1)
+		builder = par2.Par2Builder(os.path.join(self.tmpdir, 'set'), self.files, 1024, 20, executor, 1)
+		done = threading.Event()
+		results = []
+		builder.on_done = lambda builder, ok: (results.append(ok), done.set())
+		
+		path, name, size = self.files[0]
+		with open(path, 'rb') as f:
+			data = f.read()
+		builder.feeder(path)(2048, data[2048:4096])
+		
+		# Parts we already have don't matter, one we don't is the end of it
+		self.assertFalse(builder.part_failed(path, 2048, 4096))
+		self.assertTrue(builder.part_failed(path, 0, 2048))
+		self.assertFalse(builder.part_failed(path, 4096, 5000))
+		self.assertTrue(done.wait(10))
+		executor.shutdown()
+		
+		self.assertEqual([False], results)
+		self.assertEqual({}, builder._by_path[path]._early)
+		self.assertEqual([], [name for name in os.listdir(self.tmpdir) if name.endswith('.par2')])
+		self.assertFalse(os.path.exists(builder._tmpdir))
+	
+	# Recovery slice 0 is every input slice XORed together
+	def check_parity(self, builder, block_size):
+		parity = bytearray(block_size)
+		for path, name, size in self.files:
+			with open(path, 'rb') as f:
+				data = f.read()
+			for begin in range(0, size, block_size):
+				for i, byte in enumerate(data[begin:begin + block_size]):
+					parity[i] ^= byte
+		
+		with open(builder.volumes[1][0], 'rb') as f:
+			data = f.read()
+		self.assertEqual(par2.MAGIC, data[:8])
+		self.assertEqual(par2.TYPE_RECVSLIC, data[48:64])
+		self.assertEqual(0, struct.unpack('<I', data[64:68])[0])
+		self.assertEqual(bytes(parity), data[68:68 + block_size])
+
+def build_article(filewrap, begin, end, fileinfo, subject, partnum, msgid=None, bufpool=None):
+	art = Article(filewrap, begin, end, fileinfo, subject, partnum, bufpool)
+	art.headers['Subject'] = subject % (partnum)
+	art.headers['Message-ID'] = msgid
+	return art
+
+class TestArticlePlanner(unittest.TestCase):
+	def setUp(self):
+		self.scanned = []
+		self.msgids = []
+		self.planner = ArticlePlanner(build_article, MessageIDs('test'))
+	
+	def scan(self, name, parts):
+		self.scanned.append(name)
+		fileinfo = {'dirname': name, 'filename': name, 'filesize': parts * 10, 'parts': parts}
+		fileidx = self.planner.add_file(DummyFileWrapper(), fileinfo, name + ' (%d/' + str(parts) + ')')
+		for partnum in range(1, parts + 1):
+			self.msgids.append(self.planner.add_part(fileidx, partnum, (partnum - 1) * 10, partnum * 10))
+	
+	def test_sources_are_scanned_lazily(self):
+		self.planner.add_source(self.scan, 'one', 2)
+		self.planner.add_source(self.scan, 'two', 1)
+		self.assertEqual([], self.scanned)
+		
+		self.assertTrue(self.planner.scan())
+		self.assertEqual(['one'], self.scanned)
+		self.assertEqual(2, self.planner.remaining())
+		
+		subjects = []
+		while self.planner.has_more():
+			article = self.planner.next_article()
+			subjects.append(article.headers['Subject'])
+		
+		self.assertEqual(['one (1/2)', 'one (2/2)', 'two (1/1)'], subjects)
+		self.assertEqual(['one', 'two'], self.scanned)
+		self.assertEqual(3, self.planner.total)
+		self.assertEqual(None, self.planner.next_article())
+	
+	def test_message_ids(self):
+		self.planner.add_source(self.scan, 'one', 2)
+		self.planner.add_source(self.scan, 'two', 2)
+		self.planner.scan_all()
+		self.assertEqual(['one', 'two'], self.scanned)
+		self.assertEqual(4, len(set(self.msgids)))
+		
+		# Known before the articles are built, and different every run
+		got = [self.planner.next_article().headers['Message-ID'] for i in range(4)]
+		self.assertEqual(self.msgids, got)
+		self.assertTrue(got[0].endswith('@test>'))
+		self.assertNotEqual(got[0], ArticlePlanner(build_article, MessageIDs('test')).add_part(0, 1, 0, 10))
+	
+	def test_compaction_keeps_order(self):
+		parts = planner.COMPACT_ROWS * 2 + 10
+		self.scan('big', parts)
+		for partnum in range(1, parts + 1):
+			article = self.planner.next_article()
+			self.assertEqual(partnum, article._partnum)
+			self.assertEqual((partnum - 1) * 10, article._begin)
+		self.assertFalse(self.planner.has_more())
+
+class TestRetry(unittest.TestCase):
+	def setUp(self):
+		conf = {
+			'posting': {'engine': 'asyncio', 'generate_nzbs': 0, 'yenc_cache': '', 'retry_attempts': 3, 'retry_delay': 1, 'retry_max_delay': 2},
+			'server': {'connections': 1},
+		}
+		self.mangler = PostMangler(conf, False)
+		self.mangler._planner = ArticlePlanner(build_article)
+		self.mangler._call_later = self.call_later
+		self.mangler._parts_left['post_title'] = 1
+		self.delays = []
 		
+		fileinfo = {'dirname': 'post_title', 'filename': 'real_filename', 'filesize': 11, 'parts': 1}
+		self.article = build_article(DummyFileWrapper(), 0, 11, fileinfo, 'testSubject (%d/1)', 1)
+	
+	def tearDown(self):
+		self.mangler.loop.close()
+	
+	def call_later(self, delay, callback):
+		self.delays.append(delay)
+	
+	def test_backoff_and_give_up(self):
+		for attempt in range(1, 3):
+			self.mangler.post_failed(self.article, '441 nope')
+			self.assertEqual(attempt, self.article.attempts)
+			self.assertTrue(self.mangler.has_work())
+			
+			# Not due yet
+			self.assertEqual(None, self.mangler.next_article())
+			self.mangler._retries[0] = (0,) + self.mangler._retries[0][1:]
+			self.assertTrue(self.mangler.next_article() is self.article)
+		
+		self.assertTrue(0.5 <= self.delays[0] <= 1.5)
+		self.assertTrue(1.0 <= self.delays[1] <= 3.0)
+		
+		self.mangler.post_failed(self.article, '441 nope')
+		self.assertFalse(self.mangler.has_work())
+		self.assertEqual([(self.article, '441 nope')], self.mangler._failed)
+		self.assertEqual({}, self.mangler._parts_left)
+
+class DummyConn:
+	def __init__(self, pool):
+		self.pool = pool
+		self.retiring = False
+		pool.conns.append(self)
+	
+	def is_connected(self):
+		return True
+
+class TestAioNNTP(unittest.TestCase):
+	def test_retire_while_reconnecting(self):
+		import asyncio
+		conf = {
+			'posting': {'from': 'a <a@b>', 'default_group': 'alt.test', 'article_size': 8000, 'yenc_cache': '',
+				'server_state': ''},
+			'server': {'hostname': '127.0.0.1', 'port': 1, 'connections': 1},
+		}
+		mangler = PostMangler(conf, False)
+		conn = AioNNTP(mangler, mangler._pools[0], 1, '127.0.0.1', 1, None, '', '', 0)
+		
+		async def retire():
+			mangler._all_done = asyncio.Event()
+			pause = asyncio.ensure_future(conn.pause(30))
+			await asyncio.sleep(0)
+			conn.retire()
+			await asyncio.wait_for(pause, 1)
+		asyncio.run(retire())
+		mangler.loop.close()
+		self.assertEqual(None, conn._wakeup)
+
+class TestServerPool(unittest.TestCase):
+	def test_penalty_and_rank(self):
+		pool = ServerPool('one', {'weight': 2, 'penalty_time': 10})
+		for i in range(3):
+			pool.post_ok(1000, 1.0)
+		self.assertEqual(0, pool.post_failed(100.0))
+		self.assertEqual(0, pool.post_failed(100.0))
+		self.assertEqual(RANK_OK, pool.rank(100.0, pool.rate))
+		self.assertEqual(10, pool.post_failed(100.0))
+		self.assertEqual(RANK_PENALISED, pool.rank(105.0, pool.rate))
+		self.assertEqual(RANK_OK, pool.rank(110.0, pool.rate))
+		
+		pool.post_ok(1000, 1.0)
+		self.assertEqual(RANK_SLOW, pool.rank(110.0, pool.rate * 10))
+		self.assertEqual(0.0, ServerPool('two', {'weight': 2}).load())
+	
+	def test_adapt_connections(self):
+		pool = ServerPool('one', {'connections': 2, 'max_connections': 4})
+		self.assertTrue(pool.adaptive)
+		self.assertEqual(2, pool.adapt(0.0))
+		
+		# More while it helps, back off when it doesn't or there are errors
+		pool.post_ok(1000, 1.0)
+		self.assertEqual(3, pool.adapt(1.0))
+		pool.post_ok(1000, 1.0)
+		self.assertEqual(2, pool.adapt(2.0))
+		pool.conn_failed()
+		self.assertEqual(1, pool.adapt(3.0))
+		self.assertEqual((1000, 2), pool.best)
+		
+		self.assertFalse(ServerPool('two', {'connections': 2}).adaptive)
+	
+	def test_server_state(self):
+		tmpdir = tempfile.mkdtemp()
+		path = os.path.join(tmpdir, 'state')
+		try:
+			state = ServerState(path)
+			self.assertEqual(None, state.get('one:119', 'connections'))
+			state.set('one:119', connections=3, article_size=384000)
+			state.save()
+			
+			state = ServerState(path)
+			self.assertEqual(3, state.get('one:119', 'connections'))
+			self.assertEqual(384000, state.get('one:119', 'article_size'))
+			
+			# Somewhere we can't write only gets a warning
+			state = ServerState(os.path.join(tmpdir, 'missing', 'state'))
+			state.set('one:119', connections=3)
+			state.save()
+			self.assertTrue(state.changed)
+		finally:
+			shutil.rmtree(tmpdir)
+	
+	def test_failed_articles_move(self):
+		conf = {
+			'posting': {'engine': 'asyncio', 'generate_nzbs': 0, 'yenc_cache': '', 'retry_delay': 1},
+			'server': {'hostname': 'one', 'connections': 1},
+			'server:two': {'weight': 3},
+		}
+		mangler = PostMangler(conf, False)
+		mangler._planner = ArticlePlanner(build_article)
+		mangler._call_later = lambda delay, callback: None
+		mangler._parts_left['post_title'] = 1
+		one, two = mangler._pools
+		self.assertEqual(['one', 'two'], [one.name, two.name])
+		self.assertEqual(3, two.weight)
+		conn_one, conn_two = DummyConn(one), DummyConn(two)
+		
+		fileinfo = {'dirname': 'post_title', 'filename': 'real_filename', 'filesize': 11, 'parts': 1}
+		article = build_article(DummyFileWrapper(), 0, 11, fileinfo, 'testSubject (%d/1)', 1)
+		article.server = 'one'
+		mangler.post_failed(article, '441 nope')
+		mangler._retries[0] = (0,) + mangler._retries[0][1:]
+		
+		self.assertEqual(None, mangler.next_article(conn_one))
+		self.assertTrue(mangler.next_article(conn_two) is article)
+		self.assertEqual('two', article.server)
+		self.assertEqual(1, two.dispatched)
+		mangler.loop.close()
+
+class TestEncodePipeline(unittest.TestCase):
+	def setUp(self):
+		self.loop = EventLoop()
+		self.planner = ArticlePlanner(build_article)
+		fileinfo = {'dirname': 'post_title', 'filename': 'real_filename', 'filesize': 11, 'parts': 5}
+		fileidx = self.planner.add_file(DummyFileWrapper(), fileinfo, 'testSubject (%d/5)')
+		for partnum in range(1, 6):
+			self.planner.add_part(fileidx, partnum, 0, 11)
+	
+	def tearDown(self):
+		self.loop.close()
+	
+	def test_articles_come_out_in_order(self):
+		pipeline = EncodePipeline(self.planner, 2, 2, False, self.loop.call_soon_threadsafe)
+		pipeline.fill()
+		self.assertEqual(2, pipeline.pending())
+		self.assertEqual(3, self.planner.remaining())
+		
+		got = []
+		start = time.time()
+		while len(got) < 5 and time.time() - start < 5:
+			article = pipeline.get()
+			if article is None:
+				self.loop.run_once(0.1)
+			else:
+				self.assertTrue(article.is_prepared())
+				got.append(article.headers['Subject'])
+		pipeline.close()
+		
+		self.assertEqual(['testSubject (%d/5)' % (i) for i in range(1, 6)], got)
+	
+	def test_failed_articles_are_passed_on(self):
+		failed = []
+		pipeline = EncodePipeline(self.planner, 2, 5, False, self.loop.call_soon_threadsafe)
+		pipeline.on_failed = lambda article, reason: failed.append(article.headers['Subject'])
+		with unittest.mock.patch.object(DummyFileWrapper, 'read_part', side_effect=OSError('nope')):
+			pipeline.fill()
+			start = time.time()
+			while pipeline.pending() and time.time() - start < 5:
+				self.assertEqual(None, pipeline.get())
+				self.loop.run_once(0.1)
+		pipeline.close()
+		
+		self.assertEqual(['testSubject (%d/5)' % (i) for i in range(1, 6)], failed)
+	
+	def test_waits_for_buffers(self):
+		bufpool = BufferPool(2, yenc.yEncodeBufferSize(11))
+		self.planner._build_article = lambda *args: build_article(*args, bufpool=bufpool)
+		pipeline = EncodePipeline(self.planner, 2, 5, False, self.loop.call_soon_threadsafe, bufpool)
+		bufpool.on_free = pipeline.buffer_freed
+		pipeline.fill()
+		self.assertEqual(2, pipeline.pending())
+		
+		got = []
+		start = time.time()
+		while len(got) < 2 and time.time() - start < 5:
+			article = pipeline.get()
+			if article is None:
+				self.loop.run_once(0.1)
+			else:
+				got.append(article)
+		self.assertEqual(0, pipeline.pending())
+		
+		# Posting one lets the next one start
+		got[0].release()
+		self.assertEqual(1, pipeline.pending())
+		pipeline.close()
+		
+class TestPosting(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.postdir = os.path.join(self.tmpdir, 'test post')
+		os.mkdir(self.postdir)
+		self.data = {}
+		for i, size in enumerate((1, 5000, 25000)):
+			self.data['file%d.bin' % (i)] = os.urandom(size)
+			with open(os.path.join(self.postdir, 'file%d.bin' % (i)), 'wb') as f:
+				f.write(self.data['file%d.bin' % (i)])
+		self.server = FakeNNTPServer(username='user', password='pass').start()
+	
+	def tearDown(self):
+		self.server.stop()
+		shutil.rmtree(self.tmpdir)
+	
+	def post(self, engine, streaming, servers={}, **posting):
+		conf = {
+			'posting': {'from': 'a <a@b>', 'default_group': 'alt.test', 'article_size': 8000, 'yenc_cache': '',
+				'subject_prefix': '', 'generate_nzbs': 0, 'engine': engine, 'journal': '',
+				'server_state': '', 'retry_delay': 0.01},
+			'server': {'hostname': '127.0.0.1', 'port': self.server.port, 'use_ssl': 0,
+				'username': 'user', 'password': 'pass', 'connections': 2, 'reconnect_delay': 0.1,
+				'streaming': streaming, 'quarantine_after': 100},
+		}
+		conf['posting'].update(posting)
+		conf.update(servers)
+		mangler = PostMangler(conf, False)
+		mangler.post('alt.test', [self.postdir])
+		mangler.loop.close()
+		return mangler
+	
+	def engines(self):
+		engines = ['asyncio']
+		if importlib.util.find_spec('asyncore'):
+			engines.append('asyncore')
+		return engines
+	
+	def check_engine(self, engine):
+		for streaming in (0, 1):
+			self.server.stats.reset()
+			self.server.conf['fail_rate'] = 0.2
+			mangler = self.post(engine, streaming)
+			self.assertEqual([], mangler._failed)
+			self.assertEqual(1 + 1 + 4, self.server.stats.accepted)
+			self.assertEqual(0, self.server.stats.bad)
+	
+	@unittest.skipUnless(importlib.util.find_spec('asyncore'), 'needs asyncore')
+	def test_asyncore(self):
+		self.check_engine('asyncore')
+	
+	def test_asyncio(self):
+		self.check_engine('asyncio')
+	
+	def test_session_errors(self):
+		# Everything that was in flight goes back in the queue
+		self.server.conf['error_every'] = 4
+		for engine in self.engines():
+			for streaming in (0, 1):
+				self.server.stats.reset()
+				mangler = self.post(engine, streaming, retry_attempts=20)
+				self.assertEqual([], mangler._failed)
+				self.assertTrue(self.server.stats.session_errors > 0)
+				# Anything the server took after the error gets posted again
+				self.assertTrue(self.server.stats.accepted >= 6)
+	
+	def test_dead_server(self):
+		# Nothing listens here once the socket is closed
+		import socket
+		sock = socket.socket()
+		sock.bind(('127.0.0.1', 0))
+		port = sock.getsockname()[1]
+		sock.close()
+		
+		for engine in self.engines():
+			self.server.stats.reset()
+			start = time.time()
+			mangler = self.post(engine, 0, servers={'server:dead': {'hostname': '127.0.0.1', 'port': port,
+				'connections': 1, 'reconnect_delay': 0.5}})
+			self.assertEqual([], mangler._failed)
+			self.assertEqual(6, self.server.stats.accepted)
+			self.assertTrue(time.time() - start < 5)
+	
+	def test_prepare_failure(self):
+		cwd = os.getcwd()
+		os.chdir(self.tmpdir)
+		self.addCleanup(os.chdir, cwd)
+		
+		read_part = FileWrap.read_part
+		def broken(filewrap, begin, end):
+			if filewrap._filepath.endswith('file2.bin') and begin == 8000:
+				raise OSError('disk on fire')
+			return read_part(filewrap, begin, end)
+		
+		# The part is given up on and the NZB still gets written
+		with unittest.mock.patch.object(FileWrap, 'read_part', broken):
+			mangler = self.post('asyncio', 0, generate_nzbs=1)
+		self.assertEqual(1, len(mangler._failed))
+		self.assertEqual(5, self.server.stats.accepted)
+		
+		nzbpath, = [name for name in os.listdir('.') if name.endswith('.nzb')]
+		segments = dict((entry.filename(), len(entry.segments)) for entry in read_nzb(nzbpath))
+		self.assertEqual({'file0.bin': 1, 'file1.bin': 1, 'file2.bin': 3}, segments)
+
+	def test_resume(self):
+		cwd = os.getcwd()
+		os.chdir(self.tmpdir)
+		self.addCleanup(os.chdir, cwd)
+		journal = os.path.join(self.tmpdir, 'test.journal')
+		
+		# Stop after a few parts, like someone hitting ^C
+		post_success = PostMangler.post_success
+		def interrupted(mangler, article):
+			post_success(mangler, article)
+			if mangler._posted == 3:
+				raise KeyboardInterrupt
+		
+		with unittest.mock.patch.object(PostMangler, 'post_success', interrupted):
+			with self.assertRaises(KeyboardInterrupt):
+				self.post('asyncio', 0, journal=journal, journal_sync=0.01)
+		# The other connection might have got one more in that never made
+		# it to the journal
+		self.assertIn(self.server.stats.accepted, (3, 4))
+		
+		# Only the rest gets posted, and the NZB has everything
+		self.server.stats.reset()
+		self.post('asyncio', 0, journal=journal, resume=True, generate_nzbs=1)
+		self.assertEqual(3, self.server.stats.accepted)
+		
+		nzbpath, = [name for name in os.listdir('.') if name.endswith('.nzb')]
+		entries = read_nzb(nzbpath)
+		segments = dict((entry.filename(), len(entry.segments)) for entry in entries)
+		self.assertEqual({'file0.bin': 1, 'file1.bin': 1, 'file2.bin': 4}, segments)
+		msgids = set(segment.msgid for entry in entries for segment in entry.segments)
+		self.assertEqual(6, len(msgids))
+		self.assertEqual(3, len(msgids & self.server.stats.msgids))
+
+	@unittest.skipUnless(par2.HAVE_NUMPY, 'needs NumPy')
+	def test_par2(self):
+		for read_fails in (False, True):
+			self.server.stats.reset()
+			read_part = FileWrap.read_part
+			def broken(filewrap, begin, end):
+				if read_fails and filewrap._filepath.endswith('file2.bin') and begin == 8000:
+					raise OSError('disk on fire')
+				return read_part(filewrap, begin, end)
+			
+			# A part that can't be read means no PAR2 files, but the post
+			# still finishes
+			with unittest.mock.patch.object(FileWrap, 'read_part', broken):
+				mangler = self.post('asyncio', 0, par2_redundancy=10, par2_dir=self.tmpdir, par2_workers=1)
+			par2files = [name for name in os.listdir(self.tmpdir) if name.endswith('.par2')]
+			if read_fails:
+				self.assertEqual(1, len(mangler._failed))
+				self.assertEqual(5, self.server.stats.accepted)
+				self.assertEqual([], par2files)
+			else:
+				self.assertEqual([], mangler._failed)
+				self.assertTrue(par2files)
+				self.assertTrue(self.server.stats.accepted > 6)
+				for name in par2files:
+					os.remove(os.path.join(self.tmpdir, name))
+	
+	def test_probe(self):
+		cwd = os.getcwd()
+		os.chdir(self.tmpdir)
+		self.addCleanup(os.chdir, cwd)
+		journal = os.path.join(self.tmpdir, 'test.journal')
+		
+		mangler = self.post('asyncio', 0, article_size='auto', probe_sizes='4000 8000', probe_bytes=20000,
+			checksum_files='sfv md5', journal=journal)
+		self.assertIn(mangler.conf['posting']['article_size'], (4000, 8000))
+		
+		# Only the real post gets checksum files and goes in the journal
+		self.assertEqual(['newsmangler_test_post.md5', 'newsmangler_test_post.sfv'],
+			sorted(name for name in os.listdir('.') if name.endswith(('.md5', '.sfv'))))
+		with open(journal) as f:
+			paths = [record['path'] for record in map(json.loads, f) if 'file' in record]
+		self.assertEqual(sorted(self.data), sorted(os.path.basename(path) for path in paths))
+
+class TestVerify(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+		os.chdir(self.tmpdir)
+		
+		self.postdir = os.path.join(self.tmpdir, 'test post')
+		os.mkdir(self.postdir)
+		for i, size in enumerate((1, 5000, 25000)):
+			with open(os.path.join(self.postdir, 'file%d.bin' % (i)), 'wb') as f:
+				f.write(os.urandom(size))
+		
+		self.server = FakeNNTPServer().start()
+		self.conf = {
+			'posting': {'from': 'a <a@b>', 'default_group': 'alt.test', 'article_size': 8000, 'yenc_cache': '',
+				'subject_prefix': '', 'generate_nzbs': 1, 'engine': 'asyncio', 'journal': '',
+				'server_state': '', 'retry_delay': 0.01},
+			'server': {'hostname': '127.0.0.1', 'port': self.server.port, 'use_ssl': 0,
+				'username': '', 'password': '', 'connections': 2, 'reconnect_delay': 0.1,
+				'verify_window': 4},
+		}
+	
+	def tearDown(self):
+		os.chdir(self.cwd)
+		self.server.stop()
+		shutil.rmtree(self.tmpdir)
+	
+	def mangler(self):
+		mangler = PostMangler(dict((k, dict(v)) for k, v in self.conf.items()), False)
+		self.addCleanup(mangler.loop.close)
+		return mangler
+	
+	def test_read_nzb(self):
+		writer = NZBWriter('test.nzb', 'a <a@b>', ['alt.test', 'alt.test2'])
+		writer.add_segment('x [1/1] - "x.bin" yEnc (01/12)', 12, 2, '<2@b>', 100, 1)
+		writer.close()
+		
+		entry, = read_nzb('test.nzb')
+		self.assertEqual('x.bin', entry.filename())
+		self.assertEqual(12, entry.total())
+		self.assertEqual('x [1/1] - "x.bin" yEnc (03/12)', entry.subject_format() % (3))
+		self.assertEqual(['alt.test', 'alt.test2'], entry.groups)
+		self.assertEqual([(2, 100, '<2@b>')], [(seg.number, seg.bytes, seg.msgid) for seg in entry.segments])
+		
+		# Other NZBs have a namespace, and might be gzipped
+		with gzip.open('other.nzb', 'wt') as f:
+			f.write('<?xml version="1.0"?><nzb xmlns="http://www.newzbin.com/DTD/2003/nzb">'
+				'<file poster="p" date="1" subject="100% &quot;y.bin&quot; (1/1)"><groups><group>a.b</group>'
+				'</groups><segments><segment bytes="5" number="1">m@n</segment></segments></file></nzb>')
+		entry, = read_nzb('other.nzb')
+		self.assertEqual('100% "y.bin" (1/1)', entry.subject_format() % (1))
+		self.assertEqual('<m@n>', entry.segments[0].msgid)
+		
+		with open('bad.nzb', 'w') as f:
+			f.write('<nzb><file>')
+		self.assertRaises(ValueError, read_nzb, 'bad.nzb')
+	
+	def test_verify_and_repair(self):
+		self.mangler().post('alt.test', [self.postdir])
+		nzb = 'newsmangler_test_post.nzb'
+		self.assertEqual([], self.mangler().verify([nzb]))
+		
+		# Lose some articles
+		with self.server.stats.lock:
+			lost = sorted(self.server.stats.msgids)[:3]
+			self.server.stats.msgids.difference_update(lost)
+		
+		results = self.mangler().verify([nzb])
+		self.assertEqual(sorted(lost), sorted(seg.msgid for path, entry, missing in results for seg in missing))
+		
+		accepted = self.server.stats.accepted
+		self.assertEqual(0, self.mangler().repair([nzb], [self.postdir]))
+		self.assertEqual(accepted + 3, self.server.stats.accepted)
+		self.assertEqual(0, self.server.stats.bad)
+		self.assertEqual([], self.mangler().verify([nzb]))
+		
+		# Files that have changed size can't be repaired
+		with self.server.stats.lock:
+			self.server.stats.msgids.difference_update(lost)
+		with open(os.path.join(self.postdir, 'file2.bin'), 'ab') as f:
+			f.write(os.urandom(8000))
+		changed = sum(entry.filename() == 'file2.bin' for path, entry, missing in results)
+		self.assertEqual(changed, self.mangler().repair([nzb], [self.postdir]))
+		self.assertEqual(accepted + 6 - changed, self.server.stats.accepted)
+
+	def test_checksum_files(self):
+		self.conf['posting']['checksum_files'] = 'sfv md5 bogus'
+		self.mangler().post('alt.test', [self.postdir])
+		
+		crcs, md5s = {}, {}
+		for i in range(3):
+			with open(os.path.join(self.postdir, 'file%d.bin' % (i)), 'rb') as f:
+				data = f.read()
+			crcs['file%d.bin' % (i)] = '%08X' % (zlib.crc32(data))
+			md5s['file%d.bin' % (i)] = hashlib.md5(data).hexdigest()
+		
+		with open('newsmangler_test_post.sfv') as f:
+			lines = [line.split() for line in f if not line.startswith(';')]
+		self.assertEqual(crcs, dict(lines))
+		with open('newsmangler_test_post.md5') as f:
+			self.assertEqual(md5s, dict(line.split(' *')[::-1] for line in f.read().splitlines()))
+		self.assertFalse(os.path.exists('newsmangler_test_post.bogus'))
+		
+		root = ET.parse('newsmangler_test_post.nzb').getroot()
+		meta = [(m.get('type'), m.text) for m in root.find('head')]
+		self.assertIn(('crc32', '%s *file2.bin' % (crcs['file2.bin'].lower())), meta)
+		self.assertIn(('md5', '%s *file1.bin' % (md5s['file1.bin'])), meta)
+		self.assertEqual(3, len(read_nzb('newsmangler_test_post.nzb')))
+
+class TestWorkers(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+		os.chdir(self.tmpdir)
+		
+		self.postdir = os.path.join(self.tmpdir, 'test post')
+		os.mkdir(self.postdir)
+		for i, size in enumerate((1, 5000, 25000, 60000)):
+			with open(os.path.join(self.postdir, 'file%d.bin' % (i)), 'wb') as f:
+				f.write(os.urandom(size))
+		self.server = FakeNNTPServer(slow_ack=0.02).start()
+	
+	def tearDown(self):
+		os.chdir(self.cwd)
+		self.server.stop()
+		shutil.rmtree(self.tmpdir)
+	
+	def test_worker_conf(self):
+		conf = {
+			'posting': {'journal': 'x', 'skip_filenames': ['a', 'b']},
+			'server': {'hostname': 'a', 'connections': 5},
+			'server:b': {'hostname': 'b', 'connections': 1},
+			'server:c': {'hostname': 'c', 'connections': 2, 'max_connections': 6, 'min_connections': 4},
+		}
+		confs = [workers.worker_conf(conf, i, 2) for i in range(2)]
+		self.assertEqual([3, 2], [c['server']['connections'] for c in confs])
+		self.assertEqual([True, False], ['server:b' in c for c in confs])
+		self.assertEqual([(1, 3, 3), (1, 3, 3)], [(c['server:c']['connections'], c['server:c']['min_connections'],
+			c['server:c']['max_connections']) for c in confs])
+		self.assertEqual(('', 'a b'), (confs[0]['posting']['journal'], confs[0]['posting']['skip_filenames']))
+		self.assertEqual(5, conf['server']['connections'])
+		self.assertEqual(6, workers.max_workers({'server': {'connections': 2, 'max_connections': 6}}))
+	
+	def test_split(self):
+		mangler = unittest.mock.Mock(conf={'posting': {}, 'server': {'hostname': 'a', 'connections': 4}})
+		coordinator = workers.Coordinator(mangler, 3)
+		planned = [('big', [(i + 1, i * 10, i * 10 + 10) for i in range(12)]), ('small', [(1, 0, 5)])]
+		shards = coordinator.split(planned)
+		self.assertEqual(['big', 'small'], coordinator._files)
+		self.assertEqual([[(0, planned[0][1][0:4]), (1, planned[1][1])], [(0, planned[0][1][4:8])],
+			[(0, planned[0][1][8:12])]], shards)
+	
+	def test_worker_dies(self):
+		conf = {
+			'posting': {'from': 'a <a@b>', 'default_group': 'alt.test', 'article_size': 8000, 'yenc_cache': '',
+				'subject_prefix': '', 'generate_nzbs': 1, 'engine': 'asyncio', 'journal': 'test.journal',
+				'server_state': '', 'retry_delay': 0.01, 'workers': 2},
+			'server': {'hostname': '127.0.0.1', 'port': self.server.port, 'use_ssl': 0,
+				'username': '', 'password': '', 'connections': 2, 'reconnect_delay': 0.1},
+		}
+		
+		# Kill the first worker once it has posted something
+		handle = workers.Coordinator.handle
+		killed = []
+		def kill_first(coordinator, message):
+			handle(coordinator, message)
+			if message[0] == 'posted' and not killed:
+				killed.append(message[1])
+				coordinator._workers[message[1]].process.kill()
+		
+		with unittest.mock.patch.object(workers.Coordinator, 'handle', kill_first):
+			mangler = PostMangler(conf, False)
+			mangler.post('alt.test', [self.postdir])
+			mangler.loop.close()
+		
+		self.assertEqual(1, len(killed))
+		self.assertEqual(1 + 1 + 4 + 8, mangler._posted)
+		self.assertEqual(0, self.server.stats.bad)
+		entries = read_nzb('newsmangler_test_post.nzb')
+		self.assertEqual([1, 1, 4, 8], sorted(len(entry.segments) for entry in entries))
+		self.assertEqual(set(seg.msgid for entry in entries for seg in entry.segments) - self.server.stats.msgids, set())
+		
+		# The journal is written by the coordinator
+		journal = Journal('test.journal', resume=True)
+		key, identity = file_identity(os.path.join(self.postdir, 'file3.bin'))
+		self.assertEqual(list(range(1, 9)), sorted(journal.done_parts(key)))
+		journal.close()
+
+class TestFakeNNTP(unittest.TestCase):
+	def test_check_article(self):
+		body = io.BytesIO()
+		crc = yenc.yEncode(body, b'hello')
+		article = b'Subject: x\r\n\r\n=ybegin part=1 line=128 size=5 name=x\r\n=ypart begin=1 end=5\r\n'
+		article += body.getvalue() + ('=yend size=5 part=1 pcrc32=%s\r\n' % (crc)).encode('ascii')
+		self.assertEqual(None, check_article(article))
+		self.assertEqual('pcrc32 mismatch', check_article(article.replace(crc.encode('ascii'), b'00000000')))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)